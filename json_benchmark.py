@@ -0,0 +1,33 @@
+from nidm.experiment.Navigate import makeValueType
+from nidm.experiment.tools import rest_json
+import simplejson
+import timeit
+import sys
+
+# a field_values response of ROWS ValueTypes, like /projects/{id}?fields=... returns
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+REPEAT = 5
+
+def makeResult():
+    return [makeValueType(value=20 + i % 50, label='AGE_AT_SCAN', datumType='http://uri.interlex.org/ilx_0738262',
+                          hasUnit='years', isAbout='http://uri.interlex.org/ilx_0100400', measureOf='http://uri.interlex.org/ilx_0104846',
+                          dataElement='AGE_AT_SCAN', description='Age at scan', subject='sub-{:06d}'.format(i), project='abc123')
+            for i in range(ROWS)]
+
+def best(function):
+    return min(timeit.repeat(function, number=1, repeat=REPEAT))
+
+if __name__ == '__main__':
+    result = makeResult()
+    timings = [('simplejson indent=2 (previous output)', lambda: simplejson.dumps(result, indent=2).encode('utf-8'))]
+    for name in sorted(rest_json.ENCODERS):
+        rest_json.setEncoder(name)
+        timings.append(('{} compact'.format(name), lambda encoder=rest_json.ENCODERS[name]: encoder(result)))
+        timings.append(('{} pretty'.format(name), lambda encoder=rest_json.ENCODERS[name]: encoder(result, pretty=True)))
+
+    print("Encoding {} ValueTypes, best of {}".format(ROWS, REPEAT))
+    baseline = None
+    for name, function in timings:
+        seconds = best(function)
+        baseline = baseline or seconds
+        print("{:<40} {:8.3f}s {:6.1f}x {:10d} bytes".format(name, seconds, baseline / seconds, len(function())))
@@ -4,7 +4,6 @@ import uuid
 from rdflib import Namespace
 from rdflib.namespace import XSD
 import types 
-import graphviz
 from rdflib import Graph, RDF, URIRef, util, plugin
 from rdflib.serializer import Serializer
 
@@ -12,7 +11,6 @@ from rdflib.serializer import Serializer
 #sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from ..core import Constants
 import prov.model as pm
-from prov.dot import prov_to_dot
 from io import StringIO
 from collections import OrderedDict
 import json
@@ -20,7 +18,6 @@ import re
 import string
 import random
 
-from pydot import Edge
 
 def getUUID():
     uid = str(uuid.uuid1())
@@ -448,6 +445,10 @@ class Core(object):
         return context
 
     def save_DotGraph(self,filename,format=None):
+        # graphviz support is only imported when a graph is drawn
+        from prov.dot import prov_to_dot
+        from pydot import Edge
+
         dot = prov_to_dot(self.graph)
 
         ISPARTOF = {
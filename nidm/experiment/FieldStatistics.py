@@ -0,0 +1,147 @@
+'''
+Vectorized statistics over a table of field values (one row per subject, one column per field).
+
+Every column is typed with ValueColumn, the statistics of all groups are computed with pandas
+group-by operations over the whole column instead of looping over subjects.  Numeric fields get
+counts, the basic statistics, percentiles and a histogram with bin edges shared by all groups,
+categorical fields get the count of each category.
+'''
+import numpy as np
+import pandas as pd
+
+from nidm.experiment.ValueColumn import ValueColumn
+
+PERCENTILES = (5, 25, 50, 75, 95)
+HISTOGRAM_BINS = 10
+
+
+def fieldTable(columns, index=None):
+    '''
+    Builds a typed DataFrame from {field: list of values}
+
+    :param columns: dict of equally long lists, missing values may be None
+    :param index: optional row labels (e.g. subject UUIDs)
+    :return: pandas DataFrame with int64, float64 or categorical columns
+    '''
+    table = pd.DataFrame({field: ValueColumn(values).toPandas() for field, values in columns.items()})
+    if index is not None:
+        table.index = list(index)
+    return table
+
+
+def plain(value):
+    '''
+    numpy scalars and NaN to JSON friendly python values
+    '''
+    if value is None:
+        return None
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(value)
+    if pd.isna(value):
+        return None
+    return value
+
+
+def groupKeys(table, group_by):
+    '''
+    Numbers the groups of the table rows
+
+    :return: (group number of each row, list of group tuples in group number order)
+    '''
+    if len(group_by) == 0:
+        return np.zeros(len(table), dtype=np.int64), [()] if len(table) > 0 else []
+    keys = table[group_by]
+    group_ids = keys.groupby(group_by, observed=True, dropna=False, sort=True).ngroup().to_numpy()
+    first_rows = pd.Series(np.arange(len(keys))).groupby(group_ids).first().to_numpy()
+    groups = [tuple(plain(v) for v in keys.iloc[row]) for row in first_rows]
+    return group_ids, groups
+
+
+def numericStatistics(values, group_ids, groups, bins):
+    '''
+    Statistics of one numeric column for every group
+
+    :return: list of stats dicts in group number order
+    '''
+    values = values.astype(np.float64).to_numpy()
+    grouped = pd.Series(values).groupby(group_ids, sort=True)
+
+    basic = pd.DataFrame({
+        'count': grouped.count(),
+        'missing': grouped.size() - grouped.count(),
+        'max': grouped.max(),
+        'min': grouped.min(),
+        'median': grouped.median(),
+        'mean': grouped.mean(),
+        'standard_deviation': grouped.std(ddof=0),
+    }).reindex(range(len(groups)))
+    quantiles = grouped.quantile([p / 100.0 for p in PERCENTILES]).unstack().reindex(range(len(groups)))
+
+    mask = ~np.isnan(values)
+    edges = np.histogram_bin_edges(values[mask], bins=bins) if mask.any() else np.array([])
+    histograms = np.zeros((len(groups), max(len(edges) - 1, 0)), dtype=np.int64)
+    if mask.any():
+        # the last bin includes its right edge, like numpy.histogram
+        bin_ids = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, bins - 1)
+        histograms = np.bincount(group_ids[mask] * bins + bin_ids[mask], minlength=len(groups) * bins).reshape(len(groups), bins)
+
+    result = []
+    for i in range(len(groups)):
+        stats = {name: plain(basic[name].iloc[i]) for name in basic.columns}
+        stats['count'] = int(basic['count'].iloc[i])
+        stats['missing'] = int(basic['missing'].iloc[i])
+        stats['percentiles'] = {'p{}'.format(p): plain(quantiles[p / 100.0].iloc[i]) for p in PERCENTILES}
+        stats['histogram'] = {'edges': [float(e) for e in edges], 'counts': [int(c) for c in histograms[i]]}
+        result.append(stats)
+    return result
+
+
+def categoricalStatistics(values, group_ids, groups):
+    '''
+    Category counts of one categorical column for every group
+
+    :return: list of stats dicts in group number order
+    '''
+    codes = values.cat.codes.to_numpy()
+    categories = list(values.cat.categories)
+    present = codes >= 0
+    counts = np.bincount(group_ids[present] * len(categories) + codes[present],
+                         minlength=len(groups) * len(categories)).reshape(len(groups), len(categories))
+    sizes = np.bincount(group_ids, minlength=len(groups))
+
+    result = []
+    for i in range(len(groups)):
+        result.append({'count': int(counts[i].sum()), 'missing': int(sizes[i] - counts[i].sum()),
+                       'max': None, 'min': None, 'median': None, 'mean': None, 'standard_deviation': None,
+                       'categories': {str(c): int(n) for c, n in zip(categories, counts[i]) if n > 0}})
+    return result
+
+
+def fieldStatistics(table, fields, group_by=None, bins=HISTOGRAM_BINS):
+    '''
+    Statistics of each field, overall or for each combination of the group_by fields
+
+    :param table: DataFrame from fieldTable
+    :param fields: columns to describe
+    :param group_by: list of (categorical) columns to group the rows by
+    :param bins: number of histogram bins
+    :return: {field: stats} without group_by, otherwise {field: [{'group': {name: value}, ...stats}]}
+    '''
+    group_by = list(group_by or [])
+    group_ids, groups = groupKeys(table, group_by)
+
+    result = {}
+    for field in fields:
+        values = table[field]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            stats = categoricalStatistics(values, group_ids, groups)
+        else:
+            stats = numericStatistics(values, group_ids, groups, bins)
+
+        if len(group_by) == 0:
+            result[field] = stats[0] if len(stats) > 0 else None
+        else:
+            result[field] = [dict({'group': dict(zip(group_by, group))}, **stats[i]) for i, group in enumerate(groups)]
+    return result
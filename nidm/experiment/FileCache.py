@@ -0,0 +1,409 @@
+'''
+File version aware caches for the Query and Navigate modules.
+
+A query over a set of NIDM files is split into one partial result per file and a cheap step that
+combines them.  The partials are cached per file with a dependency record, the version of the file
+(modification time and size) they were computed from:
+
+    @perFile(maxsize=QUERY_CACHE_SIZE)
+    def getFileProjects(file):
+        ...
+
+    @corpusCache(maxsize=QUERY_CACHE_SIZE)
+    def getProjects(nidm_file_tuples):
+        return [project for file in nidm_file_tuples for project in getFileProjects(file)]
+
+When one file of the corpus changes, or a file is added, only that file's partials are recomputed:
+the partials of the other files still match their versions.  corpusCache keeps the combined result
+(or the result of a lookup across all files) along with the versions of every file it was computed
+from and recomputes it when any of them changed.
+
+perFile(persist=True) also pickles the partials in the temp directory keyed by the md5 of the file
+contents, so they survive the process and a changed file can never be served from a stale pickle.
+
+Both caches have lru_cache's cache_info() and cache_clear(), invalidate(file) drops everything
+computed from one file.  pin(function, *args) keeps one result regardless of the cache's maxsize.
+
+Checking the versions means a stat of every file on every call, which adds up for lookups done once
+per term or subject over a large corpus.  Inside a VersionSnapshot the version of each file (and of
+each tuple of files) is only looked up once, the REST parser and the query command run every query
+in one:
+
+    with VersionSnapshot():
+        ...
+'''
+import os
+import pickle
+import hashlib
+import tempfile
+import threading
+import functools
+import collections
+from os import path
+
+from rdflib.graph import Graph
+
+# part of the name of the pickled partials, bump it when a persisted function changes its result
+PARTIAL_CACHE_VERSION = 1
+
+# file lists a VersionSnapshot recognizes by identity
+SNAPSHOT_LISTS = 64
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+_caches = []
+_hashes = {}
+_snapshots = threading.local()
+
+
+def hashFile(file):
+    '''
+    Returns the md5 hex digest of the file contents. Used to key the on disk caches
+    so a changed file is never served from a stale cache entry.
+
+    :param file: filename
+    :return: hex digest string
+    '''
+    BLOCKSIZE = 65536
+    hasher = hashlib.md5()
+    with open(file, 'rb') as afile:
+        buf = afile.read(BLOCKSIZE)
+        while len(buf) > 0:
+            hasher.update(buf)
+            buf = afile.read(BLOCKSIZE)
+    return hasher.hexdigest()
+
+
+def fileKey(file):
+    '''
+    Parsed graphs can't be hashed reliably, they are cached by identity
+    '''
+    if isinstance(file, str):
+        return file
+    return ('graph', id(file)) if isinstance(file, Graph) else file
+
+
+def fileVersion(file):
+    '''
+    The version of a file a cached result depends on: (modification time, size) of a file on disk,
+    in memory graphs never change.  A file that doesn't exist has version None.
+    '''
+    if isinstance(file, Graph):
+        return ('graph', id(file))
+    try:
+        stat = os.stat(file)
+    except (OSError, TypeError, ValueError):
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def fileHash(file, version=None):
+    '''
+    hashFile, only computed once per file version
+    '''
+    version = version or fileVersion(file)
+    cached = _hashes.get(file)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    digest = hashFile(file)
+    _hashes[file] = (version, digest)
+    return digest
+
+
+class VersionSnapshot:
+    '''
+    Context in which every file keeps the version it had when it was first looked at, so the caches
+    only stat it once.  Snapshots can be entered again (and nested, the outermost one is used).
+    '''
+
+    def __init__(self):
+        self.files = {}
+        # file tuple -> (file keys, versions)
+        self.tuples = {}
+        # id of a file list -> (the list, file keys, versions) saves hashing long tuples on every call,
+        # the list is kept so its id can't be reused while the entry exists
+        self.lists = {}
+
+    def version(self, file):
+        key = fileKey(file)
+        if key not in self.files:
+            self.files[key] = fileVersion(file)
+        return self.files[key]
+
+    def fileList(self, files):
+        entry = self.lists.get(id(files))
+        if entry is not None:
+            return entry
+        key = tuple(files)
+        found = self.tuples.get(key)
+        if found is None:
+            found = self.tuples[key] = (tuple(fileKey(f) for f in key), tuple(self.version(f) for f in key))
+        if len(self.lists) >= SNAPSHOT_LISTS:
+            # lists built for a single call would pile up otherwise
+            self.lists.clear()
+        entry = self.lists[id(files)] = (files,) + found
+        return entry
+
+    def versions(self, files):
+        return self.fileList(files)[2]
+
+    def fileKeys(self, files):
+        return self.fileList(files)[1]
+
+    def __enter__(self):
+        if not hasattr(_snapshots, 'stack'):
+            _snapshots.stack = []
+        _snapshots.stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _snapshots.stack.pop()
+        return False
+
+
+def activeSnapshot():
+    '''
+    The outermost VersionSnapshot of this thread or None
+    '''
+    stack = getattr(_snapshots, 'stack', None)
+    return stack[0] if stack else None
+
+
+class VersionedCache:
+    '''
+    Bounded LRU cache whose entries remember the file versions they were computed from and are
+    recomputed once those no longer match.  Pinned entries (see pin) don't count against the bound.
+    '''
+
+    def __init__(self, function, maxsize):
+        functools.update_wrapper(self, function)
+        self.function = function
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.pinned = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        _caches.append(self)
+
+    def key(self, args, kwargs):
+        raise NotImplementedError
+
+    def files(self, args, kwargs):
+        raise NotImplementedError
+
+    def versions(self, files):
+        snapshot = activeSnapshot()
+        if snapshot is not None:
+            return snapshot.versions(files)
+        return tuple(fileVersion(f) for f in files)
+
+    def compute(self, versions, args, kwargs):
+        return self.function(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        key = self.key(args, kwargs)
+        versions = self.versions(self.files(args, kwargs))
+        with self.lock:
+            entry = self.pinned.get(key)
+            if entry is None:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+            if entry is not None and (entry[0] is versions or entry[0] == versions):
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        result = self.compute(versions, args, kwargs)
+
+        with self.lock:
+            # the files (or graphs, which are keyed by identity) are kept alive with the entry
+            if key in self.pinned:
+                self.pinned[key] = (versions, result, args[0])
+                return result
+            self.entries[key] = (versions, result, args[0])
+            self.entries.move_to_end(key)
+            if self.maxsize is not None and len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return result
+
+    def pin(self, *args, **kwargs):
+        '''
+        Calls the function and keeps the result until its file changes or is invalidated, however
+        many other entries are added after it
+
+        :return: the result
+        '''
+        result = self(*args, **kwargs)
+        key = self.key(args, kwargs)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                entry = (self.versions(self.files(args, kwargs)), result, args[0])
+            self.pinned[key] = entry
+        return result
+
+    def __get__(self, instance, owner):
+        # behave like a function when stored on a class
+        if instance is None:
+            return self
+        return functools.partial(self, instance)
+
+    def dependsOn(self, key, file):
+        raise NotImplementedError
+
+    def invalidate(self, file):
+        '''
+        Drops every entry computed from the file
+        '''
+        key = fileKey(file)
+        with self.lock:
+            for entries in [self.entries, self.pinned]:
+                for entry_key in [k for k in entries if self.dependsOn(k, key)]:
+                    del entries[entry_key]
+
+    def dependencies(self, file):
+        '''
+        The cache keys of the entries computed from the file
+        '''
+        key = fileKey(file)
+        with self.lock:
+            return [k for k in list(self.pinned) + list(self.entries) if self.dependsOn(k, key)]
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries) + len(self.pinned))
+
+    def cache_clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pinned.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class PartialCache(VersionedCache):
+    '''
+    Caches a function whose first argument is a single file, see perFile
+    '''
+
+    def __init__(self, function, maxsize, persist=False):
+        super().__init__(function, maxsize)
+        self.persist = persist
+        self.loaded = 0
+
+    def key(self, args, kwargs):
+        return (fileKey(args[0]),) + args[1:] + tuple(sorted(kwargs.items()))
+
+    def files(self, args, kwargs):
+        return args[:1]
+
+    def versions(self, files):
+        snapshot = activeSnapshot()
+        if snapshot is not None:
+            return (snapshot.version(files[0]),)
+        return (fileVersion(files[0]),)
+
+    def dependsOn(self, key, file):
+        return key[0] == file
+
+    def pickleFile(self, version, args, kwargs):
+        arguments = hashlib.md5(repr(self.key(args, kwargs)[1:]).encode('utf-8')).hexdigest()
+        return '{}/partial.{}.{}.{}.{}.{}.pickle'.format(tempfile.gettempdir(), PARTIAL_CACHE_VERSION,
+                                                         self.__module__.split('.')[-1], self.__name__,
+                                                         fileHash(args[0], version), arguments)
+
+    def compute(self, versions, args, kwargs):
+        if not self.persist or isinstance(args[0], Graph) or versions[0] is None:
+            return self.function(*args, **kwargs)
+
+        pickle_file = self.pickleFile(versions[0], args, kwargs)
+        if path.isfile(pickle_file):
+            try:
+                with open(pickle_file, 'rb') as f:
+                    result = pickle.load(f)
+                self.loaded += 1
+                return result
+            except Exception:
+                # a partly written or unreadable pickle, compute it again
+                pass
+        result = self.function(*args, **kwargs)
+        # write and rename so concurrent readers never see half a pickle
+        partial_file = '{}.{}'.format(pickle_file, os.getpid())
+        with open(partial_file, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(partial_file, pickle_file)
+        return result
+
+
+class CorpusCache(VersionedCache):
+    '''
+    Caches a function whose first argument is a tuple of files, see corpusCache
+    '''
+
+    def key(self, args, kwargs):
+        snapshot = activeSnapshot()
+        files = snapshot.fileKeys(args[0]) if snapshot is not None else tuple(fileKey(f) for f in args[0])
+        return (files,) + args[1:] + tuple(sorted(kwargs.items()))
+
+    def files(self, args, kwargs):
+        return args[0]
+
+    def dependsOn(self, key, file):
+        return file in key[0]
+
+
+def perFile(maxsize=128, persist=False):
+    '''
+    Decorator caching the partial result of one file, the first argument of the function, until
+    the file changes
+
+    :param maxsize: number of (file, arguments) entries kept
+    :param persist: also keep the results in the temp directory, keyed by the file contents
+    '''
+    def decorator(function):
+        return PartialCache(function, maxsize, persist)
+    return decorator
+
+
+def corpusCache(maxsize=128):
+    '''
+    Decorator caching the result of a function of a tuple of files, the first argument, until one
+    of the files changes
+    '''
+    def decorator(function):
+        return CorpusCache(function, maxsize)
+    return decorator
+
+
+def pin(function, *args, **kwargs):
+    '''
+    Calls a function cached with perFile or corpusCache (possibly wrapped, e.g. by the
+    instrumentation) and keeps the result out of reach of the LRU bound, see VersionedCache.pin.
+    The REST server pins the graphs and tables it loads up front this way.
+    '''
+    cache = function
+    while not isinstance(cache, VersionedCache):
+        cache = cache.__wrapped__
+    return cache.pin(*args, **kwargs)
+
+
+def invalidate(file):
+    '''
+    Drops everything cached in memory that was computed from the file
+    '''
+    for cache in _caches:
+        cache.invalidate(file)
+    _hashes.pop(file, None)
+
+
+def dependencies(file):
+    '''
+    {function name: cache keys} of the cached results computed from the file
+    '''
+    result = {}
+    for cache in _caches:
+        keys = cache.dependencies(file)
+        if keys:
+            result['{}.{}'.format(cache.__module__.split('.')[-1], cache.__name__)] = keys
+    return result
@@ -0,0 +1,308 @@
+'''
+Opt-in timing instrumentation for the Query and Navigate modules.
+
+Nothing is recorded unless a trace is active, either through the context manager:
+
+    with trace('/tmp/query_trace.json') as t:
+        restParser.run(files, '/projects')
+    print(t.report())
+
+or by setting the PYNIDM_TRACE environment variable to the path of a JSON file, in which case
+everything the process does is traced and the trace is written when the process exits.
+
+Every call of an instrumented function records its elapsed time (total and excluding nested
+instrumented calls), whether it was answered from its lru_cache, how many rows it produced and
+any named stages (hashing, unpickling, parsing, SPARQL evaluation, formatting...) it went through.
+'''
+import os
+import time
+import json
+import atexit
+import inspect
+import functools
+import contextlib
+from datetime import datetime
+
+import rdflib
+from tabulate import tabulate
+
+TRACE_ENV = 'PYNIDM_TRACE'
+
+_active_traces = []
+
+
+class Trace:
+
+    def __init__(self, output_file=None):
+        self.output_file = output_file
+        self.started = datetime.now().isoformat()
+        self.start_time = time.perf_counter()
+        self.calls = []
+        self.stack = []
+
+    def begin(self, name, args):
+        frame = {'function': name, 'args': args, 'depth': len(self.stack),
+                 'start': time.perf_counter() - self.start_time, 'children': 0.0, 'stages': [], 'info': {}}
+        self.stack.append(frame)
+        return frame
+
+    def _pop(self, frame):
+        # frames are dicts so compare by identity, not by value
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i] is frame:
+                del self.stack[i]
+                return
+
+    def suspend(self, frame):
+        # a generator handed control back to its consumer
+        self._pop(frame)
+
+    def resume(self, frame):
+        self.stack.append(frame)
+
+    def end(self, frame, elapsed, cache=None, rows=None):
+        self._pop(frame)
+        frame['elapsed'] = elapsed
+        frame['self_elapsed'] = max(0.0, elapsed - frame.pop('children'))
+        frame['cache'] = cache
+        frame['rows'] = rows
+        if self.stack:
+            self.stack[-1]['children'] += elapsed
+        self.calls.append(frame)
+
+    def addStage(self, name, elapsed, info):
+        stage = {'stage': name, 'elapsed': elapsed}
+        stage.update(info)
+        if self.stack:
+            self.stack[-1]['stages'].append(stage)
+        else:
+            # stage outside of any instrumented function, keep it as its own entry
+            self.calls.append({'function': None, 'depth': 0, 'elapsed': elapsed, 'self_elapsed': elapsed,
+                               'stages': [stage], 'info': {}, 'cache': None, 'rows': None})
+
+    def note(self, **info):
+        if self.stack:
+            self.stack[-1]['info'].update(info)
+
+    def summary(self):
+        '''
+        Aggregates the calls per function and the stages per stage name
+
+        :return: {'functions': [...], 'stages': [...]}
+        '''
+        functions = {}
+        stages = {}
+        for call in self.calls:
+            if call['function']:
+                f = functions.setdefault(call['function'], {'function': call['function'], 'calls': 0, 'elapsed': 0.0,
+                                                            'self_elapsed': 0.0, 'cache_hits': 0, 'cache_misses': 0, 'rows': 0})
+                f['calls'] += 1
+                f['elapsed'] += call['elapsed']
+                f['self_elapsed'] += call['self_elapsed']
+                if call['cache'] == 'hit':
+                    f['cache_hits'] += 1
+                elif call['cache'] == 'miss':
+                    f['cache_misses'] += 1
+                if call['rows']:
+                    f['rows'] += call['rows']
+            for stage in call['stages']:
+                s = stages.setdefault(stage['stage'], {'stage': stage['stage'], 'count': 0, 'elapsed': 0.0})
+                s['count'] += 1
+                s['elapsed'] += stage['elapsed']
+
+        return {'functions': sorted(functions.values(), key=lambda x: x['self_elapsed'], reverse=True),
+                'stages': sorted(stages.values(), key=lambda x: x['elapsed'], reverse=True)}
+
+    def files(self):
+        '''
+        Returns the per-file information (triple counts, how the graph was loaded) noted by OpenGraph
+        '''
+        result = {}
+        for call in self.calls:
+            if 'file' in call['info']:
+                result.setdefault(call['info']['file'], {}).update(call['info'])
+        return list(result.values())
+
+    def toDict(self):
+        return {'started': self.started, 'elapsed': time.perf_counter() - self.start_time,
+                'calls': self.calls, 'files': self.files(), 'summary': self.summary()}
+
+    def write(self, output_file=None):
+        output_file = output_file or self.output_file
+        with open(output_file, 'w') as f:
+            json.dump(self.toDict(), f, indent=2, default=str)
+
+    def report(self):
+        '''
+        Human readable breakdown of where the time went
+        '''
+        summary = self.summary()
+        total = time.perf_counter() - self.start_time
+        functions = [[f['function'], f['calls'], "{:.4f}".format(f['elapsed']), "{:.4f}".format(f['self_elapsed']),
+                      f['cache_hits'], f['cache_misses'], f['rows']] for f in summary['functions']]
+        stages = [[s['stage'], s['count'], "{:.4f}".format(s['elapsed'])] for s in summary['stages']]
+        files = [[f.get('file'), f.get('source'), f.get('triples')] for f in self.files()]
+
+        return "{}\n\n{}\n\n{}\n\nTotal elapsed: {:.4f}s".format(
+            tabulate(functions, headers=['function', 'calls', 'total (s)', 'self (s)', 'cache hits', 'cache misses', 'rows']),
+            tabulate(stages, headers=['stage', 'count', 'elapsed (s)']),
+            tabulate(files, headers=['file', 'loaded from', 'triples']),
+            total)
+
+
+def currentTrace():
+    if _active_traces:
+        return _active_traces[-1]
+    return None
+
+
+def tracing():
+    return len(_active_traces) > 0
+
+
+@contextlib.contextmanager
+def trace(output_file=None):
+    '''
+    Records every instrumented call made inside the with block.  If output_file is
+    given the trace is written there as JSON when the block exits.
+    '''
+    t = Trace(output_file)
+    _active_traces.append(t)
+    try:
+        yield t
+    finally:
+        _active_traces.remove(t)
+        if output_file:
+            t.write()
+
+
+@contextlib.contextmanager
+def stage(name, **info):
+    '''
+    Times a named stage (e.g. 'hash', 'unpickle', 'parse', 'sparql') inside the current call
+    '''
+    t = currentTrace()
+    if t is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        t.addStage(name, time.perf_counter() - start, info)
+
+
+def note(**info):
+    '''
+    Attaches extra information (e.g. a triple count) to the current call, if tracing
+    '''
+    t = currentTrace()
+    if t is not None:
+        t.note(**info)
+
+
+def countRows(result):
+    if isinstance(result, rdflib.graph.Graph):
+        # the triple count is noted separately by OpenGraph
+        return None
+    if hasattr(result, 'data') and isinstance(getattr(result, 'data'), list):
+        # ActivityData
+        return len(result.data)
+    if isinstance(result, (str, bytes)):
+        return None
+    try:
+        return len(result)
+    except TypeError:
+        return None
+
+
+def describeArgs(args, kwargs):
+    def short(x):
+        s = repr(x)
+        return s if len(s) < 80 else s[:77] + '...'
+    return [short(a) for a in args] + ["{}={}".format(k, short(v)) for k, v in kwargs.items()]
+
+
+def instrumented(func, name=None):
+    '''
+    Wraps a function so its calls are recorded in the active trace.  When no trace
+    is active the only overhead is one list check.
+    '''
+    name = name or "{}.{}".format(func.__module__.split('.')[-1], func.__name__)
+    cache_info = getattr(func, 'cache_info', None)
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            t = currentTrace()
+            if t is None:
+                yield from func(*args, **kwargs)
+                return
+            rows = 0
+            elapsed = 0.0
+            frame = t.begin(name, describeArgs(args, kwargs))
+            t.suspend(frame)
+            try:
+                iterator = func(*args, **kwargs)
+                while True:
+                    # only count the time spent producing items, not the time the consumer holds them
+                    t.resume(frame)
+                    start = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                    finally:
+                        elapsed += time.perf_counter() - start
+                        t.suspend(frame)
+                    rows += 1
+                    yield item
+            finally:
+                t.end(frame, elapsed, rows=rows)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        t = currentTrace()
+        if t is None:
+            return func(*args, **kwargs)
+        hits = cache_info().hits if cache_info else None
+        frame = t.begin(name, describeArgs(args, kwargs))
+        start = time.perf_counter()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            cache = None
+            if cache_info:
+                cache = 'hit' if cache_info().hits > hits else 'miss'
+            t.end(frame, elapsed, cache=cache, rows=countRows(result))
+    return wrapper
+
+
+def instrumentModule(module_globals):
+    '''
+    Replaces every public function defined in the calling module with an instrumented
+    version.  Call it at the very end of the module:
+
+        instrumentModule(globals())
+    '''
+    module_name = module_globals['__name__']
+    for key, value in list(module_globals.items()):
+        if key.startswith('_') or not callable(value) or inspect.isclass(value):
+            continue
+        if getattr(value, '__module__', None) != module_name:
+            continue
+        module_globals[key] = instrumented(value)
+
+
+def _startEnvironmentTrace():
+    output_file = os.environ.get(TRACE_ENV)
+    if output_file and not tracing():
+        t = Trace(output_file)
+        _active_traces.append(t)
+        atexit.register(t.write)
+
+_startEnvironmentTrace()
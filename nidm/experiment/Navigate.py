@@ -1,8 +1,12 @@
 from nidm.core import Constants
 from nidm.experiment.Query import OpenGraph, URITail, trimWellKnownURIPrefix, getDataTypeInfo, ACQUISITION_MODALITY, \
-    IMAGE_CONTRAST_TYPE, IMAGE_USAGE_TYPE, TASK, expandUUID, matchPrefix
+    IMAGE_CONTRAST_TYPE, IMAGE_USAGE_TYPE, TASK, expandUUID, matchPrefix, getNamespaces
+from nidm.experiment.FileCache import perFile, corpusCache
+from nidm.experiment.SubjectIndex import getSubjectIndex
+from nidm.experiment.ValueColumn import typedValue
+from nidm.experiment.Instrumentation import instrumentModule
+from nidm.experiment.QueryBudget import checkBudget
 from rdflib import Graph, RDF, URIRef, util, term
-import functools
 import collections
 
 
@@ -11,11 +15,19 @@ isPartOf = Constants.DCT['isPartOf']
 ValueType = collections.namedtuple('ValueType',
                                    ['value', 'label', 'datumType', 'hasUnit', 'isAbout', 'measureOf', 'hasLaterality', 'dataElement', 'description', 'subject', 'project'])
 ActivityData = collections.namedtuple('ActivityData', ['category', 'uuid', 'data'])
+CursorPosition = collections.namedtuple('CursorPosition', ['project', 'session', 'acquisition', 'object'])
+STATS_COLLECTION_TYPES = [Constants.NIDM['FSStatsCollection'], Constants.NIDM['FSLStatsCollection'], Constants.NIDM['ANTSStatsCollection']]
+SubjectRow = collections.namedtuple('SubjectRow', ['uuid', 'subject_id', 'sessions', 'acquisitions', 'instruments', 'derivatives'])
+# variable is None for the row counting the instruments of a type, see getInstrumentCatalog
+CatalogRow = collections.namedtuple('CatalogRow', ['project', 'project_title', 'instrument', 'variable', 'count'])
+# rdf:types of assessment entities that aren't instrument types
+CATALOG_SKIPPED_TYPES = [Constants.PROV['Entity'], Constants.NIDM['AcquisitionObject']]
 QUERY_CACHE_SIZE=64
 BIG_CACHE_SIZE=256
 
 def makeValueType(value=None, label=None, datumType=None, hasUnit=None, isAbout=None, measureOf=None, hasLaterality=None, dataElement=None, description=None, subject=None, project=None):
-    return ValueType(str(value), str(label), str(datumType), str(hasUnit), str(isAbout), str(measureOf), str(hasLaterality), str(dataElement), str(description), str(subject), str(project))
+    # the value keeps its type (numbers stay numbers), use outputValue() when displaying it
+    return ValueType(typedValue(value), str(label), str(datumType), str(hasUnit), str(isAbout), str(measureOf), str(hasLaterality), str(dataElement), str(description), str(subject), str(project))
 
 def makeValueTypeFromDataTypeInfo(value, data_type_info_tuple):
 
@@ -27,11 +39,20 @@ def makeValueTypeFromDataTypeInfo(value, data_type_info_tuple):
             data_type_info_tuple[key] = None
 
 
-    return ValueType(str(value), str(data_type_info_tuple['label']), str(data_type_info_tuple['datumType']),
+    return ValueType(typedValue(value), str(data_type_info_tuple['label']), str(data_type_info_tuple['datumType']),
                      str(data_type_info_tuple['hasUnit']), str(data_type_info_tuple['isAbout']), str(data_type_info_tuple['measureOf']),
                      str(data_type_info_tuple['hasLaterality']), str(data_type_info_tuple['dataElement']),
                      str(data_type_info_tuple['description']), str(data_type_info_tuple['subject']), str(data_type_info_tuple['project']))
 
+def trimValue(o):
+    '''
+    Numeric literals are returned untouched so their datatype survives, anything else gets the well known
+    URI prefixes trimmed
+    '''
+    if not isinstance(typedValue(o), str):
+        return o
+    return trimWellKnownURIPrefix(o)
+
 def expandID(id, namespace):
     '''
     If the ID isn't a full URI already, make it one in the given namespace
@@ -49,7 +70,15 @@ def expandID(id, namespace):
     return id
 
 
-@functools.lru_cache(maxsize=BIG_CACHE_SIZE)
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
+def getNamespaceLookup(nidm_file_tuples):
+    names = {}
+    for (prefix, uri) in getNamespaces(nidm_file_tuples):
+        if not str(uri) in names:
+            names[str(uri)] = prefix
+    return names
+
+@corpusCache(maxsize=BIG_CACHE_SIZE)
 def simplifyURIWithPrefix(nidm_file_tuples, uri):
     '''
     Takes a URI and finds if there is a simple prefix for it in the graph
@@ -58,16 +87,6 @@ def simplifyURIWithPrefix(nidm_file_tuples, uri):
     :return: simple prefix or the original uri string
     '''
 
-    @functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
-    def getNamespaceLookup(nidm_file_tuples):
-        names = {}
-        for f in nidm_file_tuples:
-            rdf_graph = OpenGraph(f)
-            for (prefix, uri) in rdf_graph.namespace_manager.namespaces():
-                if not str(uri) in names:
-                    names[str(uri)] = prefix
-        return names
-
     names = getNamespaceLookup(tuple(nidm_file_tuples))
     # strip off the bit of URI after the last /
     trimed_uri = str(uri).split('/')[0:-1]
@@ -77,52 +96,207 @@ def simplifyURIWithPrefix(nidm_file_tuples, uri):
     else:
         return uri
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
-def getProjects(nidm_file_tuples):
-    projects = []
+def iterProjects(nidm_file_tuples):
+    '''
+    Lazily yields the URI of every project in the supplied files. Stop consuming the
+    generator to stop the traversal.
 
+    :param nidm_file_tuples: tuple of NIDM files
+    :return: generator of project URIs
+    '''
     for file in nidm_file_tuples:
         rdf_graph = OpenGraph(file)
-        #find all the sessions
         for (project, p, o) in rdf_graph.triples((None, isa, Constants.NIDM['Project'])):
-            projects.append(project)
+            yield project
 
-    return projects
+def iterSessions(nidm_file_tuples, project_id):
+    '''
+    Lazily yields the URI of every session that is part of the project
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
-def getSessions(nidm_file_tuples, project_id):
+    :param nidm_file_tuples: tuple of NIDM files
+    :param project_id: project UUID or URI
+    :return: generator of session URIs
+    '''
     project_uri = expandID(project_id, Constants.NIIRI)
-    sessions = []
 
     for file in nidm_file_tuples:
         rdf_graph = OpenGraph(file)
         #find all the sessions
         for (session, p, o) in rdf_graph.triples((None, isa, Constants.NIDM['Session'])):
             #check if it is part of our project
+            checkBudget()
             if (session, isPartOf, project_uri) in rdf_graph:
-                sessions.append(session)
+                yield session
 
-    return sessions
+def iterAcquisitions(nidm_file_tuples, session_id):
+    '''
+    Lazily yields the URI of every acquisition that is part of the session
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
-def getAcquisitions(nidm_file_tuples, session_id):
+    :param nidm_file_tuples: tuple of NIDM files
+    :param session_id: session UUID or URI
+    :return: generator of acquisition URIs
+    '''
     session_uri = expandID(session_id, Constants.NIIRI)
-    acquisitions = []
 
     for file in nidm_file_tuples:
         rdf_graph = OpenGraph(file)
-        #find all the sessions
         for (acq, p, o) in rdf_graph.triples((None, isPartOf, session_uri)):
+            checkBudget()
             #check if it is a acquisition
             if (acq, isa, Constants.NIDM['Acquisition']) in rdf_graph:
-                acquisitions.append(acq)
+                yield acq
+
+def iterAcquisitionObjects(nidm_file_tuples, acquisition_id):
+    '''
+    Lazily yields the URI of everything generated by the acquisition (acquisition objects,
+    stats collections, etc.)
+
+    :param nidm_file_tuples: tuple of NIDM files
+    :param acquisition_id: acquisition UUID or URI
+    :return: generator of object URIs
+    '''
+    acquisition_uri = expandID(acquisition_id, Constants.NIIRI)
+
+    for file in nidm_file_tuples:
+        rdf_graph = OpenGraph(file)
+        for (data_object, p, o) in rdf_graph.triples((None, Constants.PROV['wasGeneratedBy'], acquisition_uri)):
+            yield data_object
+
+def iterSubjects(nidm_file_tuples, project_id):
+    '''
+    Lazily yields each distinct subject (prov:agent with the sio:Subject role) of the project.
+    Only the subjects seen so far are remembered, so asking for the first few is cheap.
+
+    :param nidm_file_tuples: tuple of NIDM files
+    :param project_id: project UUID or URI
+    :return: generator of subject URIs
+    '''
+    seen = set([])
+    for s in iterSessions(nidm_file_tuples, project_id):
+        for acq in iterAcquisitions(nidm_file_tuples, s):
+            sub = getSubject(nidm_file_tuples, acq)
+            if sub is not None and not sub in seen:
+                seen.add(sub)
+                yield sub
+
+def iterActivities(nidm_file_tuples, subject_id):
+    '''
+    Lazily yields each distinct activity the subject is associated with
+
+    :param nidm_file_tuples: tuple of NIDM files
+    :param subject_id: subject UUID or URI
+    :return: generator of activity URIs
+    '''
+    seen = set([])
+    subject_uri = expandID(subject_id, Constants.NIIRI)
+
+    for file in nidm_file_tuples:
+        rdf_graph = OpenGraph(file)
+        for blank_node in rdf_graph.subjects( predicate=Constants.PROV['agent'], object=subject_uri):
+            checkBudget()
+            for activity in rdf_graph.subjects(predicate=Constants.PROV['qualifiedAssociation'], object=blank_node):
+                if (activity, isa, Constants.PROV['Activity']) in rdf_graph and not activity in seen:
+                    seen.add(activity)
+                    yield activity
 
-    return acquisitions
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+class NavigationCursor:
+    '''
+    Walks project -> session -> acquisition -> object without materializing any of the
+    intermediate collections. Iterating the cursor yields a CursorPosition for every object
+    found, so callers that only need the first match or a count can stop early.
+
+    Example:
+        cursor = NavigationCursor(files, project_id=project)
+        first_object = cursor.first()
+        number_of_sessions = cursor.count(level='session')
+    '''
+
+    LEVELS = ['project', 'session', 'acquisition', 'object']
+
+    def __init__(self, nidm_file_tuples, project_id=None):
+        self.nidm_file_tuples = tuple(nidm_file_tuples)
+        self.project_id = project_id
+
+    def projects(self):
+        if self.project_id:
+            yield expandID(self.project_id, Constants.NIIRI)
+        else:
+            yield from iterProjects(self.nidm_file_tuples)
+
+    def walk(self, level='object'):
+        '''
+        Depth first walk down to the requested level
+
+        :param level: one of 'project', 'session', 'acquisition' or 'object'
+        :return: generator of CursorPosition
+        '''
+        depth = self.LEVELS.index(level)
+        for project in self.projects():
+            if depth == 0:
+                yield CursorPosition(project, None, None, None)
+                continue
+            for session in iterSessions(self.nidm_file_tuples, project):
+                if depth == 1:
+                    yield CursorPosition(project, session, None, None)
+                    continue
+                for acq in iterAcquisitions(self.nidm_file_tuples, session):
+                    if depth == 2:
+                        yield CursorPosition(project, session, acq, None)
+                        continue
+                    for data_object in iterAcquisitionObjects(self.nidm_file_tuples, acq):
+                        yield CursorPosition(project, session, acq, data_object)
+
+    def __iter__(self):
+        return self.walk()
+
+    def first(self, match=None, level='object'):
+        '''
+        Returns the first CursorPosition (optionally the first one where match(position) is true)
+        or None. The walk stops as soon as a match is found.
+        '''
+        for position in self.walk(level):
+            if match is None or match(position):
+                return position
+        return None
+
+    def count(self, match=None, level='object'):
+        '''
+        Counts the positions at the given level without keeping any of them in memory
+        '''
+        return sum(1 for position in self.walk(level) if match is None or match(position))
+
+
+# The get* functions below are cached until one of the files changes (see FileCache).  The ones
+# that scan whole files combine per file partial results, so a changed file only rescans itself.
+
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
+def getProjects(nidm_file_tuples):
+    return [project for file in nidm_file_tuples for project in getFileProjects(file)]
+
+@perFile(maxsize=BIG_CACHE_SIZE)
+def getFileProjects(file):
+    return list(iterProjects((file,)))
+
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
+def getSessions(nidm_file_tuples, project_id):
+    return [session for file in nidm_file_tuples for session in getFileSessions(file, project_id)]
+
+@perFile(maxsize=BIG_CACHE_SIZE)
+def getFileSessions(file, project_id):
+    return list(iterSessions((file,), project_id))
+
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
+def getAcquisitions(nidm_file_tuples, session_id):
+    return [acq for file in nidm_file_tuples for acq in getFileAcquisitions(file, session_id)]
+
+@perFile(maxsize=BIG_CACHE_SIZE)
+def getFileAcquisitions(file, session_id):
+    return list(iterAcquisitions((file,), session_id))
+
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
 def getSubject(nidm_file_tuples, acquisition_id):
     acquisition_uri = expandID(acquisition_id, Constants.NIIRI)
-    subjects = []
 
     for file in nidm_file_tuples:
         rdf_graph = OpenGraph(file)
@@ -133,48 +307,165 @@ def getSubject(nidm_file_tuples, acquisition_id):
                     return sub
     return None
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
 def getSubjects(nidm_file_tuples, project_id):
-    subjects = set([])
-    project_uri = expandID(project_id, Constants.NIIRI)
+    return set(iterSubjects(nidm_file_tuples, project_id))
 
-    sessions = getSessions(nidm_file_tuples, project_uri)
-    for s in sessions:
-        acquisitions = getAcquisitions(nidm_file_tuples, s)
-        for acq in acquisitions:
-            sub = getSubject(nidm_file_tuples, acq)
-            subjects.add(sub)
-    return subjects
+def getProjectSubjectTable(nidm_file_tuples, project_id):
+    '''
+    The subject table of the project, see getProjectSubjectTableCached.  The project may be given
+    as UUID or URI, both share one cache entry.
+    '''
+    return getProjectSubjectTableCached(tuple(nidm_file_tuples), expandID(project_id, Constants.NIIRI))
+
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
+def getProjectSubjectTableCached(nidm_file_tuples, project_uri):
+    '''
+    One row per subject of the project, built in a single traversal of every file: the subject
+    role associations are visited once and each associated activity is sorted into the project's
+    acquisitions (with their sessions and instruments) or the derivatives that produced stats
+    collections.  Replaces walking sessions -> acquisitions -> getSubject and looking up each
+    subject's ID and data separately.  The rows are shared with the cache so don't modify them.
+
+    :param nidm_file_tuples: tuple of NIDM files
+    :param project_uri: project URI
+    :return: list of SubjectRow sorted by subject URI
+    '''
+    rows = {}
+    derivatives = collections.defaultdict(set)
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
-def getSubjectIDfromUUID(nidm_file_tuples, subject_uuid):
     for file in nidm_file_tuples:
-        rdf_graph = OpenGraph(file)
-        id_generator = rdf_graph.objects(subject=subject_uuid, predicate=Constants.NDAR['src_subject_id'])
-        for id in id_generator:
-            return id
-    return None
+        file_rows, file_derivatives = getFileSubjectTable(file, project_uri)
+        for sub, (sessions, acquisitions, instruments) in file_rows.items():
+            row = rows.setdefault(sub, {'sessions': set(), 'acquisitions': set(), 'instruments': set()})
+            row['sessions'].update(sessions)
+            row['acquisitions'].update(acquisitions)
+            row['instruments'].update(instruments)
+        for sub, stats in file_derivatives.items():
+            derivatives[sub].update(stats)
+
+    index = getSubjectIndex(nidm_file_tuples)
+    files = index.fileKeys(nidm_file_tuples)
+    table = []
+    for sub in sorted(rows, key=str):
+        row = rows[sub]
+        subject_id = index.subjectID(sub, files)
+        table.append(SubjectRow(uuid=sub, subject_id=None if subject_id is None else str(subject_id),
+                                sessions=tuple(sorted(row['sessions'], key=str)),
+                                acquisitions=len(row['acquisitions']),
+                                instruments=tuple(sorted(row['instruments'], key=str)),
+                                derivatives=tuple(sorted(derivatives[sub], key=str))))
+    return table
+
+@perFile(maxsize=QUERY_CACHE_SIZE, persist=True)
+def getFileSubjectTable(file, project_uri):
+    '''
+    The part of getProjectSubjectTableCached found in one file
+
+    :return: ({subject: (sessions, acquisitions, instruments)}, {subject: stats collections}) with frozensets
+    '''
+    rows = {}
+    derivatives = collections.defaultdict(set)
+
+    rdf_graph = OpenGraph(file)
+    sessions = set(session for (session, p, o) in rdf_graph.triples((None, isa, Constants.NIDM['Session']))
+                   if (session, isPartOf, project_uri) in rdf_graph)
+
+    for (blank, p, o) in rdf_graph.triples((None, Constants.PROV['hadRole'], Constants.SIO['Subject'])):
+        checkBudget()
+        subjects = list(rdf_graph.objects(subject=blank, predicate=Constants.PROV['agent']))
+        for activity in rdf_graph.subjects(predicate=Constants.PROV['qualifiedAssociation'], object=blank):
+            generated = list(rdf_graph.subjects(predicate=Constants.PROV['wasGeneratedBy'], object=activity))
+            stats = [g for g in generated if any((g, isa, t) in rdf_graph for t in STATS_COLLECTION_TYPES)]
+            for sub in subjects:
+                derivatives[sub].update(stats)
+
+            if (activity, isa, Constants.NIDM['Acquisition']) not in rdf_graph:
+                continue
+            activity_sessions = sessions.intersection(rdf_graph.objects(subject=activity, predicate=isPartOf))
+            if len(activity_sessions) == 0:
+                continue
+            instruments = [g for g in generated if (g, isa, Constants.NIDM['AcquisitionObject']) in rdf_graph]
+            for sub in subjects:
+                row = rows.setdefault(sub, (set(), set(), set()))
+                row[0].update(activity_sessions)
+                row[1].add(activity)
+                row[2].update(instruments)
+
+    return ({sub: tuple(frozenset(part) for part in row) for sub, row in rows.items()},
+            {sub: frozenset(stats) for sub, stats in derivatives.items()})
+
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
+def getInstrumentCatalog(nidm_file_tuples):
+    '''
+    Every instrument type and instrument variable used in every project with the number of
+    instruments (assessment entities) of the type, and of those the number that have a value for
+    the variable.  Each file's part is built once per file version, and kept on disk, by
+    getFileInstrumentCatalog so only new or changed files are read.
+
+    :param nidm_file_tuples: tuple of NIDM files
+    :return: list of CatalogRow sorted by project, instrument and variable, the instrument rows
+             (variable None) come before their variables
+    '''
+    counts = collections.Counter()
+    titles = {}
+    for file in nidm_file_tuples:
+        for row in getFileInstrumentCatalog(file):
+            counts[(row.project, row.instrument, row.variable)] += row.count
+            titles.setdefault(row.project, row.project_title)
+    return [CatalogRow(project, titles[project], instrument, variable, count)
+            for (project, instrument, variable), count in sorted(counts.items(), key=lambda item: (item[0][0], item[0][1], item[0][2] or ''))]
+
+@perFile(maxsize=QUERY_CACHE_SIZE, persist=True)
+def getFileInstrumentCatalog(file):
+    '''
+    The part of getInstrumentCatalog found in one file.  An instrument belongs to the titled
+    projects its activity's sessions are part of (entity -> wasGeneratedBy -> isPartOf -> isPartOf).
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+    :return: tuple of CatalogRow with str values
+    '''
+    rdf_graph = OpenGraph(file)
+    titles = {}
+    for (project, p, title) in rdf_graph.triples((None, Constants.DCTYPES['title'], None)):
+        titles.setdefault(project, str(title))
+
+    counts = collections.Counter()
+    for entity in rdf_graph.subjects(predicate=isa, object=Constants.ONLI['assessment-instrument']):
+        checkBudget()
+        projects = set(project for activity in rdf_graph.objects(subject=entity, predicate=Constants.PROV['wasGeneratedBy'])
+                       for session in rdf_graph.objects(subject=activity, predicate=isPartOf)
+                       for project in rdf_graph.objects(subject=session, predicate=isPartOf)
+                       if project in titles)
+        if len(projects) == 0:
+            continue
+        types = set(rdf_graph.objects(subject=entity, predicate=isa)).difference(CATALOG_SKIPPED_TYPES)
+        variables = set(rdf_graph.predicates(subject=entity))
+        for project in projects:
+            for instrument_type in types:
+                counts[(project, instrument_type, None)] += 1
+                for variable in variables:
+                    counts[(project, instrument_type, variable)] += 1
+
+    return tuple(CatalogRow(str(project), titles[project], str(instrument_type), None if variable is None else str(variable), count)
+                 for (project, instrument_type, variable), count in counts.items())
+
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
+def getSubjectIDfromUUID(nidm_file_tuples, subject_uuid):
+    return getSubjectIndex(nidm_file_tuples).subjectID(expandID(subject_uuid, Constants.NIIRI), nidm_file_tuples)
+
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
 def getActivities(nidm_file_tuples, subject_id):
-    activities = set([])
-    subject_uri = expandID(subject_id, Constants.NIIRI)
+    return set(activity for file in nidm_file_tuples for activity in getFileActivities(file, subject_id))
 
-    for file in nidm_file_tuples:
-        rdf_graph = OpenGraph(file)
-        for blank_node in rdf_graph.subjects( predicate=Constants.PROV['agent'], object=subject_uri):
-            for activity in rdf_graph.subjects(predicate=Constants.PROV['qualifiedAssociation'], object=blank_node):
-                if (activity, isa, Constants.PROV['Activity']) in rdf_graph:
-                    activities.add(activity)
-    return activities
+@perFile(maxsize=BIG_CACHE_SIZE)
+def getFileActivities(file, subject_id):
+    return frozenset(iterActivities((file,), subject_id))
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
 def isAStatCollection(nidm_file_tuples, uri):
     for file in nidm_file_tuples:
         rdf_graph = OpenGraph(file)
-        if ((uri, isa, Constants.NIDM['FSStatsCollection']) in rdf_graph ) or \
-            ((uri, isa, Constants.NIDM['FSLStatsCollection']) in rdf_graph) or \
-            ((uri, isa, Constants.NIDM['ANTSStatsCollection']) in rdf_graph) :
+        if any((uri, isa, stats_type) in rdf_graph for stats_type in STATS_COLLECTION_TYPES):
             return True
     return False
 
@@ -192,7 +483,7 @@ def isAStatCollection(nidm_file_tuples, uri):
 #
 #     return False
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
 def getActivityData(nidm_file_tuples, acquisition_id):
     acquisition_uri = expandID(acquisition_id, Constants.NIIRI)
     result = []
@@ -202,6 +493,7 @@ def getActivityData(nidm_file_tuples, acquisition_id):
         rdf_graph = OpenGraph(file)
         # find everything generated by the acquisition
         for (data_object, p1, o1) in rdf_graph.triples((None, Constants.PROV['wasGeneratedBy'], acquisition_uri)):
+            checkBudget()
             # make sure this is an acquisition object
             if (data_object, isa, Constants.NIDM['AcquisitionObject']) in rdf_graph:
                 category = 'instrument'
@@ -211,15 +503,15 @@ def getActivityData(nidm_file_tuples, acquisition_id):
                     dti = getDataTypeInfo(rdf_graph, p)
                     if (dti):
                         # there is a DataElement describing this predicate
-                        value_type = makeValueTypeFromDataTypeInfo(value=trimWellKnownURIPrefix(o), data_type_info_tuple=dti)
+                        value_type = makeValueTypeFromDataTypeInfo(value=trimValue(o), data_type_info_tuple=dti)
                         result.append( value_type )
                     else:
                         #Don't know exactly what this is so just set a label and be done.
                         if (data_object, isa, Constants.ONLI['assessment-instrument']) in rdf_graph:
-                            result.append(makeValueType(value=trimWellKnownURIPrefix(o), label=simplifyURIWithPrefix(nidm_file_tuples, str(p))))
+                            result.append(makeValueType(value=trimValue(o), label=simplifyURIWithPrefix(nidm_file_tuples, str(p))))
                             #result[ simplifyURIWithPrefix(nidm_file_list, str(p)) ] = trimWellKnownURIPrefix(o)
                         else:
-                            result.append(makeValueType(value=trimWellKnownURIPrefix(o), label=URITail(str(p))))
+                            result.append(makeValueType(value=trimValue(o), label=URITail(str(p))))
                             # result[ URITail(str(p))] = trimWellKnownURIPrefix(o)
 
             # or maybe it's a stats collection
@@ -228,13 +520,13 @@ def getActivityData(nidm_file_tuples, acquisition_id):
                 for (s, p, o) in rdf_graph.triples((data_object, None, None)):
                         cde = getDataTypeInfo(rdf_graph,p )
                         result.append(
-                            makeValueTypeFromDataTypeInfo(value=str(o), data_type_info_tuple=cde)
+                            makeValueTypeFromDataTypeInfo(value=o, data_type_info_tuple=cde)
                         )
                         # result[ URITail(str(p)) ] = str(o)
 
     return ActivityData(category=category, uuid=trimWellKnownURIPrefix(acquisition_uri),  data=result)
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
 def GetProjectAttributes(nidm_files_tuple, project_id):
     result = {
         ACQUISITION_MODALITY: set([]),
@@ -278,4 +570,6 @@ def GetProjectAttributes(nidm_files_tuple, project_id):
     result[IMAGE_USAGE_TYPE] = list(result[IMAGE_USAGE_TYPE])
     result[TASK] = list(result[TASK])
 
-    return result
\ No newline at end of file
+    return result
+
+instrumentModule(globals())
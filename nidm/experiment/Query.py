@@ -43,8 +43,10 @@ from urllib.request import urlretrieve
 
 import pickle
 
-from joblib import Memory
-memory = Memory(tempfile.gettempdir(), verbose=0 )
+from nidm.experiment.Instrumentation import stage, note, tracing, instrumentModule
+from nidm.experiment.QueryBudget import checkBudget
+from nidm.experiment.FileCache import hashFile, perFile, corpusCache
+from nidm.experiment.ValueColumn import typedValue, outputValue, compareValues
 
 
 QUERY_CACHE_SIZE=64
@@ -84,7 +86,13 @@ def sparql_query_nidm(nidm_file_list,query, output_file=None, return_graph=False
 
         if not return_graph:
             #execute query
-            qres = rdf_graph_parse.query(query)
+            with stage('sparql', file=nidm_file):
+                qres = rdf_graph_parse.query(query)
+                # the solutions are produced lazily, so a budget can stop a long running query
+                rows = []
+                for row in qres:
+                    checkBudget()
+                    rows.append(row)
 
             #if this is the first file then grab the SPARQL bound variable names from query result for column headings of query result
             if first_file:
@@ -95,7 +103,7 @@ def sparql_query_nidm(nidm_file_list,query, output_file=None, return_graph=False
                 #    break
 
             #append result as row to result list
-            for row in qres:
+            for row in rows:
                 results.append(list(row))
         else:
             #execute query
@@ -421,9 +429,38 @@ def GetNameForDataElement(graph, uri):
 
 
 def GetParticipantInstrumentData(nidm_file_list ,project_id, participant_id):
+    '''
+    Instrument data for a participant with every value converted to a string, see GetParticipantInstrumentDataTyped
+    '''
+    data = GetParticipantInstrumentDataCached(tuple(nidm_file_list) ,project_id, participant_id)
+    return {instrument: {key: outputValue(value) for key, value in data[instrument].items()} for instrument in data}
+
+def GetParticipantInstrumentDataTyped(nidm_file_list ,project_id, participant_id):
+    '''
+    Instrument data for a participant with numeric values kept as int / float.  The result is
+    shared with the cache so don't modify it.
+    '''
     return GetParticipantInstrumentDataCached(tuple(nidm_file_list) ,project_id, participant_id)
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def getNamespaces(nidm_file_list):
+    '''
+    The (prefix, namespace URI) pairs of all the files, the first file to use a pair wins
+
+    :param nidm_file_list: tuple of NIDM files
+    :return: tuple of (prefix, URIRef)
+    '''
+    names = []
+    for f in nidm_file_list:
+        for n in getFileNamespaces(f):
+            if not n in names:
+                names.append(n)
+    return tuple(names)
+
+@perFile(maxsize=BIG_CACHE_SIZE)
+def getFileNamespaces(file):
+    return tuple(OpenGraph(file).namespace_manager.namespaces())
+
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
 def GetParticipantInstrumentDataCached(nidm_file_list: tuple ,project_id, participant_id):
     '''
     This query will return a list of all instrument data for prov:agent entity UUIDs that has
@@ -436,44 +473,106 @@ def GetParticipantInstrumentDataCached(nidm_file_list: tuple ,project_id, partic
         participant_id = Constants.NIIRI[participant_id]
 
     result = {}
-    names = []
+    names = getNamespaces(nidm_file_list)
     for f in nidm_file_list:
-        rdf_graph = OpenGraph(f)
-        for n in rdf_graph.namespace_manager.namespaces():
-            if not n in names:
-                names.append(n)
+        result.update(GetParticipantInstrumentDataForFile(f, participant_id, names))
+    return result
+
+@perFile(maxsize=BIG_CACHE_SIZE)
+def GetParticipantInstrumentDataForFile(file, participant_id, names):
+    '''
+    The part of GetParticipantInstrumentDataCached found in one file
 
+    :param file: NIDM file
+    :param participant_id: participant URI
+    :param names: namespaces of all the files being queried, see getNamespaces
+    '''
+    result = {}
     isa = URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#type')
+    rdf_graph = OpenGraph(file)
+    # find all the instrument based assessments
+    for acquisition in rdf_graph.subjects(isa, Constants.NIDM['Acquisition']):
+        checkBudget()
+        # verify that the assessment is linked to a subject through a blank node
+        for blanknode in rdf_graph.objects(subject=acquisition,predicate=Constants.PROV['qualifiedAssociation']):
+            # check to see if this assessment is about our participant
+            if ((blanknode, Constants.PROV['agent'], participant_id) in rdf_graph)  :
+                # now we know that the assessment is one we want, find the actual assessment data
+                for instrument in rdf_graph.subjects(predicate=Constants.PROV['wasGeneratedBy'], object=acquisition):
+                    #load up all the assement data into the result
+                    instrument_key = str(instrument).split('/')[-1]
+                    result[instrument_key] = {}
+                    for s,data_element,o in rdf_graph.triples((instrument, None, None)):
+                        # convert the random looking URIs to the prefix used in the ttl file, if any
+                        matches = [n[0] for n in names if n[1] == data_element]
+                        if len(matches) > 0:
+                            idx = str(matches[0])
+                        else:
+                            # idx = str(data_element)
+                            idx = GetNameForDataElement(rdf_graph, data_element)
+                        result[instrument_key][ idx ] = typedValue(o)
+
+    return result
+
+def GetProjectInstrumentDataTyped(nidm_file_list, project_id):
+    '''
+    Instrument data for every participant in one pass over the acquisitions, see
+    GetProjectInstrumentDataCached.  The result is shared with the cache so don't modify it.
+    '''
+    return GetProjectInstrumentDataCached(tuple(nidm_file_list), project_id)
+
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
+def GetProjectInstrumentDataCached(nidm_file_list: tuple, project_id):
+    '''
+    Same as GetParticipantInstrumentDataCached but for all participants at once, the acquisitions
+    are walked a single time instead of once per participant.  Each file's part is cached (and
+    pickled) separately, see GetProjectInstrumentDataForFile.
+
+    :param nidm_file_list: tuple of NIDM files
+    :param project_id: project UUID (not used to narrow the search, same as the per participant query)
+    :return: {participant UUID: {instrument UUID: {data element: typed value}}}
+    '''
+    result = {}
+    names = getNamespaces(nidm_file_list)
     for f in nidm_file_list:
-        rdf_graph = OpenGraph(f)
-        # find all the instrument based assessments
-        for acquisition in rdf_graph.subjects(isa, Constants.NIDM['Acquisition']):
-            # verify that the assessment is linked to a subject through a blank node
-            for blanknode in rdf_graph.objects(subject=acquisition,predicate=Constants.PROV['qualifiedAssociation']):
-                # check to see if this assessment is about our participant
-                if ((blanknode, Constants.PROV['agent'], participant_id) in rdf_graph)  :
-                    # now we know that the assessment is one we want, find the actual assessment data
-                    for instrument in rdf_graph.subjects(predicate=Constants.PROV['wasGeneratedBy'], object=acquisition):
-                        #load up all the assement data into the result
-                        instrument_key = str(instrument).split('/')[-1]
-                        result[instrument_key] = {}
-                        for s,data_element,o in rdf_graph.triples((instrument, None, None)):
-                            # convert the random looking URIs to the prefix used in the ttl file, if any
-                            matches = [n[0] for n in names if n[1] == data_element]
-                            if len(matches) > 0:
-                                idx = str(matches[0])
-                            else:
-                                # idx = str(data_element)
-                                idx = GetNameForDataElement(rdf_graph, data_element)
-                            result[instrument_key][ idx ] = str(str(o))
+        for participant_key, instruments in GetProjectInstrumentDataForFile(f, names).items():
+            for instrument_key, data in instruments.items():
+                # copied, the partials are shared with the cache
+                result.setdefault(participant_key, {}).setdefault(instrument_key, {}).update(data)
+    return result
 
+@perFile(maxsize=QUERY_CACHE_SIZE, persist=True)
+def GetProjectInstrumentDataForFile(file, names):
+    '''
+    The part of GetProjectInstrumentDataCached found in one file
+
+    :param file: NIDM file
+    :param names: namespaces of all the files being queried, see getNamespaces
+    '''
+    result = {}
+    isa = URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#type')
+    rdf_graph = OpenGraph(file)
+    element_names = {}
+    for acquisition in rdf_graph.subjects(isa, Constants.NIDM['Acquisition']):
+        checkBudget()
+        for blanknode in rdf_graph.objects(subject=acquisition, predicate=Constants.PROV['qualifiedAssociation']):
+            for participant in rdf_graph.objects(subject=blanknode, predicate=Constants.PROV['agent']):
+                participant_key = str(participant).split('/')[-1]
+                for instrument in rdf_graph.subjects(predicate=Constants.PROV['wasGeneratedBy'], object=acquisition):
+                    instrument_key = str(instrument).split('/')[-1]
+                    data = result.setdefault(participant_key, {}).setdefault(instrument_key, {})
+                    for s, data_element, o in rdf_graph.triples((instrument, None, None)):
+                        if data_element not in element_names:
+                            matches = [n[0] for n in names if n[1] == data_element]
+                            element_names[data_element] = str(matches[0]) if len(matches) > 0 else GetNameForDataElement(rdf_graph, data_element)
+                        data[element_names[data_element]] = typedValue(o)
 
     return result
 
 def GetParticipantUUIDsForProject(nidm_file_list: tuple, project_id, filter, output_file=None):
     return GetParticipantUUIDsForProjectCached(tuple(nidm_file_list), project_id, filter, output_file=None)
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
 def GetParticipantUUIDsForProjectCached(nidm_file_list:tuple, project_id, filter, output_file=None):
     '''
     This query will return a list of all prov:agent entity UUIDs within a single project
@@ -497,34 +596,50 @@ def GetParticipantUUIDsForProjectCached(nidm_file_list:tuple, project_id, filter
 
 
     for file in nidm_file_list:
-        rdf_graph = OpenGraph(file)
-        #find all the sessions
-        for (session, p, o) in rdf_graph.triples((None, None, Constants.NIDM['Session'])): #rdf_graph.subjects(object=isa, predicate=Constants.NIDM['Session']):
-            #check if it is part of our project
-            if (session, Constants.DCT['isPartOf'], project) in rdf_graph:
-                #find all the activities/acquisitions/etc that are part of this session
-                for activity in rdf_graph.subjects(predicate=Constants.DCT['isPartOf'], object=session):
-                    # look to see if the activity is linked to a subject via blank node
-                    for blank in rdf_graph.objects(subject=activity, predicate=Constants.PROV['qualifiedAssociation']):
-                        if (blank, Constants.PROV['hadRole'], Constants.SIO['Subject']):
-                            for participant in rdf_graph.objects(subject=blank, predicate=Constants.PROV['agent']):
-                                uuid = (str(participant)).split('/')[-1]  # srip off the http://whatever/whatever/
-                                if (not uuid in participants) and \
-                                        ( (not filter) or CheckSubjectMatchesFilter( tuple([file]) , project, participant, filter) ):
-                                    ### added by DBK for subject IDs as well ###
-                                    for id in rdf_graph.objects(subject=participant,predicate=URIRef(Constants.NIDM_SUBJECTID.uri)):
-                                        subid = (str(id)).split('/')[-1]  # srip off the http://whatever/whatever/
-
-                                    ### added by DBK for subject IDs as well ###
+        file_participants = GetParticipantUUIDsForProjectInFile(file, project, filter)
+        participants['uuid'].extend(file_participants['uuid'])
+        participants['subject id'].extend(file_participants['subject id'])
+
+    return participants
+
+@perFile(maxsize=QUERY_CACHE_SIZE)
+def GetParticipantUUIDsForProjectInFile(file, project, filter):
+    '''
+    The part of GetParticipantUUIDsForProjectCached found in one file
+    '''
+    participants = {}
+    participants["uuid"] = []
+    participants["subject id"] = []
+
+    rdf_graph = OpenGraph(file)
+    #find all the sessions
+    for (session, p, o) in rdf_graph.triples((None, None, Constants.NIDM['Session'])): #rdf_graph.subjects(object=isa, predicate=Constants.NIDM['Session']):
+        #check if it is part of our project
+        if (session, Constants.DCT['isPartOf'], project) in rdf_graph:
+            #find all the activities/acquisitions/etc that are part of this session
+            for activity in rdf_graph.subjects(predicate=Constants.DCT['isPartOf'], object=session):
+                checkBudget()
+                # look to see if the activity is linked to a subject via blank node
+                for blank in rdf_graph.objects(subject=activity, predicate=Constants.PROV['qualifiedAssociation']):
+                    if (blank, Constants.PROV['hadRole'], Constants.SIO['Subject']):
+                        for participant in rdf_graph.objects(subject=blank, predicate=Constants.PROV['agent']):
+                            uuid = (str(participant)).split('/')[-1]  # srip off the http://whatever/whatever/
+                            if (not uuid in participants) and \
+                                    ( (not filter) or CheckSubjectMatchesFilter( tuple([file]) , project, participant, filter) ):
+                                ### added by DBK for subject IDs as well ###
+                                for id in rdf_graph.objects(subject=participant,predicate=URIRef(Constants.NIDM_SUBJECTID.uri)):
+                                    subid = (str(id)).split('/')[-1]  # srip off the http://whatever/whatever/
+
+                                ### added by DBK for subject IDs as well ###
+                                #participants.append(uuid)
+                                try:
+                                    participants['uuid'].append(uuid)
+                                    participants['subject id'].append(subid)
+                                # just in case there's no subject id in the file...
+                                except:
                                     #participants.append(uuid)
-                                    try:
-                                        participants['uuid'].append(uuid)
-                                        participants['subject id'].append(subid)
-                                    # just in case there's no subject id in the file...
-                                    except:
-                                        #participants.append(uuid)
-                                        participants['uuid'].append(uuid)
-                                        participants['subject id'].append('')
+                                    participants['uuid'].append(uuid)
+                                    participants['subject id'].append('')
 
     return participants
 
@@ -561,7 +676,7 @@ def getProjectAcquisitionObjects(nidm_file_list, project_id):
                                 acq_objects.append(acq_obj)
     return acq_objects
 
-@functools.lru_cache(maxsize=LARGEST_CACHE_SIZE)
+@corpusCache(maxsize=LARGEST_CACHE_SIZE)
 def GetDatatypeSynonyms(nidm_file_list, project_id, datatype):
     '''
     Try to match a datatype string with any of the known info about a data element
@@ -704,7 +819,7 @@ def CheckSubjectMatchesFilter(nidm_file_list, project_uuid, subject_uuid, filter
         if len(sub_pieces) == 2 and sub_pieces[0] == 'instruments':
             term = sub_pieces[1] # 'AGE_AT_SCAN' for example
             synonyms = GetDatatypeSynonyms(tuple(nidm_file_list), project_uuid, term)
-            instrument_details = GetParticipantInstrumentData(nidm_file_list, project_uuid, subject_uuid)
+            instrument_details = GetParticipantInstrumentDataTyped(nidm_file_list, project_uuid, subject_uuid)
             for instrument_uuid in instrument_details:
                 for instrument_term in instrument_details[instrument_uuid]:
                     if instrument_term in synonyms:
@@ -714,7 +829,7 @@ def CheckSubjectMatchesFilter(nidm_file_list, project_uuid, subject_uuid, filter
 
         elif len(sub_pieces) == 2 and sub_pieces[0] == 'derivatives':
             type = sub_pieces[1] # 'ilx:0102597' for example
-            derivatives_details = GetDerivativesDataForSubject(nidm_file_list, project_uuid, subject_uuid)
+            derivatives_details = GetDerivativesDataForSubjectTyped(nidm_file_list, project_uuid, subject_uuid)
             for key in derivatives_details:
                 derivatives = derivatives_details[key]['values']
                 for vkey in derivatives:  # values will be in the form { http://example.com/a/b/c#fs_00001 : { datumType: '', label: '', value: '', units:'' }, ... }
@@ -734,17 +849,7 @@ def CheckSubjectMatchesFilter(nidm_file_list, project_uuid, subject_uuid, filter
     return True
 
 def filterCompare(left, op, right):
-    try:
-        if op == 'eq':
-            return (left == right)
-        elif op == 'lt':
-            return (float(left) < float(right))
-        elif op == 'gt':
-            return (float(left) > float(right))
-    except:
-        pass
-
-    return None
+    return compareValues(left, op, right)
 
 def GetProjectsMetadata(nidm_file_list):
     '''
@@ -1135,17 +1240,26 @@ def getStatsCollectionForNode (rdf_graph, derivatives_node):
         else:
             dti = getDataTypeInfo(rdf_graph, datatype )
             if dti:  # if we can't find a datatype then this is non-data info so don't record it
-                data['values'][str(datatype)] = {'datumType': str(dti['datumType']), 'label': str(dti['label']), 'value': str(value), 'units': str(dti['hasUnit'])}
+                data['values'][str(datatype)] = {'datumType': str(dti['datumType']), 'label': str(dti['label']), 'value': typedValue(value), 'units': str(dti['hasUnit'])}
 
     return data
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@perFile(maxsize=QUERY_CACHE_SIZE)
 def OpenGraph(file):
     '''
     Returns a parsed RDFLib Graph object for the given file
     The file will be hashed and if a pickled copy is found in the TMP dir, that will be used
     Otherwise the graph will be computed and then saved in the TMP dir as a pickle file
-    We also use functools.lru_cache to cache results in memory during a run
+    We also cache the graph in memory during a run, until the file changes on disk
+
+    :param file: filename
+    :return: Graph
+    '''
+    return loadGraph(file)
+
+def loadGraph(file):
+    '''
+    OpenGraph without the in memory cache, always goes to the hash keyed pickle (or parses the file)
 
     :param file: filename
     :return: Graph
@@ -1154,32 +1268,46 @@ def OpenGraph(file):
     if isinstance(file, rdflib.graph.Graph):
         return file
 
-    BLOCKSIZE = 65536
-    hasher = hashlib.md5()
-    with open(file, 'rb') as afile:
-        buf = afile.read(BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(BLOCKSIZE)
-    hash = hasher.hexdigest()
+    with stage('hash', file=file):
+        hash = hashFile(file)
 
     pickle_file = '{}/rdf_graph.{}.pickle'.format( tempfile.gettempdir(), hash)
     if path.isfile(pickle_file):
-        return pickle.load(open(pickle_file, "rb"))
+        with stage('unpickle', file=file):
+            rdf_graph = pickle.load(open(pickle_file, "rb"))
+        if tracing():
+            note(file=file, source='pickle', triples=len(rdf_graph))
+        return rdf_graph
 
     rdf_graph = Graph()
-    rdf_graph.parse(file, format=util.guess_format(file))
-    pickle.dump(rdf_graph, open(pickle_file, 'wb'))
-
-    # new graph, so to be safe clear out all cached entries
-    memory.clear(warn=False)
+    with stage('parse', file=file):
+        rdf_graph.parse(file, format=util.guess_format(file))
+    with stage('pickle', file=file):
+        pickle.dump(rdf_graph, open(pickle_file, 'wb'))
+    if tracing():
+        note(file=file, source='parse', triples=len(rdf_graph))
 
     return rdf_graph
 
 def GetDerivativesDataForSubject(files, project, subject):
+    '''
+    Derivatives data for a subject with every value converted to a string, see GetDerivativesDataForSubjectTyped
+    '''
+    data = GetDerivativesDataForSubjectCache (tuple(files), project, subject)
+    result = {}
+    for key, collection in data.items():
+        result[key] = dict(collection)
+        result[key]['values'] = {uri: dict(measure, value=outputValue(measure['value'])) for uri, measure in collection['values'].items()}
+    return result
+
+def GetDerivativesDataForSubjectTyped(files, project, subject):
+    '''
+    Derivatives data for a subject with numeric values kept as int / float.  The result is
+    shared with the cache so don't modify it.
+    '''
     return GetDerivativesDataForSubjectCache (tuple(files), project, subject)
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
 def GetDerivativesDataForSubjectCache(files, project, subject):
     '''
     Searches for the subject in the supplied RDF .ttl files and returns
@@ -1199,13 +1327,63 @@ def GetDerivativesDataForSubjectCache(files, project, subject):
     data = {}
 
     for nidm_file in files:
-        rdf_graph = OpenGraph(nidm_file)
-        for node in getDerivativesNodesForSubject(rdf_graph, subject):
+        data.update(GetDerivativesDataForSubjectInFile(nidm_file, subject))
+
+    return data
+
+@perFile(maxsize=QUERY_CACHE_SIZE)
+def GetDerivativesDataForSubjectInFile(file, subject):
+    '''
+    The part of GetDerivativesDataForSubjectCache found in one file
+    '''
+    data = {}
+    rdf_graph = OpenGraph(file)
+    for node in getDerivativesNodesForSubject(rdf_graph, subject):
+        checkBudget()
+        collection = getStatsCollectionForNode(rdf_graph, node)
+        key = str(collection['URI']).split('/')[-1]
+        data[key] = collection
+
+    return data
+
+def GetProjectDerivativesDataTyped(nidm_file_list, project_id):
+    '''
+    Derivatives data for every participant in one pass over the graphs, see
+    GetProjectDerivativesDataCached.  The result is shared with the cache so don't modify it.
+    '''
+    return GetProjectDerivativesDataCached(tuple(nidm_file_list), project_id)
+
+@corpusCache(maxsize=QUERY_CACHE_SIZE)
+def GetProjectDerivativesDataCached(nidm_file_list: tuple, project_id):
+    '''
+    Same as GetDerivativesDataForSubjectCache but for all participants at once.  Each file's part
+    is cached (and pickled) separately, see GetProjectDerivativesDataForFile.
+
+    :param nidm_file_list: tuple of NIDM files
+    :param project_id: project UUID (not used to narrow the search, same as the per participant query)
+    :return: {participant UUID: {stat collection UUID: stat collection}}
+    '''
+    result = {}
+    for f in nidm_file_list:
+        for participant_key, collections in GetProjectDerivativesDataForFile(f).items():
+            result.setdefault(participant_key, {}).update(collections)
+    return result
+
+@perFile(maxsize=QUERY_CACHE_SIZE, persist=True)
+def GetProjectDerivativesDataForFile(file):
+    '''
+    The part of GetProjectDerivativesDataCached found in one file
+    '''
+    result = {}
+    rdf_graph = OpenGraph(file)
+    for participant in set(rdf_graph.objects(predicate=Constants.PROV['agent'])):
+        checkBudget()
+        for node in getDerivativesNodesForSubject(rdf_graph, participant):
             collection = getStatsCollectionForNode(rdf_graph, node)
             key = str(collection['URI']).split('/')[-1]
-            data[key] = collection
+            result.setdefault(str(participant).split('/')[-1], {})[key] = collection
 
-    return data
+    return result
 
 def getSoftwareAgents(rdf_graph):
     '''
@@ -1228,11 +1406,49 @@ def download_cde_files():
     cde_dir = tempfile.gettempdir()
 
     for url in Constants.CDE_FILE_LOCATIONS:
-        urlretrieve( url, "{}/{}".format(cde_dir, url.split('/')[-1] ) )
+        file_name = "{}/{}".format(cde_dir, url.split('/')[-1])
+        # only the missing files, a new copy would also invalidate everything cached for the old one
+        if not os.path.isfile(file_name):
+            urlretrieve( url, file_name + ".part" )
+            os.replace(file_name + ".part", file_name)
 
     return cde_dir
 
 
+def getCDEFileList(file_list=None):
+    '''
+    The CDE files getCDEs reads: the supplied files or the ANTS, FreeSurfer and FSL CDE files in
+    $CDE_DIR (downloaded to the temp directory if there is no CDE_DIR).  The default list is worked out
+    once per CDE_DIR setting.
+    '''
+    if file_list:
+        return file_list
+
+    cde_dir = ''
+    if "CDE_DIR" in os.environ:
+        cde_dir = os.environ['CDE_DIR']
+
+    if cde_dir in getCDEFileList.cache:
+        return list(getCDEFileList.cache[cde_dir])
+    env_cde_dir = cde_dir
+
+    if (not cde_dir) and (os.path.isfile( '/opt/project/nidm/core/cde_dir/ants_cde.ttl' )):
+        cde_dir = '/opt/project/nidm/core/cde_dir'
+
+    if (not cde_dir):
+        cde_dir = download_cde_files()
+
+    file_list = [ ]
+    for f in ['ants_cde.ttl', 'fs_cde.ttl', 'fsl_cde.ttl']:
+        fname = '{}/{}'.format(cde_dir, f)
+        if os.path.isfile( fname ):
+            file_list.append( fname )
+    getCDEFileList.cache[env_cde_dir] = tuple(file_list)
+    return file_list
+
+getCDEFileList.cache = {}
+
+
 def getCDEs(file_list=None):
 
     if getCDEs.cache:
@@ -1251,25 +1467,7 @@ def getCDEs(file_list=None):
 
     rdf_graph = Graph()
 
-    if not file_list:
-
-        cde_dir = ''
-        if "CDE_DIR" in os.environ:
-            cde_dir = os.environ['CDE_DIR']
-
-        if (not cde_dir) and (os.path.isfile( '/opt/project/nidm/core/cde_dir/ants_cde.ttl' )):
-            cde_dir = '/opt/project/nidm/core/cde_dir'
-
-        if (not cde_dir):
-            cde_dir = download_cde_files()
-
-        file_list = [ ]
-        for f in ['ants_cde.ttl', 'fs_cde.ttl', 'fsl_cde.ttl']:
-            fname = '{}/{}'.format(cde_dir, f)
-            if os.path.isfile( fname ):
-                file_list.append( fname )
-
-
+    file_list = getCDEFileList(file_list)
 
     for fname in file_list:
         if os.path.isfile(fname):
@@ -1285,4 +1483,6 @@ def getCDEs(file_list=None):
 
     getCDEs.cache = rdf_graph
     return rdf_graph
-getCDEs.cache = None
\ No newline at end of file
+getCDEs.cache = None
+
+instrumentModule(globals())
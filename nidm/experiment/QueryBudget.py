@@ -0,0 +1,112 @@
+'''
+Time and work budgets for queries.
+
+A Budget holds a deadline, the maximum number of result rows and subjects a query may produce and
+an optional cancelled() callback (e.g. "has the client disconnected").  While a budget is active:
+
+    with enforce(Budget(timeout=10, max_rows=1000)):
+        restParser.route()
+
+the traversal loops of the Query and Navigate modules call checkBudget(), which raises
+BudgetExceeded once the deadline has passed or the query was cancelled.  Row and subject limits
+are counted by whoever produces the rows (see RestParser).  When no budget is active checkBudget()
+only costs one attribute lookup.  Budgets are per thread, a budget entered in one thread doesn't
+limit queries running in another.
+
+Results of cached query functions are never cut short: the exception leaves the function before
+FileCache stores (or pickles) anything.
+'''
+import time
+import threading
+import contextlib
+
+# how often (seconds) the cancelled() callback is asked, it may need a system call
+CANCEL_CHECK_INTERVAL = 0.25
+
+# the stack of budgets entered by each thread
+_active_budgets = threading.local()
+
+
+class BudgetExceeded(Exception):
+    '''
+    reason is one of 'deadline', 'rows', 'subjects' or 'cancelled'
+    '''
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class Budget:
+
+    def __init__(self, timeout=None, max_rows=None, max_subjects=None, cancelled=None):
+        '''
+        :param timeout: seconds the query may run, None for no limit
+        :param max_rows: number of result rows after which the query stops
+        :param max_subjects: number of subjects the query may visit
+        :param cancelled: callable returning True when the result is no longer wanted
+        '''
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.max_subjects = max_subjects
+        self.cancelled = cancelled
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.next_cancel_check = 0.0
+        self.rows = 0
+        self.subjects = 0
+
+    def check(self):
+        if self.deadline is None and self.cancelled is None:
+            return
+        now = time.monotonic()
+        if self.deadline is not None and now > self.deadline:
+            raise BudgetExceeded('deadline', "Query took longer than {:g} seconds".format(self.timeout))
+        if self.cancelled is not None and now >= self.next_cancel_check:
+            self.next_cancel_check = now + CANCEL_CHECK_INTERVAL
+            if self.cancelled():
+                raise BudgetExceeded('cancelled', "Query was cancelled")
+
+    def countRow(self):
+        self.rows += 1
+        if self.max_rows is not None and self.rows > self.max_rows:
+            raise BudgetExceeded('rows', "Query produced more than {} rows".format(self.max_rows))
+        self.check()
+
+    def countSubject(self):
+        self.subjects += 1
+        if self.max_subjects is not None and self.subjects > self.max_subjects:
+            raise BudgetExceeded('subjects', "Query visited more than {} subjects".format(self.max_subjects))
+        self.check()
+
+
+def currentBudget():
+    stack = getattr(_active_budgets, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+@contextlib.contextmanager
+def enforce(budget):
+    '''
+    Makes the budget the one checked by checkBudget() inside the with block, None enforces nothing
+    '''
+    if budget is None:
+        yield budget
+        return
+    if not hasattr(_active_budgets, 'stack'):
+        _active_budgets.stack = []
+    _active_budgets.stack.append(budget)
+    try:
+        yield budget
+    finally:
+        _active_budgets.stack.remove(budget)
+
+
+def checkBudget():
+    '''
+    Raises BudgetExceeded if the active budget ran out, call it inside long running loops
+    '''
+    stack = getattr(_active_budgets, 'stack', None)
+    if stack:
+        stack[-1].check()
@@ -0,0 +1,216 @@
+'''
+Full text and fuzzy search over the data elements of NIDM files and the CDE files.
+
+Every data element (anything whose rdf:type ends with DataElement) becomes a SearchDocument of its
+label, description, source variable and the labels of the concepts it is about.  The documents
+are ranked with BM25, the label counts more than the source variable and concept labels, which
+count more than the description:
+
+    index = getSearchIndex(('a.ttl', 'b.ttl') + tuple(getCDEFileList()))
+    for result in index.search('left hippocampus volume'):
+        print(result.score, result.label, result.uri)
+
+Query words that aren't in the index are expanded to the indexed words they are a prefix of and
+to the words sharing most of their character trigrams, so "hipocampus" still finds "hippocampus".
+
+The documents of a file (the CDE files too) are extracted once per file version and pickled in
+the temp directory (see FileCache.perFile), the index over a set of files is rebuilt from them
+when a file changes.
+'''
+import re
+import math
+import bisect
+import collections
+
+from rdflib import RDF
+
+from nidm.core import Constants
+from nidm.experiment.Query import OpenGraph
+from nidm.experiment.FileCache import perFile, corpusCache
+from nidm.experiment.QueryBudget import checkBudget
+
+SearchDocument = collections.namedtuple('SearchDocument', ['uri', 'label', 'description', 'source_variable', 'concepts'])
+SearchResult = collections.namedtuple('SearchResult', ['score', 'uri', 'label', 'description', 'source_variable', 'concepts', 'sources'])
+
+# how much a word counts in each field of a document
+FIELD_WEIGHTS = {'label': 3.0, 'source_variable': 2.0, 'concepts': 2.0, 'description': 1.0}
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+# a query word missing from the index matches indexed words with at least this trigram similarity
+FUZZY_SIMILARITY = 0.5
+FUZZY_EXPANSIONS = 5
+PREFIX_WEIGHT = 0.8
+SEARCH_CACHE_SIZE = 16
+
+
+def tokenize(text):
+    '''
+    Lower case words of a text, "LeftHippocampus_volume (mm^3)" -> ['left', 'hippocampus', 'volume', 'mm', '3']
+    '''
+    text = re.sub(r'([a-z])([A-Z])', r'\1 \2', str(text))
+    return re.findall(r'[a-z0-9]+', text.lower())
+
+
+def trigrams(word):
+    padded = '${}$'.format(word)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def extractSearchDocuments(rdf_graph):
+    '''
+    One SearchDocument per data element of the graph, the same predicates as getDataTypeInfo are
+    recognized (any namespace) plus nidm:source_variable and the rdfs:label of the isAbout concepts
+
+    :param rdf_graph: parsed RDF Graph
+    :return: list of SearchDocument with str values
+    '''
+    data_elements = set(s for (s, p, o) in rdf_graph.triples((None, RDF.type, None)) if str(o).endswith('DataElement'))
+
+    documents = []
+    for data_element in sorted(data_elements):
+        checkBudget()
+        label = description = source_variable = ''
+        concepts = []
+        for (s, p, o) in rdf_graph.triples((data_element, None, None)):
+            predicate = str(p)
+            if re.search(r'label$', predicate):
+                label = str(o)
+            elif re.search(r'description$', predicate):
+                description = str(o)
+            elif re.search(r'source_?variable$', predicate, flags=re.IGNORECASE):
+                source_variable = str(o)
+            elif re.search(r'isAbout$', predicate, flags=re.IGNORECASE):
+                concept_labels = [str(l) for l in rdf_graph.objects(subject=o, predicate=Constants.RDFS['label'])]
+                concepts.extend(concept_labels or [str(o).rstrip('/#').split('/')[-1].split('#')[-1]])
+        documents.append(SearchDocument(str(data_element), label, description, source_variable, tuple(sorted(set(concepts)))))
+    return documents
+
+
+@perFile(maxsize=SEARCH_CACHE_SIZE, persist=True)
+def getFileSearchDocuments(file):
+    '''
+    The SearchDocuments of one file
+    '''
+    return tuple(extractSearchDocuments(OpenGraph(file)))
+
+
+class SearchIndex:
+    '''
+    BM25 ranked inverted index of SearchDocuments.  A data element found in several sources is
+    indexed once, with the fields it has in any of them.
+    '''
+
+    def __init__(self):
+        self.documents = []
+        self.sources = []
+        self.by_uri = {}
+        self.lengths = []
+        self.postings = collections.defaultdict(dict)
+        self.grams = collections.defaultdict(set)
+        self.vocabulary = []
+
+    def add(self, document, source):
+        '''
+        Adds (or completes) a data element, call finish() once everything is added
+        '''
+        position = self.by_uri.get(document.uri)
+        if position is None:
+            self.by_uri[document.uri] = len(self.documents)
+            self.documents.append(document)
+            self.sources.append([source])
+            return
+        known = self.documents[position]
+        self.documents[position] = known._replace(**dict((field, getattr(document, field))
+                                                         for field in ['label', 'description', 'source_variable']
+                                                         if not getattr(known, field) and getattr(document, field)),
+                                                  concepts=tuple(sorted(set(known.concepts + document.concepts))))
+        if source not in self.sources[position]:
+            self.sources[position].append(source)
+
+    def finish(self):
+        '''
+        Builds the postings and the fuzzy lookup of the added documents
+        '''
+        self.postings.clear()
+        self.grams.clear()
+        self.lengths = []
+        for position, document in enumerate(self.documents):
+            frequencies = collections.Counter()
+            for field, weight in FIELD_WEIGHTS.items():
+                value = getattr(document, field)
+                text = ' '.join(value) if isinstance(value, tuple) else value
+                for word in tokenize(text):
+                    frequencies[word] += weight
+            for word, frequency in frequencies.items():
+                self.postings[word][position] = frequency
+            self.lengths.append(sum(frequencies.values()))
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        self.vocabulary = sorted(self.postings)
+        for word in self.vocabulary:
+            for gram in trigrams(word):
+                self.grams[gram].add(word)
+        return self
+
+    def expand(self, word):
+        '''
+        {indexed word: weight} a query word stands for, itself if it is indexed and otherwise the
+        indexed words it is a prefix of and the most similar indexed words
+        '''
+        if word in self.postings:
+            return {word: 1.0}
+        expansions = {}
+        start = bisect.bisect_left(self.vocabulary, word)
+        for candidate in self.vocabulary[start:start + FUZZY_EXPANSIONS]:
+            if not candidate.startswith(word) or len(word) < 3:
+                break
+            expansions[candidate] = PREFIX_WEIGHT
+
+        word_grams = trigrams(word)
+        shared = collections.Counter(candidate for gram in word_grams for candidate in self.grams.get(gram, ()))
+        similar = []
+        for candidate, count in shared.items():
+            # Dice coefficient of the trigram sets
+            similarity = 2.0 * count / (len(word_grams) + len(trigrams(candidate)))
+            if similarity >= FUZZY_SIMILARITY:
+                similar.append((similarity, candidate))
+        for similarity, candidate in sorted(similar, reverse=True)[:FUZZY_EXPANSIONS]:
+            expansions[candidate] = max(similarity, expansions.get(candidate, 0))
+        return expansions
+
+    def search(self, query, limit=10):
+        '''
+        :param query: words to look for
+        :param limit: number of results, None for all matches
+        :return: list of SearchResult, best match first
+        '''
+        scores = collections.defaultdict(float)
+        count = len(self.documents)
+        for word in set(tokenize(query)):
+            for indexed_word, weight in self.expand(word).items():
+                postings = self.postings[indexed_word]
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for position, frequency in postings.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[position] / self.average_length)
+                    scores[position] += weight * idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], self.documents[item[0]].uri))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [SearchResult(round(score, 4), *self.documents[position], sources=tuple(self.sources[position]))
+                for position, score in ranked]
+
+    def __len__(self):
+        return len(self.documents)
+
+
+@corpusCache(maxsize=SEARCH_CACHE_SIZE)
+def getSearchIndex(nidm_file_tuples):
+    '''
+    The SearchIndex of the data elements in a tuple of NIDM (and CDE) files
+    '''
+    index = SearchIndex()
+    for file in nidm_file_tuples:
+        for document in getFileSearchDocuments(file):
+            index.add(document, file)
+    return index.finish()
@@ -0,0 +1,274 @@
+import os
+import re
+import pickle
+import tempfile
+import collections
+from os import path
+
+import rdflib
+from rdflib import URIRef
+
+from nidm.core import Constants
+from nidm.experiment.Query import OpenGraph
+from nidm.experiment.FileCache import fileHash
+
+isa = URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#type')
+SubjectRecord = collections.namedtuple('SubjectRecord', ['subject_id', 'uuid', 'project', 'file'])
+
+# part of the name of the pickled records, bump it when extractSubjectRecords changes its result
+SUBJECT_INDEX_VERSION = 1
+
+
+def normalizeSubjectID(subject_id):
+    '''
+    Normalizes a subject identifier so the same participant matches across NIDM files and CSV files,
+    e.g. "sub-0050", "0050" and 50 all normalize to "50"
+
+    :param subject_id: subject identifier (string, number or rdflib Literal)
+    :return: normalized string
+    '''
+    normalized = str(subject_id).strip()
+    normalized = re.sub(r'^sub-', '', normalized, flags=re.IGNORECASE)
+    # pandas may have read a numeric ID column as float
+    normalized = re.sub(r'^(\d+)\.0$', r'\1', normalized)
+    normalized = normalized.lstrip('0')
+    if normalized == '' and str(subject_id).strip() != '':
+        # the ID was all zeros
+        normalized = '0'
+    return normalized
+
+
+def indexDataFrame(df, id_field):
+    '''
+    Builds a lookup of normalized subject ID -> list of row labels for a DataFrame so rows for a
+    subject can be found with a dict lookup instead of scanning the ID column for every subject
+
+    :param df: pandas DataFrame
+    :param id_field: name of the subject ID column
+    :return: dict
+    '''
+    lookup = {}
+    for label, value in df[id_field].items():
+        lookup.setdefault(normalizeSubjectID(value), []).append(label)
+    return lookup
+
+
+def extractSubjectRecords(rdf_graph, file=None):
+    '''
+    Scans a graph for every prov:agent with a ndar:src_subject_id and the project(s) that agent
+    takes part in (agent <- qualifiedAssociation <- activity -> session -> project)
+
+    :param rdf_graph: parsed RDF Graph
+    :param file: the file name to record with each entry
+    :return: list of SubjectRecord
+    '''
+    records = []
+    for agent, p, subject_id in rdf_graph.triples((None, Constants.NDAR['src_subject_id'], None)):
+        projects = set([])
+        for blank in rdf_graph.subjects(predicate=Constants.PROV['agent'], object=agent):
+            for activity in rdf_graph.subjects(predicate=Constants.PROV['qualifiedAssociation'], object=blank):
+                for session in rdf_graph.objects(subject=activity, predicate=Constants.DCT['isPartOf']):
+                    for project in rdf_graph.objects(subject=session, predicate=Constants.DCT['isPartOf']):
+                        if (project, isa, Constants.NIDM['Project']) in rdf_graph:
+                            projects.add(project)
+        if len(projects) == 0:
+            projects.add(None)
+        for project in projects:
+            records.append(SubjectRecord(subject_id=subject_id, uuid=agent, project=project, file=file))
+    return records
+
+
+class SubjectIndex:
+    '''
+    Maps normalized subject IDs to the agent UUIDs that carry them, per file and project, across
+    a set of NIDM files.  The per-file part of the index is pickled in the temp directory keyed by
+    the file's hash, so it is only computed once per file version, and update() only re-indexes
+    files that changed since they were last seen.  Beyond max_files files the least recently
+    updated ones are dropped.
+    '''
+
+    def __init__(self, nidm_file_list=None, cache_dir=None, max_files=1024):
+        self.cache_dir = cache_dir or tempfile.gettempdir()
+        self.max_files = max_files
+        self.file_records = {}
+        self.file_stats = {}
+        # file keys, least recently updated first
+        self.used = collections.OrderedDict()
+        self.by_id = {}
+        self.by_uuid = {}
+        if nidm_file_list:
+            self.update(nidm_file_list)
+
+    def update(self, nidm_file_list):
+        '''
+        Adds any new files to the index and re-indexes any file that changed on disk
+
+        :param nidm_file_list: list of NIDM files (or parsed rdflib Graphs)
+        :return: self
+        '''
+        for file in nidm_file_list:
+            self.used[self._key(file)] = None
+            self.used.move_to_end(self._key(file))
+            if isinstance(file, rdflib.graph.Graph):
+                # in memory graphs can't change underneath us, so index them once
+                if self._key(file) not in self.file_records:
+                    self._addRecords(self._key(file), extractSubjectRecords(file, file))
+                continue
+
+            stat = os.stat(file)
+            stat = (stat.st_mtime_ns, stat.st_size)
+            if self.file_stats.get(file) == stat:
+                continue
+            self.remove(file)
+            self.used[file] = None
+            self._addRecords(file, self._loadRecords(file))
+            self.file_stats[file] = stat
+
+        keep = self.fileKeys(nidm_file_list)
+        while len(self.used) > self.max_files:
+            oldest = next(iter(self.used))
+            if oldest in keep:
+                break
+            self.remove(oldest)
+        return self
+
+    def remove(self, file):
+        '''
+        Drops everything indexed for one file
+        '''
+        key = self._key(file)
+        for record in self.file_records.pop(key, []):
+            self.by_id[normalizeSubjectID(record.subject_id)].remove(record)
+            self.by_uuid[str(record.uuid)].remove(record)
+        self.file_stats.pop(key, None)
+        self.used.pop(key, None)
+
+    def _key(self, file):
+        return id(file) if isinstance(file, rdflib.graph.Graph) else file
+
+    def fileKeys(self, nidm_file_list):
+        '''
+        The set to pass as files= to the lookups for a list of files (or graphs)
+        '''
+        return set(self._key(file) for file in nidm_file_list)
+
+    def _loadRecords(self, file):
+        cache_file = '{}/subject_index.{}.{}.pickle'.format(self.cache_dir, SUBJECT_INDEX_VERSION, fileHash(file))
+        records = None
+        if path.isfile(cache_file):
+            try:
+                with open(cache_file, 'rb') as f:
+                    records = pickle.load(f)
+            except Exception:
+                # a partly written or unreadable pickle, index the file again
+                records = None
+        if records is None:
+            records = extractSubjectRecords(OpenGraph(file))
+            # write and rename so concurrent readers never see half a pickle
+            partial_file = '{}.{}'.format(cache_file, os.getpid())
+            with open(partial_file, 'wb') as f:
+                pickle.dump(records, f)
+            os.replace(partial_file, cache_file)
+        # the same file contents may live under more than one name so the name isn't pickled
+        return [r._replace(file=file) for r in records]
+
+    def _addRecords(self, key, records):
+        self.file_records[key] = records
+        for record in records:
+            self.by_id.setdefault(normalizeSubjectID(record.subject_id), []).append(record)
+            self.by_uuid.setdefault(str(record.uuid), []).append(record)
+
+    def lookup(self, subject_id, file=None, project=None):
+        '''
+        Finds every agent with the given subject ID
+
+        :param subject_id: subject ID in any of the forms accepted by normalizeSubjectID
+        :param file: optionally restrict to one file
+        :param project: optionally restrict to one project URI
+        :return: list of SubjectRecord
+        '''
+        records = self.by_id.get(normalizeSubjectID(subject_id), [])
+        return [r for r in records
+                if (file is None or r.file == file) and (project is None or str(r.project) == str(project))]
+
+    def uuids(self, subject_id, file=None, project=None):
+        '''
+        Returns the distinct agent UUIDs for a subject ID, in the order they were indexed
+        '''
+        result = []
+        for record in self.lookup(subject_id, file, project):
+            if record.uuid not in result:
+                result.append(record.uuid)
+        return result
+
+    def subjectID(self, uuid, files=None):
+        '''
+        Returns the src_subject_id recorded for an agent UUID or None
+
+        :param files: optionally only look in these files, a list or the set from fileKeys()
+        '''
+        if files is not None and not isinstance(files, set):
+            files = self.fileKeys(files)
+        for record in self.by_uuid.get(str(uuid), []):
+            if files is None or self._key(record.file) in files:
+                return record.subject_id
+        return None
+
+    def canonicalUUIDs(self, nidm_file_list):
+        '''
+        Maps the agents of each file to the agent with the same subject ID in the first file that has
+        the ID, going through the files in order.  Agents of one file are never merged with each
+        other.  Where either file has several agents with the ID (e.g. two projects both using
+        subject "1") an agent is only mapped to the one agent of the first file sharing a project
+        with it.
+
+        :param nidm_file_list: list of NIDM files already in the index
+        :return: dict of agent UUID -> canonical agent UUID, for the agents that need renaming
+        '''
+        owners = {}
+        remap = {}
+        for file in nidm_file_list:
+            # normalized subject ID -> {agent UUID: projects} of this file
+            agents = collections.defaultdict(lambda: collections.defaultdict(set))
+            for record in self.file_records.get(self._key(file), []):
+                agents[normalizeSubjectID(record.subject_id)][record.uuid].add(record.project)
+
+            for subject_id, file_agents in agents.items():
+                owner_agents = owners.setdefault(subject_id, file_agents)
+                if owner_agents is file_agents:
+                    continue
+                for uuid, projects in file_agents.items():
+                    if len(owner_agents) == 1 and len(file_agents) == 1:
+                        target = next(iter(owner_agents))
+                    else:
+                        matches = [owner for owner, owner_projects in owner_agents.items()
+                                   if (owner_projects & projects) - set([None])]
+                        target = matches[0] if len(matches) == 1 else None
+                    if target is not None and target != uuid:
+                        remap[uuid] = target
+        return remap
+
+    def subjects(self, file=None):
+        '''
+        Yields one SubjectRecord per distinct agent, optionally just for one file
+        '''
+        seen = set([])
+        sources = [self.file_records.get(self._key(file), [])] if file is not None else self.file_records.values()
+        for records in sources:
+            for record in records:
+                if (record.file, record.uuid) not in seen:
+                    seen.add((record.file, record.uuid))
+                    yield record
+
+
+_shared_index = SubjectIndex()
+
+def getSubjectIndex(nidm_file_list):
+    '''
+    Returns the process wide SubjectIndex brought up to date with the supplied files.  It may hold
+    other files too (the daemon and the servers share it), so pass the files to its lookups.
+
+    :param nidm_file_list: list of NIDM files
+    :return: SubjectIndex
+    '''
+    return _shared_index.update(nidm_file_list)
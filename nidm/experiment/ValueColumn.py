@@ -0,0 +1,254 @@
+import re
+import math
+from decimal import Decimal
+
+import numpy as np
+from rdflib import Literal
+
+MISSING_STRINGS = set(['', 'nan', 'NaN', 'None', 'n/a', 'N/A', 'NA'])
+
+
+class LexicalInt(int):
+    '''
+    An int that still prints the way it was written in the file, e.g. "007"
+    '''
+
+    def __new__(cls, value, lexical=None):
+        number = int.__new__(cls, value)
+        number.lexical = lexical
+        return number
+
+    def __getnewargs__(self):
+        return (int(self), self.lexical)
+
+    def __str__(self):
+        return self.lexical
+
+
+class LexicalFloat(float):
+    '''
+    A float that still prints the way it was written in the file, e.g. "3.50"
+    '''
+
+    def __new__(cls, value, lexical=None):
+        number = float.__new__(cls, value)
+        number.lexical = lexical
+        return number
+
+    def __getnewargs__(self):
+        return (float(self), self.lexical)
+
+    def __str__(self):
+        return self.lexical
+
+
+def typedValue(term):
+    '''
+    Converts an RDF term to the Python value it represents.  Numeric literals become int or float,
+    everything else (URIs, plain strings) becomes a string.  Numbers whose literal isn't written the
+    way Python would print them ("007", "3.50") keep the literal for outputValue().
+
+    :param term: rdflib term or python value
+    :return: int | float | str
+    '''
+    value = term
+    if isinstance(term, Literal):
+        value = term.toPython()
+    if isinstance(value, bool):
+        return str(term)
+    if isinstance(value, Decimal):
+        value = float(value)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        if isinstance(term, Literal) and str(term) != str(value):
+            return LexicalInt(value, str(term)) if isinstance(value, (int, np.integer)) else LexicalFloat(value, str(term))
+        return value
+    return str(term)
+
+
+def toNumber(value):
+    '''
+    Returns the value as a float or None if it isn't numeric
+    '''
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)
+    try:
+        return float(str(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def isInteger(value):
+    '''
+    True for ints and for strings holding an integer, e.g. values read back from a CSV file
+    '''
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, np.integer)):
+        return True
+    return isinstance(value, str) and re.match(r'^\s*[+-]?\d+\s*$', value) is not None
+
+
+def outputValue(value):
+    '''
+    The string form used when values leave the library (JSON, CLI tables, legacy string APIs),
+    the literal as written in the file
+    '''
+    return str(value)
+
+
+def compareValues(left, op, right):
+    '''
+    Compares a typed value against a filter value.  'eq' compares numerically when both
+    sides are numbers and as strings otherwise, 'lt' and 'gt' compare numerically.
+
+    :param left: typed value
+    :param op: 'eq', 'lt' or 'gt'
+    :param right: the filter value, usually a string
+    :return: True | False | None if the values can't be compared
+    '''
+    left_number = toNumber(left)
+    right_number = toNumber(right)
+    if op == 'eq':
+        if left_number is not None and right_number is not None and not math.isnan(left_number):
+            return left_number == right_number
+        return str(left) == str(right)
+    if left_number is None or right_number is None:
+        return None
+    if op == 'lt':
+        return left_number < right_number
+    if op == 'gt':
+        return left_number > right_number
+    return None
+
+
+class ValueColumn:
+    '''
+    A column of values stored the way NumPy wants them: an int64 or float64 array when every
+    present value is numeric (missing values are NaN), otherwise categorical codes (int32) into a
+    list of distinct strings with -1 for missing.  Statistics and comparisons are vectorized and
+    strings are only produced by strings().
+    '''
+
+    INT = 'int64'
+    FLOAT = 'float64'
+    CATEGORY = 'category'
+
+    def __init__(self, values):
+        values = list(values)
+        present = [v for v in values if not self.isMissing(v)]
+        numbers = [toNumber(v) for v in present]
+
+        if len(present) > 0 and all(n is not None for n in numbers):
+            if len(present) == len(values) and all(isInteger(v) for v in present):
+                self.kind = self.INT
+                self.values = np.array([int(v) for v in values], dtype=np.int64)
+            else:
+                self.kind = self.FLOAT
+                self.values = np.array([np.nan if self.isMissing(v) else toNumber(v) for v in values], dtype=np.float64)
+            self.categories = None
+        else:
+            self.kind = self.CATEGORY
+            self.categories = []
+            lookup = {}
+            codes = np.empty(len(values), dtype=np.int32)
+            for i, v in enumerate(values):
+                if self.isMissing(v):
+                    codes[i] = -1
+                    continue
+                s = str(v)
+                if s not in lookup:
+                    lookup[s] = len(self.categories)
+                    self.categories.append(s)
+                codes[i] = lookup[s]
+            self.values = codes
+
+    @staticmethod
+    def isMissing(value):
+        if value is None:
+            return True
+        if isinstance(value, float) and math.isnan(value):
+            return True
+        return isinstance(value, str) and value.strip() in MISSING_STRINGS
+
+    def __len__(self):
+        return len(self.values)
+
+    def isNumeric(self):
+        return self.kind != self.CATEGORY
+
+    def missing(self):
+        '''
+        Boolean mask of the missing entries
+        '''
+        if self.kind == self.FLOAT:
+            return np.isnan(self.values)
+        if self.kind == self.INT:
+            return np.zeros(len(self.values), dtype=bool)
+        return self.values == -1
+
+    def numbers(self):
+        '''
+        The present values as a float64 array (empty for categorical columns)
+        '''
+        if not self.isNumeric():
+            return np.array([], dtype=np.float64)
+        return self.values[~self.missing()].astype(np.float64)
+
+    def compare(self, op, right):
+        '''
+        Vectorized version of compareValues for a whole column, e.g. a table read back from CSV.  The
+        REST filters test one subject at a time and use compareValues directly.
+
+        :return: boolean array
+        '''
+        right_number = toNumber(right)
+        if self.isNumeric():
+            if right_number is None:
+                if op == 'eq':
+                    return np.array([s == str(right) for s in self.strings()], dtype=bool)
+                return np.zeros(len(self.values), dtype=bool)
+            with np.errstate(invalid='ignore'):
+                if op == 'eq':
+                    return self.values == right_number
+                if op == 'lt':
+                    return self.values < right_number
+                if op == 'gt':
+                    return self.values > right_number
+            return np.zeros(len(self.values), dtype=bool)
+
+        if op == 'eq':
+            if str(right) in self.categories:
+                return self.values == self.categories.index(str(right))
+            return np.zeros(len(self.values), dtype=bool)
+        return np.zeros(len(self.values), dtype=bool)
+
+    def stats(self):
+        '''
+        Basic statistics over the present numeric values, None when there are none
+        '''
+        numbers = self.numbers()
+        if len(numbers) == 0:
+            return {"max": None, "min": None, "median": None, "mean": None, "standard_deviation": None}
+        return {"max": float(np.max(numbers)), "min": float(np.min(numbers)), "median": float(np.median(numbers)),
+                "mean": float(np.mean(numbers)), "standard_deviation": float(np.std(numbers))}
+
+    def toPandas(self):
+        '''
+        The column as a pandas Series: int64, float64 or categorical
+        '''
+        import pandas as pd
+        if self.kind == self.CATEGORY:
+            return pd.Series(pd.Categorical.from_codes(self.values, categories=self.categories))
+        return pd.Series(self.values)
+
+    def strings(self):
+        '''
+        Converts the column back to strings, this is the output boundary
+        '''
+        if self.kind == self.CATEGORY:
+            return [self.categories[c] if c >= 0 else '' for c in self.values]
+        if self.kind == self.INT:
+            return [outputValue(int(v)) for v in self.values]
+        return [outputValue(float(v)) for v in self.values]
@@ -0,0 +1,35 @@
+from nidm.experiment.FieldStatistics import fieldTable, fieldStatistics
+
+
+def test_fieldStatistics():
+    table = fieldTable({'age': [21, 33, None, 40, 18],
+                        'site': ['CMU', 'NYU', 'CMU', None, 'CMU'],
+                        'sex': ['F', 'M', 'F', 'F', 'M']})
+
+    stats = fieldStatistics(table, ['age', 'site'], bins=4)
+    age = stats['age']
+    assert age['count'] == 4 and age['missing'] == 1
+    assert age['min'] == 18 and age['max'] == 40 and age['median'] == 27
+    assert age['percentiles']['p50'] == 27
+    assert age['histogram']['edges'][0] == 18 and age['histogram']['edges'][-1] == 40
+    assert sum(age['histogram']['counts']) == 4
+    assert stats['site']['categories'] == {'CMU': 3, 'NYU': 1}
+    assert stats['site']['missing'] == 1
+    assert stats['site']['mean'] is None
+
+
+def test_fieldStatistics_group_by():
+    table = fieldTable({'age': [21, 33, None, 40, 18],
+                        'site': ['CMU', 'NYU', 'CMU', None, 'CMU'],
+                        'sex': ['F', 'M', 'F', 'F', 'M']})
+
+    groups = fieldStatistics(table, ['age'], group_by=['site'])['age']
+    assert [g['group'] for g in groups] == [{'site': 'CMU'}, {'site': 'NYU'}, {'site': None}]
+    cmu = groups[0]
+    assert cmu['count'] == 2 and cmu['missing'] == 1 and cmu['mean'] == 19.5
+    # every group uses the same histogram bins
+    assert all(g['histogram']['edges'] == cmu['histogram']['edges'] for g in groups)
+    assert [sum(g['histogram']['counts']) for g in groups] == [2, 1, 1]
+
+    groups = fieldStatistics(table, ['sex'], group_by=['site', 'sex'])['sex']
+    assert groups[0] == dict(groups[0], group={'site': 'CMU', 'sex': 'F'}, categories={'F': 2})
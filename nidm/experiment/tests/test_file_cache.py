@@ -0,0 +1,111 @@
+from nidm.experiment import Project, Session, Acquisition, FileCache
+from nidm.experiment import Navigate, Query
+from nidm.core import Constants
+from os import remove
+
+
+def makeSubjectFile(file_name, project_uuid, subject_ids):
+    kwargs={Constants.NIDM_PROJECT_NAME:"FBIRN_PhaseII",Constants.NIDM_PROJECT_IDENTIFIER:9610,Constants.NIDM_PROJECT_DESCRIPTION:"Test investigation"}
+    project = Project(uuid=project_uuid,attributes=kwargs)
+    session = Session(project=project)
+    for subject_id in subject_ids:
+        acq = Acquisition(session=session)
+        person=acq.add_person(attributes=({Constants.NIDM_SUBJECTID:subject_id}))
+        acq.add_qualified_association(person=person,role=Constants.NIDM_PARTICIPANT)
+
+    with open(file_name,'w') as f:
+        f.write(project.serializeTurtle())
+
+
+def test_changed_file_only_recomputes_its_part():
+    makeSubjectFile("test_fc_a.ttl", "_fc_p1", ["1", "2"])
+    makeSubjectFile("test_fc_b.ttl", "_fc_p1", ["3"])
+    files = ("test_fc_a.ttl", "test_fc_b.ttl")
+    project = Constants.NIIRI["_fc_p1"]
+
+    table = Navigate.getProjectSubjectTable(files, "_fc_p1")
+    assert sorted(row.subject_id for row in table) == ["1", "2", "3"]
+    part_a = Navigate.getFileSubjectTable("test_fc_a.ttl", project)
+    part_b = Navigate.getFileSubjectTable("test_fc_b.ttl", project)
+    graph_a = Query.OpenGraph("test_fc_a.ttl")
+    assert "Navigate.getFileSubjectTable" in FileCache.dependencies("test_fc_b.ttl")
+
+    # unchanged files are served from the cache, the combined result too
+    assert Navigate.getProjectSubjectTable(files, "_fc_p1") is table
+
+    makeSubjectFile("test_fc_b.ttl", "_fc_p1", ["3", "4", "5"])
+
+    table = Navigate.getProjectSubjectTable(files, "_fc_p1")
+    assert sorted(row.subject_id for row in table) == ["1", "2", "3", "4", "5"]
+    assert Navigate.getFileSubjectTable("test_fc_a.ttl", project) is part_a
+    assert Query.OpenGraph("test_fc_a.ttl") is graph_a
+    assert Navigate.getFileSubjectTable("test_fc_b.ttl", project) is not part_b
+    assert len(Navigate.getProjects(files)) == 2
+
+    FileCache.invalidate("test_fc_b.ttl")
+    assert FileCache.dependencies("test_fc_b.ttl") == {}
+    assert "Query.OpenGraph" in FileCache.dependencies("test_fc_a.ttl")
+
+    remove("test_fc_a.ttl")
+    remove("test_fc_b.ttl")
+
+
+def test_persisted_partials():
+    makeSubjectFile("test_fc_c.ttl", "_fc_p2", ["7"])
+    project = Constants.NIIRI["_fc_p2"]
+
+    part = Navigate.getFileSubjectTable("test_fc_c.ttl", project)
+    cached = Navigate.getFileSubjectTable.__wrapped__
+    loaded = cached.loaded
+
+    # a new process (an empty memory cache) reads the pickle instead of the graph
+    FileCache.invalidate("test_fc_c.ttl")
+    assert Navigate.getFileSubjectTable("test_fc_c.ttl", project) == part
+    assert cached.loaded == loaded + 1
+
+    remove("test_fc_c.ttl")
+
+
+def test_version_snapshot():
+    makeSubjectFile("test_fc_d.ttl", "_fc_p3", ["8"])
+    files = ("test_fc_d.ttl",)
+
+    with FileCache.VersionSnapshot() as snapshot:
+        projects = Navigate.getProjects(files)
+        version = snapshot.version("test_fc_d.ttl")
+        # a change while the snapshot is active isn't looked for, every lookup sees the same version
+        makeSubjectFile("test_fc_d.ttl", "_fc_p4", ["8"])
+        assert Navigate.getProjects(files) is projects
+        with FileCache.VersionSnapshot():
+            assert FileCache.activeSnapshot() is snapshot
+            assert Navigate.getProjects(files) is projects
+        assert snapshot.version("test_fc_d.ttl") == version
+
+    # the next query notices it
+    assert FileCache.activeSnapshot() is None
+    assert Navigate.getProjects(files) != projects
+
+    remove("test_fc_d.ttl")
+
+
+def test_pinned_entries_are_not_evicted():
+    makeSubjectFile("test_fc_e.ttl", "_fc_p5", ["9"])
+
+    graph = FileCache.pin(Query.OpenGraph, "test_fc_e.ttl")
+    cache = Query.OpenGraph.__wrapped__
+    # more graphs than the cache holds
+    others = ["test_fc_f{}.ttl".format(i) for i in range(cache.maxsize + 1)]
+    for i, other in enumerate(others):
+        with open(other, 'w') as f:
+            f.write("<http://example.org/{}> <http://example.org/p> 1 .\n".format(i))
+        Query.OpenGraph(other)
+    assert "Query.OpenGraph" not in FileCache.dependencies(others[0])
+    assert Query.OpenGraph("test_fc_e.ttl") is graph
+    assert "Query.OpenGraph" in FileCache.dependencies("test_fc_e.ttl")
+
+    FileCache.invalidate("test_fc_e.ttl")
+    assert FileCache.dependencies("test_fc_e.ttl") == {}
+
+    remove("test_fc_e.ttl")
+    for other in others:
+        remove(other)
@@ -0,0 +1,51 @@
+from nidm.experiment import Project, Session, Acquisition, Navigate, Query
+from nidm.experiment.Instrumentation import trace, tracing
+from nidm.core import Constants
+from os import remove, path
+import json
+
+
+def makeTraceTestFile(file_name):
+    kwargs={Constants.NIDM_PROJECT_NAME:"FBIRN_PhaseII",Constants.NIDM_PROJECT_IDENTIFIER:9610,Constants.NIDM_PROJECT_DESCRIPTION:"Test investigation"}
+    project = Project(uuid="_trace_p1",attributes=kwargs)
+    session = Session(project=project)
+    for subject_id in ["1", "2", "3"]:
+        acq = Acquisition(session=session)
+        person=acq.add_person(attributes=({Constants.NIDM_SUBJECTID:subject_id}))
+        acq.add_qualified_association(person=person,role=Constants.NIDM_PARTICIPANT)
+
+    with open(file_name,'w') as f:
+        f.write(project.serializeTurtle())
+
+
+def test_trace_records_calls():
+    makeTraceTestFile("test_trace.ttl")
+    files = tuple(["test_trace.ttl"])
+
+    assert not tracing()
+    with trace("test_trace.json") as t:
+        assert tracing()
+        Navigate.getSubjects(files, Constants.NIIRI + "_trace_p1")
+        Query.GetProjectsUUID(files)
+    assert not tracing()
+
+    summary = t.summary()
+    functions = {f['function']: f for f in summary['functions']}
+    assert functions['Navigate.getSubjects']['calls'] == 1
+    assert functions['Navigate.getSubjects']['rows'] == 3
+    assert functions['Navigate.iterSubjects']['rows'] == 3
+    assert functions['Query.OpenGraph']['cache_hits'] + functions['Query.OpenGraph']['cache_misses'] == functions['Query.OpenGraph']['calls']
+    assert 'sparql' in [s['stage'] for s in summary['stages']]
+    assert 'Navigate.getSubjects' in t.report()
+
+    with open("test_trace.json") as f:
+        written = json.load(f)
+    assert len(written['calls']) == len(t.calls)
+
+    # nothing is recorded once the trace is closed
+    calls = len(t.calls)
+    Navigate.getProjects(files)
+    assert len(t.calls) == calls
+
+    remove("test_trace.ttl")
+    remove("test_trace.json")
@@ -120,3 +120,33 @@ def test_navigate_get_acquisition_data_by_subject():
     assert 'InversionTime' in set_of_keys_returned
     assert 'hadAcquisitionModality' in set_of_keys_returned
 
+
+
+def test_navigate_iter_sessions_matches_get_sessions():
+    sessions = Navigate.getSessions(BRAIN_VOL_FILES, PROJECT_URI)
+    iterated = list(Navigate.iterSessions(BRAIN_VOL_FILES, PROJECT_URI))
+    assert iterated == sessions
+
+    # generators can be abandoned after the first item
+    first = next(Navigate.iterSessions(BRAIN_VOL_FILES, PROJECT_URI))
+    assert first == sessions[0]
+
+
+def test_navigate_iter_subjects_matches_get_subjects():
+    subjects = Navigate.getSubjects(BRAIN_VOL_FILES, PROJECT_URI)
+    iterated = list(Navigate.iterSubjects(BRAIN_VOL_FILES, PROJECT_URI))
+    assert len(iterated) == len(set(iterated))
+    assert set(iterated) == subjects
+
+
+def test_navigate_cursor():
+    cursor = Navigate.NavigationCursor(BRAIN_VOL_FILES, project_id=PROJECT_URI)
+
+    position = cursor.first()
+    assert position.project == PROJECT_URI
+    assert position.session != None
+    assert position.acquisition != None
+    assert position.object != None
+
+    assert cursor.count(level='session') == len(Navigate.getSessions(BRAIN_VOL_FILES, PROJECT_URI))
+    assert Navigate.NavigationCursor(BRAIN_VOL_FILES).count(level='project') == 2
@@ -1,6 +1,7 @@
 import nidm.experiment.Navigate
 from nidm.experiment import Project, Session, AssessmentAcquisition, AssessmentObject, Acquisition, AcquisitionObject, Query
 from nidm.core import Constants
+from nidm.experiment.tools.rest import RestParser
 from rdflib import Namespace,URIRef
 import prov.model as pm
 from os import remove, path
@@ -360,3 +361,39 @@ def test_custom_data_types():
     assert (str(valuetype3['label']) == 'age')
     assert (str(valuetype3['description']) == "Age of participant at scan")
     assert (str(valuetype3['isAbout']) == str(Constants.NIIRI['24d78sq']))
+
+
+DERIVATIVES = '''
+@prefix prov: <http://www.w3.org/ns/prov#> .
+@prefix nidm: <http://purl.org/nidash/nidm#> .
+@prefix sio: <http://semanticscience.org/ontology/sio.owl#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix niiri: <http://iri.nidash.org/> .
+
+niiri:fs a prov:SoftwareAgent .
+niiri:volume a nidm:DataElement ; rdfs:label "Left-Hippocampus (mm^3)" ; nidm:datumType niiri:ratio ; nidm:hasUnit "mm^3" .
+{subjects}
+'''
+
+
+def test_GetProjectDerivativesData(tmp_path):
+    subjects = "\n".join('niiri:{0} a prov:Agent .\n'
+                         'niiri:{0}_act prov:qualifiedAssociation [ prov:agent niiri:{0} ; prov:hadRole sio:Subject ], [ prov:agent niiri:fs ] .\n'
+                         'niiri:{0}_stats a nidm:FSStatsCollection ; prov:wasGeneratedBy niiri:{0}_act ; niiri:volume {1} .'
+                         .format(subject, volume) for subject, volume in [("d1", 4000), ("d2", "4100.5")])
+    nidm_file = tmp_path / "derivatives.ttl"
+    nidm_file.write_text(DERIVATIVES.format(subjects=subjects))
+    files = (str(nidm_file),)
+
+    data = Query.GetProjectDerivativesDataTyped(files, None)
+    assert sorted(data) == ["d1", "d2"]
+    # the same collections as the per subject query, found in one pass
+    for subject in ["d1", "d2"]:
+        assert data[subject] == Query.GetDerivativesDataForSubjectTyped(files, None, subject)
+    values = [measure['value'] for measure in data["d2"]["d2_stats"]['values'].values()]
+    assert values == [4100.5]
+
+    restParser = RestParser()
+    restParser.nidm_files = files
+    table = restParser.projectFieldTable(None, ["d1", "d2", "d3"], ["derivatives.Left-Hippocampus (mm^3)"])
+    assert list(table["Left-Hippocampus (mm^3)"].iloc[:2]) == [4000, 4100.5]
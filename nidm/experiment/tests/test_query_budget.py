@@ -0,0 +1,62 @@
+import time
+import threading
+
+import pytest
+
+from nidm.experiment import Navigate
+from nidm.experiment.QueryBudget import Budget, BudgetExceeded, enforce, checkBudget, currentBudget
+from nidm.experiment.tools.tests.test_rest import makeTestFile
+
+
+def test_budget_limits():
+    budget = Budget(max_rows=2, max_subjects=1)
+    budget.countRow()
+    budget.countRow()
+    with pytest.raises(BudgetExceeded) as e:
+        budget.countRow()
+    assert e.value.reason == 'rows'
+    budget.countSubject()
+    with pytest.raises(BudgetExceeded) as e:
+        budget.countSubject()
+    assert e.value.reason == 'subjects'
+
+    budget = Budget(timeout=0.01)
+    time.sleep(0.02)
+    with pytest.raises(BudgetExceeded) as e:
+        budget.check()
+    assert e.value.reason == 'deadline'
+
+    # nothing is enforced outside of enforce()
+    checkBudget()
+    with enforce(budget):
+        assert currentBudget() is budget
+        with pytest.raises(BudgetExceeded):
+            checkBudget()
+    assert currentBudget() is None
+    checkBudget()
+
+    # a budget only applies to the thread that entered it
+    seen = []
+    def other():
+        seen.append(currentBudget())
+        checkBudget()
+        seen.append('checked')
+    with enforce(budget):
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+    assert seen == [None, 'checked']
+
+
+def test_traversal_stops(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'budget.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'traversal_p1', 'PROJECT2_UUID': 'traversal_p2'})
+    files = (nidm_file,)
+
+    with enforce(Budget(cancelled=lambda: True)):
+        with pytest.raises(BudgetExceeded) as e:
+            Navigate.getProjectSubjectTable(files, 'traversal_p1')
+    assert e.value.reason == 'cancelled'
+    # the interrupted call left nothing in the cache
+    assert len(Navigate.getProjectSubjectTable(files, 'traversal_p1')) == 3
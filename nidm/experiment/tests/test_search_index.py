@@ -0,0 +1,138 @@
+from nidm.experiment import SearchIndex, FileCache
+from nidm.experiment.tools.rest import RestParser
+from click.testing import CliRunner
+from os import remove, path
+import json
+
+# data elements the way csv2nidm writes them (the concept label is stored on the isAbout URI)
+DATA_ELEMENTS = '''
+@prefix nidm: <http://purl.org/nidash/nidm#> .
+@prefix niiri: <http://iri.nidash.org/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix dct: <http://purl.org/dc/terms/> .
+@prefix prov: <http://www.w3.org/ns/prov#> .
+
+niiri:age_de a nidm:DataElement, prov:Entity ;
+    rdfs:label "AGE_AT_SCAN" ;
+    dct:description "Age of the participant when the scan was acquired" ;
+    nidm:source_variable "age" ;
+    nidm:isAbout <http://uri.interlex.org/ilx_0100400> .
+
+<http://uri.interlex.org/ilx_0100400> a prov:Entity ;
+    rdfs:label "Age" .
+
+niiri:hand_de a nidm:DataElement, prov:Entity ;
+    rdfs:label "handedness" ;
+    dct:description "Dominant hand of the participant" ;
+    nidm:source_variable "hand" .
+'''
+
+MORE_DATA_ELEMENTS = '''
+@prefix nidm: <http://purl.org/nidash/nidm#> .
+@prefix niiri: <http://iri.nidash.org/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+niiri:hippo_de a nidm:DataElement ;
+    rdfs:label "Left-Hippocampus Volume (mm^3)" .
+
+niiri:hand_de a nidm:DataElement ;
+    rdfs:label "handedness" .
+'''
+
+CDE_DIR = path.join(path.dirname(__file__), '..', '..', 'core', 'cde_dir')
+
+
+def writeFile(file_name, turtle):
+    with open(file_name, 'w') as f:
+        f.write(turtle)
+
+
+def test_tokenize():
+    assert SearchIndex.tokenize("LeftHippocampus_volume (mm^3)") == ['left', 'hippocampus', 'volume', 'mm', '3']
+    assert SearchIndex.tokenize("AGE_AT_SCAN") == ['age', 'at', 'scan']
+
+
+def test_search_index():
+    writeFile("test_search_a.ttl", DATA_ELEMENTS)
+    writeFile("test_search_b.ttl", MORE_DATA_ELEMENTS)
+    files = ("test_search_a.ttl", "test_search_b.ttl")
+
+    index = SearchIndex.getSearchIndex(files)
+    # handedness is in both files but indexed once
+    assert len(index) == 3
+
+    results = index.search("participant age")
+    assert results[0].label == "AGE_AT_SCAN"
+    assert results[0].concepts == ("Age",)
+    assert results[0].source_variable == "age"
+
+    hand = index.search("handedness")
+    assert [r.label for r in hand] == ["handedness"]
+    assert hand[0].sources == files
+    assert hand[0].description == "Dominant hand of the participant"
+
+    # misspelled and partial words
+    assert index.search("hipocampus")[0].label == "Left-Hippocampus Volume (mm^3)"
+    assert index.search("hippo")[0].label == "Left-Hippocampus Volume (mm^3)"
+    assert index.search("zzzz") == []
+    assert len(index.search("the participant", limit=1)) == 1
+
+    assert SearchIndex.getSearchIndex(files) is index
+
+    # the documents of an unchanged file are read from their pickle
+    cached = SearchIndex.getFileSearchDocuments
+    loaded = cached.loaded
+    FileCache.invalidate("test_search_a.ttl")
+    assert SearchIndex.getSearchIndex(files).search("age")[0].label == "AGE_AT_SCAN"
+    assert cached.loaded == loaded + 1
+
+    remove("test_search_a.ttl")
+    remove("test_search_b.ttl")
+
+
+def test_search_route_and_command(monkeypatch):
+    from nidm.experiment.tools.nidm_search import search
+
+    monkeypatch.setenv("CDE_DIR", CDE_DIR)
+    writeFile("test_search_c.ttl", DATA_ELEMENTS)
+
+    rest_parser = RestParser(output_format=RestParser.OBJECT_FORMAT)
+    result = rest_parser.run(["test_search_c.ttl"], "/search?q=hippocampus%20volume&limit=2")
+    assert len(result) == 2
+    assert all("Hippocampus" in r['label'] for r in result)
+    assert result[0]['sources'][0].endswith("_cde.ttl")
+
+    result = rest_parser.run(["test_search_c.ttl"], "/search?q=dominant%20hand")
+    assert result[0]['uri'] == "http://iri.nidash.org/hand_de"
+    assert result[0]['sources'] == ["test_search_c.ttl"]
+
+    assert "error" in rest_parser.run(["test_search_c.ttl"], "/search")
+
+    runner = CliRunner()
+    res = runner.invoke(search, ['-nl', 'test_search_c.ttl', '-q', 'age', '--no_cdes', '-j'])
+    assert res.exit_code == 0
+    assert [r['label'] for r in json.loads(res.output)] == ["AGE_AT_SCAN"]
+
+    remove("test_search_c.ttl")
+
+
+def test_cde_file_list_resolved_once(monkeypatch):
+    from nidm.experiment import Query
+
+    downloads = []
+    def download():
+        downloads.append(1)
+        return CDE_DIR
+    monkeypatch.delenv("CDE_DIR", raising=False)
+    monkeypatch.setattr(Query, "download_cde_files", download)
+    monkeypatch.setattr(Query.getCDEFileList, "cache", {})
+
+    # every /search uses the CDE files, they must not be fetched again each time
+    first = Query.getCDEFileList()
+    assert len(first) == 3
+    assert Query.getCDEFileList() == first
+    assert len(downloads) == 1
+
+    monkeypatch.setenv("CDE_DIR", CDE_DIR)
+    assert Query.getCDEFileList() == first
+    assert len(downloads) == 1
@@ -0,0 +1,85 @@
+from nidm.experiment import Project, Session, Acquisition
+from nidm.experiment.SubjectIndex import SubjectIndex, normalizeSubjectID, indexDataFrame
+from nidm.core import Constants
+from rdflib import URIRef
+from os import remove
+import pandas as pd
+
+
+def makeSubjectFile(file_name, project_uuid, subject_ids):
+    kwargs={Constants.NIDM_PROJECT_NAME:"FBIRN_PhaseII",Constants.NIDM_PROJECT_IDENTIFIER:9610,Constants.NIDM_PROJECT_DESCRIPTION:"Test investigation"}
+    project = Project(uuid=project_uuid,attributes=kwargs)
+    session = Session(project=project)
+    uuids = {}
+    for subject_id in subject_ids:
+        acq = Acquisition(session=session)
+        person=acq.add_person(attributes=({Constants.NIDM_SUBJECTID:subject_id}))
+        acq.add_qualified_association(person=person,role=Constants.NIDM_PARTICIPANT)
+        uuids[subject_id] = URIRef(Constants.NIIRI + str(person.identifier).replace("niiri:", ""))
+
+    with open(file_name,'w') as f:
+        f.write(project.serializeTurtle())
+    return uuids
+
+
+def test_normalizeSubjectID():
+    assert normalizeSubjectID("sub-0050") == "50"
+    assert normalizeSubjectID("0050") == "50"
+    assert normalizeSubjectID(50) == "50"
+    assert normalizeSubjectID(50.0) == "50"
+    assert normalizeSubjectID("000") == "0"
+    assert normalizeSubjectID("a1_9999") == "a1_9999"
+
+
+def test_SubjectIndex_lookup():
+    uuids_a = makeSubjectFile("test_si_a.ttl", "_si_p1", ["0050", "0051"])
+    uuids_b = makeSubjectFile("test_si_b.ttl", "_si_p2", ["sub-50", "52"])
+
+    index = SubjectIndex(["test_si_a.ttl", "test_si_b.ttl"])
+
+    assert index.uuids("50", file="test_si_a.ttl") == [uuids_a["0050"]]
+    assert index.uuids("50", file="test_si_b.ttl") == [uuids_b["sub-50"]]
+    assert len(index.lookup("0050")) == 2
+    assert index.lookup("51")[0].project == URIRef(Constants.NIIRI + "_si_p1")
+    assert index.lookup("52", project=Constants.NIIRI + "_si_p1") == []
+    assert str(index.subjectID(uuids_b["52"])) == "52"
+    # lookups can be kept to the files of a query
+    assert str(index.subjectID(uuids_b["52"], files=["test_si_b.ttl"])) == "52"
+    assert index.subjectID(uuids_b["52"], files=["test_si_a.ttl"]) is None
+    assert len(list(index.subjects("test_si_a.ttl"))) == 2
+
+    # rewriting one file only changes that file's entries
+    uuids_b = makeSubjectFile("test_si_b.ttl", "_si_p2", ["53"])
+    index.update(["test_si_a.ttl", "test_si_b.ttl"])
+    assert index.lookup("52") == []
+    assert index.uuids("53") == [uuids_b["53"]]
+    assert len(index.lookup("50")) == 1
+
+    # files that haven't been asked for in a while are dropped
+    index.max_files = 1
+    index.update(["test_si_b.ttl"])
+    assert index.lookup("51") == []
+    assert index.uuids("53") == [uuids_b["53"]]
+
+    remove("test_si_a.ttl")
+    remove("test_si_b.ttl")
+
+
+def test_SubjectIndex_unreadable_pickle(tmp_path):
+    uuids = makeSubjectFile(str(tmp_path / "test_si_c.ttl"), "_si_p3", ["60"])
+    SubjectIndex([str(tmp_path / "test_si_c.ttl")], cache_dir=str(tmp_path))
+    pickles = list(tmp_path.glob("subject_index.*.pickle"))
+    assert len(pickles) == 1
+
+    # as seen by a reader while another process is still writing it
+    pickles[0].write_bytes(pickles[0].read_bytes()[:10])
+    index = SubjectIndex([str(tmp_path / "test_si_c.ttl")], cache_dir=str(tmp_path))
+    assert index.uuids("60") == [uuids["60"]]
+    assert SubjectIndex([str(tmp_path / "test_si_c.ttl")], cache_dir=str(tmp_path)).uuids("60") == [uuids["60"]]
+
+
+def test_indexDataFrame():
+    df = pd.DataFrame({'id': ['0050', '51', 'sub-52'], 'age': [10, 11, 12]})
+    lookup = indexDataFrame(df, 'id')
+    assert list(df.loc[lookup["50"]]['age']) == [10]
+    assert list(df.loc[lookup[normalizeSubjectID("sub-0052")]]['age']) == [12]
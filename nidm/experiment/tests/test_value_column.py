@@ -0,0 +1,74 @@
+import math
+import pickle
+
+import numpy as np
+from rdflib import Literal, URIRef, XSD
+
+from nidm.experiment.ValueColumn import ValueColumn, typedValue, compareValues, outputValue
+from nidm.experiment.tools.rest_json import ENCODERS
+
+
+def test_typedValue():
+    assert typedValue(Literal(21)) == 21
+    assert isinstance(typedValue(Literal(21)), int)
+    assert typedValue(Literal("3.5", datatype=XSD.decimal)) == 3.5
+    assert isinstance(typedValue(Literal("3.5", datatype=XSD.float)), float)
+    assert typedValue(Literal("CMU")) == "CMU"
+    assert typedValue(URIRef("http://example.com/a")) == "http://example.com/a"
+    assert typedValue(Literal(True)) == "true"
+
+
+def test_typedValue_keeps_literal():
+    value = typedValue(Literal("3.50", datatype=XSD.decimal))
+    assert value == 3.5 and value + 1 == 4.5
+    assert compareValues(value, 'gt', '3.4')
+    # the output is the literal from the file, not Python's "3.5"
+    assert outputValue(value) == "3.50"
+    assert outputValue(pickle.loads(pickle.dumps(value))) == "3.50"
+    assert outputValue(typedValue(Literal("3.5", datatype=XSD.decimal))) == "3.5"
+    assert str(ValueColumn([value, 4]).toPandas().dtype) == 'float64'
+    for dumps in ENCODERS.values():
+        assert dumps([value]) == b'[3.5]'
+
+
+def test_compareValues():
+    assert compareValues(21, 'eq', '21')
+    assert compareValues(21.0, 'eq', '21')
+    assert compareValues('CMU', 'eq', 'CMU')
+    assert not compareValues('CMU', 'eq', 'NYU')
+    assert compareValues(float('nan'), 'eq', 'nan')
+    assert compareValues(12, 'gt', '10')
+    assert not compareValues('12', 'lt', '10')
+    assert compareValues('CMU', 'lt', '10') is None
+
+
+def test_ValueColumn():
+    ints = ValueColumn([1, 2, 3, 4])
+    assert ints.kind == ValueColumn.INT
+    assert ints.values.dtype == np.int64
+    assert ints.stats()['mean'] == 2.5
+    assert list(ints.compare('gt', '2')) == [False, False, True, True]
+    assert ints.strings() == ['1', '2', '3', '4']
+
+    floats = ValueColumn([1.5, None, '2.5', 'nan'])
+    assert floats.kind == ValueColumn.FLOAT
+    assert list(floats.missing()) == [False, True, False, True]
+    stats = floats.stats()
+    assert stats['min'] == 1.5 and stats['max'] == 2.5 and stats['median'] == 2.0
+    assert list(floats.compare('lt', 2)) == [True, False, False, False]
+
+    categories = ValueColumn(['CMU', 'NYU', 'CMU', ''])
+    assert categories.kind == ValueColumn.CATEGORY
+    assert categories.values.dtype == np.int32
+    assert categories.categories == ['CMU', 'NYU']
+    assert list(categories.compare('eq', 'CMU')) == [True, False, True, False]
+    assert categories.stats()['mean'] is None
+    assert categories.strings() == ['CMU', 'NYU', 'CMU', '']
+
+    from_csv = ValueColumn(['7', '8', ' 9'])
+    assert from_csv.kind == ValueColumn.INT
+    assert str(from_csv.toPandas().dtype) == 'int64'
+    assert str(categories.toPandas().dtype) == 'category'
+
+    empty = ValueColumn([])
+    assert empty.stats()['max'] is None
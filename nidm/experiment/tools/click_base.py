@@ -1,5 +1,64 @@
+import sys
+import importlib
 import click
 
-@click.group()
+
+class LazyGroup(click.Group):
+    '''
+    A click group whose commands can be registered by module name: the module (and everything it
+    imports) is only loaded when its command runs or its full help is shown.  The modules define
+    their commands with @cli.command() as usual.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = {}
+
+    def addLazyCommand(self, name, module, short_help):
+        '''
+        :param name: command name
+        :param module: dotted name of the module defining the command
+        :param short_help: the help shown in the command list, so listing doesn't import the module
+        '''
+        self.lazy_commands[name] = (module, short_help)
+
+    def list_commands(self, ctx):
+        return sorted(set(self.commands) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            importlib.import_module(self.lazy_commands[cmd_name][0])
+        return self.commands.get(cmd_name)
+
+    def format_commands(self, ctx, formatter):
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.commands:
+                command = self.commands[name]
+                if command.hidden:
+                    continue
+                rows.append((name, command.get_short_help_str(formatter.width - 6 - len(name))))
+            else:
+                rows.append((name, self.lazy_commands[name][1]))
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+
+@click.group(cls=LazyGroup)
 def cli():
     pass
+
+
+def main():
+    '''
+    The pynidm entry point.  `pynidm query ...` is handed to a running query daemon, if there is
+    one, before any of the commands are imported (see query_daemon).
+    '''
+    from nidm.experiment.tools import query_daemon
+    status = query_daemon.forward(sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+
+    from nidm.experiment.tools.click_main import cli as pynidm
+    pynidm()
@@ -1,7 +1,11 @@
 import click
 from nidm.experiment.tools.click_base import cli
-from nidm.experiment.tools import nidm_query
-from nidm.experiment.tools import nidm_visualize
-from nidm.experiment.tools import nidm_concat
-from nidm.experiment.tools import nidm_merge
-from nidm.experiment.tools import nidm_convert
+
+# the commands' modules are imported when the command runs, see LazyGroup
+cli.addLazyCommand('query', 'nidm.experiment.tools.nidm_query', 'This function provides query support for NIDM graphs.')
+cli.addLazyCommand('visualize', 'nidm.experiment.tools.nidm_visualize', 'This command will produce a visualization(pdf) of the supplied...')
+cli.addLazyCommand('concat', 'nidm.experiment.tools.nidm_concat', 'This function will concatenate NIDM files.')
+cli.addLazyCommand('merge', 'nidm.experiment.tools.nidm_merge', 'This function will merge NIDM files.')
+cli.addLazyCommand('convert', 'nidm.experiment.tools.nidm_convert', 'This function will convert NIDM files to various RDF-supported...')
+cli.addLazyCommand('search', 'nidm.experiment.tools.nidm_search', 'This function searches the data elements of NIDM files.')
+cli.addLazyCommand('serve', 'nidm.experiment.tools.nidm_serve', 'This function serves the PyNIDM REST API over HTTP.')
@@ -34,7 +34,7 @@ from nidm.experiment import Project,Session,AssessmentAcquisition,AssessmentObje
 from nidm.core import Constants
 from nidm.experiment.Utils import read_nidm, map_variables_to_terms, add_attributes_with_cde, addGitAnnexSources, \
     redcap_datadictionary_to_json
-from nidm.experiment.Query import GetParticipantIDs
+from nidm.experiment.SubjectIndex import getSubjectIndex, indexDataFrame, normalizeSubjectID
 
 from argparse import ArgumentParser
 from os.path import  dirname, join, splitext,basename
@@ -127,8 +127,8 @@ def main(argv):
     #If user has added an existing NIDM file as a command line parameter then add to existing file for subjects who exist in the NIDM file
     if args.nidm_file:
         print("Adding to NIDM file...")
-        # get subjectID list for later
-        qres = GetParticipantIDs([args.nidm_file])
+        # get subjectID -> agent UUID index for later
+        subject_index = getSubjectIndex([args.nidm_file])
 
         #read in NIDM file
         project = read_nidm(args.nidm_file)
@@ -192,16 +192,19 @@ def main(argv):
 
 
 
-        for index,row in qres.iterrows():
-            logging.info("participant in NIDM file %s \t %s" %(row[0],row[1]))
+        # index the CSV subject ID column once so finding each participant's row is a dict lookup
+        csv_subjects = indexDataFrame(df, id_field)
+
+        for participant in subject_index.subjects(args.nidm_file):
+            logging.info("participant in NIDM file %s \t %s" %(participant.uuid,participant.subject_id))
             #find row in CSV file with subject id matching agent from NIDM file
 
             #csv_row = df.loc[df[id_field]==type(df[id_field][0])(row[1])]
             #find row in CSV file with matching subject id to the agent in the NIDM file
             #be carefull about data types...simply type-change dataframe subject id column and query to strings.
-            #here we're removing the leading 0's from IDs because pandas.read_csv strips those unless you know ahead of
-            #time which column is the subject id....
-            csv_row = df.loc[df[id_field].astype('str').str.contains(str(row[1]).lstrip("0"))]
+            #here we're matching on normalized IDs (no leading 0's or sub- prefix) because pandas.read_csv strips those
+            #unless you know ahead of time which column is the subject id....
+            csv_row = df.loc[csv_subjects.get(normalizeSubjectID(participant.subject_id), [])]
 
             #if there was data about this subject in the NIDM file already (i.e. an agent already exists with this subject id)
             #then add this CSV assessment data to NIDM file, else skip it....
@@ -228,7 +231,7 @@ def main(argv):
                 #add acquisition entity for assessment
                 acq_entity = AssessmentObject(acquisition=acq)
                 #add qualified association with existing agent
-                acq.add_qualified_association(person=row[0],role=Constants.NIDM_PARTICIPANT)
+                acq.add_qualified_association(person=participant.uuid,role=Constants.NIDM_PARTICIPANT)
 
                 # add git-annex info if exists
                 num_sources = addGitAnnexSources(obj=acq_entity,filepath=args.csv_file,bids_root=dirname(args.csv_file))
@@ -36,6 +36,7 @@ from rdflib import Graph,util
 from rdflib.tools import rdf2dot
 from nidm.experiment.Utils import read_nidm
 from nidm.experiment.Query import GetMergedGraph
+from nidm.experiment.tools import rdf_stream
 from io import StringIO
 from os.path import basename,splitext
 import subprocess
@@ -51,14 +52,21 @@ from nidm.experiment.tools.click_base import cli
               help="A comma separated list of NIDM files with full path")
 @click.option("--out_file", "-o",  required=True,
               help="File to write concatenated NIDM files")
+@click.option("--stream", is_flag=True,
+              help="Write the files one at a time instead of combining them in memory first, N-Triples (.nt) "
+                   "and N-Quads (.nq) output files are always streamed")
 
 
-def concat(nidm_file_list, out_file):
+def concat(nidm_file_list, out_file, stream):
     """
     This function will concatenate NIDM files.  Warning, no merging will be done so you may end up with
     multiple prov:agents with the same subject id if you're concatenating NIDM files from multiple vists of the
     same study.  If you want to merge NIDM files on subject ID see pynidm merge
     """
+    if stream or rdf_stream.streamFormat(out_file) != 'turtle':
+        # only one input file is in memory at a time, see rdf_stream
+        rdf_stream.concatFiles(nidm_file_list.split(','), out_file)
+        return
     #create empty graph
     graph = GetMergedGraph(nidm_file_list.split(','))
     graph.serialize(out_file, format='turtle')
@@ -25,8 +25,8 @@
 #
 #**************************************************************************************
 # Programmer comments:
-#
-#
+#   nt and nquads are written in batches with rdf_stream, --jobs converts the files in a
+#   process pool (tools.parallel, the same one nidm_query --get_fields uses)
 #**************************************************************************************
 #**************************************************************************************
 
@@ -42,62 +42,131 @@ import subprocess
 from graphviz import Source
 import tempfile
 
+import gzip
+import functools
+
 import click
 from nidm.experiment.tools.click_base import cli
+from nidm.experiment.tools.parallel import mapFiles
+from nidm.experiment.tools import rdf_stream
+
+# file extension of each output type
+EXTENSIONS = {'turtle': '.ttl', 'jsonld': '.json', 'xml-rdf': '.xml', 'n3': '.n3', 'trig': '.trig',
+              'nt': '.nt', 'nquads': '.nq'}
+# output types written triple batch by triple batch instead of from a whole graph
+STREAMED_TYPES = ['nt', 'nquads']
 
 # adding click argument parsing
 @cli.command()
 @click.option("--nidm_file_list", "-nl", required=True,
               help="A comma separated list of NIDM files with full path")
-@click.option("--type", "-t", required=True,type=click.Choice(['turtle', 'jsonld', 'xml-rdf','n3','trig'], case_sensitive=False),
+@click.option("--type", "-t", required=True,type=click.Choice(['turtle', 'jsonld', 'xml-rdf','n3','trig','nt','nquads'], case_sensitive=False),
               help="If parameter set then NIDM file will be exported as JSONLD")
 @click.option("--outdir", "-out", required=False,
               help="Optional directory to save converted NIDM file")
+@click.option("--fast", is_flag=True, default=False,
+              help="Convert turtle, jsonld and trig straight with rdflib instead of reading the files into the NIDM object model first")
+@click.option("--gzip", "compress", is_flag=True, default=False,
+              help="Write gzip compressed files (.gz is added to the file names)")
+@click.option("--jobs", required=False, type=int, default=1,
+              help="Number of processes converting files in parallel, 1 is default")
 
 
 
-def convert(nidm_file_list, type,outdir):
+def convert(nidm_file_list, type, outdir, fast, compress, jobs):
     """
     This function will convert NIDM files to various RDF-supported formats and name then / put them in the same
     place as the input file.
     """
+    if jobs < 1:
+        raise click.BadParameter("must be at least 1", param_hint="--jobs")
 
-    for nidm_file in nidm_file_list.split(','):
-        # WIP: for now we use pynidm for jsonld exports to make more human readable and rdflib for everything
-        # else.
-        if outdir:
-            outfile = join(outdir,splitext(basename(nidm_file))[0])
-        else:
-            outfile = join(splitext(nidm_file)[0])
+    nidm_files = nidm_file_list.split(',')
+    if type.lower() in STREAMED_TYPES:
+        for nidm_file in nidm_files:
+            if overwritesInput(nidm_file, outputFile(nidm_file, type.lower(), outdir, compress)):
+                raise click.BadParameter("{} is already {}, it would be overwritten".format(nidm_file, type), param_hint="--type")
+    for outfile in mapFiles(functools.partial(convertFile, type=type.lower(), outdir=outdir, fast=fast, compress=compress),
+                            nidm_files, jobs):
+        if outfile is None:
+            print("Error, type is not supported at this time")
+
+
+def outputFile(nidm_file, type, outdir=None, compress=False):
+    '''
+    The name convertFile writes a NIDM file converted to type to
+    '''
+    if outdir:
+        outfile = join(outdir,splitext(basename(nidm_file))[0])
+    else:
+        outfile = join(splitext(nidm_file)[0])
+    return outfile + EXTENSIONS[type] + (".gz" if compress else "")
 
+
+def overwritesInput(nidm_file, outfile):
+    return os.path.exists(outfile) and os.path.samefile(nidm_file, outfile)
+
+
+def convertFile(nidm_file, type, outdir=None, fast=False, compress=False):
+    '''
+    Converts one NIDM file.  The output is written to a temporary file that replaces the output file
+    once it is complete, so converting a file to its own format (e.g. turtle a.ttl) doesn't truncate
+    the input before it is read.
+
+    :param nidm_file: NIDM file in any RDF format rdflib can guess from the file name
+    :param type: one of the --type choices
+    :param outdir: directory to write to, the input file's directory if None
+    :param fast: use rdflib for turtle, jsonld and trig too
+    :param compress: gzip the output
+    :return: the name of the file written or None if the type isn't supported
+    '''
+    if type not in EXTENSIONS:
+        return None
+    # WIP: for now we use pynidm for jsonld exports to make more human readable and rdflib for everything
+    # else.
+    outfile = outputFile(nidm_file, type, outdir, compress)
+    if type in STREAMED_TYPES and overwritesInput(nidm_file, outfile):
+        # nothing to convert
+        raise ValueError("{} is already {}".format(nidm_file, type))
+
+    # next to the output file so the replace doesn't cross file systems
+    tmp_file = "{}.{}.tmp".format(outfile, os.getpid())
+    try:
+        with (gzip.open(tmp_file, 'xb') if compress else open(tmp_file, 'xb')) as out:
+            writeConverted(nidm_file, type, fast, out)
+        os.replace(tmp_file, outfile)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+    return outfile
+
+
+def writeConverted(nidm_file, type, fast, out):
+    '''
+    Writes nidm_file converted to type to the open binary file out
+    '''
+    if type in STREAMED_TYPES:
+        # no whole graph is serialized, N-Triples input is not even parsed into one
+        writer = rdf_stream.StreamWriter(out, type)
+        writer.startFile(nidm_file)
+        rdf_stream.readTriples(nidm_file, writer.add)
+        writer.flush()
+    elif type in ['jsonld', 'turtle', 'trig'] and not fast:
+        # read in nidm file
+        project = read_nidm(nidm_file)
         if type == 'jsonld':
-            # read in nidm file
-            project = read_nidm(nidm_file)
-            #write jsonld file with same name
-            with open(outfile + ".json", 'w') as f:
-                f.write(project.serializeJSONLD())
+            text = project.serializeJSONLD()
         elif type == 'turtle':
-            #graph = Graph()
-            #graph.parse(nidm_file, format=util.guess_format(nidm_file))
-            #graph.serialize(splitext(nidm_file)[0] + ".ttl", format='turtle')
-            project = read_nidm(nidm_file)
-            with open(outfile + ".ttl", 'w') as f:
-                f.write(project.serializeTurtle())
-        elif type == 'xml-rdf':
-            graph = Graph()
-            graph.parse(nidm_file, format=util.guess_format(nidm_file))
-            graph.serialize(outfile + ".xml", format='pretty-xml')
-        elif type == 'n3':
-            graph = Graph()
-            graph.parse(nidm_file, format=util.guess_format(nidm_file))
-            graph.serialize(outfile + ".n3", format='n3')
-        elif type == 'trig':
-            # read in nidm file
-            project = read_nidm(nidm_file)
-            with open(outfile + ".trig", 'w') as f:
-                f.write(project.serializeTrig())
+            text = project.serializeTurtle()
         else:
-            print("Error, type is not supported at this time")
+            text = project.serializeTrig()
+        out.write(text.encode('utf-8'))
+    else:
+        graph = Graph()
+        graph.parse(nidm_file, format=util.guess_format(nidm_file))
+        rdf_format = {'xml-rdf': 'pretty-xml', 'jsonld': 'json-ld'}.get(type, type)
+        out.write(graph.serialize(format=rdf_format, encoding='utf-8'))
 
 
 if __name__ == "__main__":
@@ -25,8 +25,8 @@
 #
 #**************************************************************************************
 # Programmer comments:
-#
-#
+#   Merging by subject ID maps agent UUIDs to one UUID per subject ID with the SubjectIndex and
+#   renames them while streaming the triples out (see rdf_stream.concatFiles)
 #**************************************************************************************
 #**************************************************************************************
 
@@ -35,7 +35,8 @@ from argparse import ArgumentParser
 from rdflib import Graph,util
 from rdflib.tools import rdf2dot
 from nidm.experiment.Utils import read_nidm
-from nidm.experiment.Query import GetParticipantIDs
+from nidm.experiment.SubjectIndex import getSubjectIndex
+from nidm.experiment.tools import rdf_stream
 from nidm.core import Constants
 from io import StringIO
 from os.path import basename,splitext
@@ -60,94 +61,18 @@ def merge(nidm_file_list, s,out_file):
     This function will merge NIDM files.  See command line parameters for supported merge operations.
     """
 
-    #graph = Graph()
-    #for nidm_file in nidm_file_list.split(','):
-    #    graph.parse(nidm_file,format=util.guess_format(nidm_file))
-
-    # create empty graph
-    graph=Graph()
-    # start with the first NIDM file and merge the rest into the first
-    first=True
-    for nidm_file in nidm_file_list.split(','):
-        # if merging by subject:
-        if s:
-            if first:
-                # get list of all subject IDs
-                first_file_subjids = GetParticipantIDs([nidm_file])
-                first = False
-                first_graph = Graph()
-                first_graph.parse(nidm_file,format=util.guess_format(nidm_file))
-            else:
-                # load second graph
-                graph.parse(nidm_file,format=util.guess_format(nidm_file))
-
-                # get list of second file subject IDs
-                subj = GetParticipantIDs([nidm_file])
-
-                # for each UUID / subject ID look in graph and see if you can find the same ID.  If so get the UUID of
-                # that prov:agent and change all the UUIDs in nidm_file to match then concatenate the two graphs.
-                query = '''
-
-                    PREFIX prov:<http://www.w3.org/ns/prov#>
-                    PREFIX sio: <http://semanticscience.org/ontology/sio.owl#>
-                    PREFIX ndar: <https://ndar.nih.gov/api/datadictionary/v2/dataelement/>
-                    PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-                    PREFIX prov:<http://www.w3.org/ns/prov#>
-
-                    SELECT DISTINCT ?uuid ?ID
-                    WHERE {
-
-                        ?uuid a prov:Agent ;
-                            %s ?ID .
-                    FILTER(?ID =
-                    ''' % Constants.NIDM_SUBJECTID
-
-                # add filters to above query to only look for subject IDs which are in the first file to merge into
-                temp=True
-                for ID in first_file_subjids['ID']:
-                    if temp:
-                        query = query + "\"" + ID + "\""
-                        temp = False
-                    else:
-                        query = query + "|| ?ID= \"" + ID + "\""
-
-                query = query + ") }"
-
-                qres = graph.query(query)
-
-                # if len(qres) > 0 then we have matches so load the nidm_file into a temporary graph so we can
-                # make changes to it then concatenate it.
-                if len(qres) > 0:
-                    #tmp = Graph()
-                    #tmp.parse(nidm_file,format=util.guess_format(nidm_file))
-
-                    # for each ID in the merged graph that matches an ID in the nidm_file graph
-                    for row in qres:
-                        # find ID from first file that matches ID in this file
-                        t=first_file_subjids['ID'].str.match(row['ID'])
-                        # then get uuid for that match from first file
-                        uuid_replacement = first_file_subjids.iloc[ [*filter(t.get,t.index)][0],0]
-
-                        for s,p,o in graph.triples((None,None,None)):
-                            if (s == row['uuid']):
-                                #print("replacing subject in triple %s %s %s with %s" %(s,p,o,uuid_to_replace))
-                                graph.add((uuid_replacement,p,o))
-                                graph.remove((row['uuid'],p,o))
-                            elif (o == row['uuid']):
-                                #print("replacing object in triple %s %s %s with %s" %(s,p,o,uuid_to_replace))
-                                graph.add((s,p,uuid_replacement))
-                                graph.remove((s,p,row['uuid']))
-                            elif (p == row['uuid']):
-                                #print("replacing predicate in triple %s %s %s with %s" %(s,p,o,uuid_to_replace))
-                                graph.add((s,uuid_replacement,o))
-                                graph.remove((s,row['uuid'],o))
-
-                # merge updated graph
-
-                graph = first_graph + graph
-
-        graph.serialize(out_file, format='turtle')
-
+    nidm_files = nidm_file_list.split(',')
+    remap = {}
+    if s:
+        # hash join of the subject IDs of all files: an agent whose subject ID was already seen in an
+        # earlier file gets the UUID of that file's agent.  Agents of the same file are never merged,
+        # and where either file has several agents with the ID only agents sharing a project are
+        # merged (see SubjectIndex.canonicalUUIDs)
+        remap = getSubjectIndex(nidm_files).canonicalUUIDs(nidm_files)
+
+    # one pass over the triples of each file, renaming the merged agents as they go by.  The
+    # output format follows the file extension (.nt, .nq, anything else is Turtle)
+    rdf_stream.concatFiles(nidm_files, out_file, remap=remap)
 
 
 if __name__ == "__main__":
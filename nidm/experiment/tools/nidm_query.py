@@ -32,25 +32,31 @@
 #**************************************************************************************
 
 import os, sys
+import functools
 from rdflib import Graph, util
 import pandas as pd
 from argparse import ArgumentParser
 import logging
 import csv
-from nidm.experiment.Query import sparql_query_nidm, GetParticipantIDs,GetProjectInstruments,GetProjectsUUID,GetInstrumentVariables,GetDataElements,GetBrainVolumes,GetBrainVolumeDataElements,getCDEs
+from nidm.experiment.Query import sparql_query_nidm, GetParticipantIDs,GetProjectsUUID,GetDataElements,GetBrainVolumes,GetBrainVolumeDataElements,getCDEs
 import click
-from click_option_group import optgroup, RequiredMutuallyExclusiveOptionGroup
+from click_option_group import optgroup, MutuallyExclusiveOptionGroup
 from nidm.experiment.tools.click_base import cli
 from nidm.experiment.tools.rest import RestParser
+from nidm.experiment.tools import rest_tables, query_daemon
+from nidm.experiment.tools.parallel import mapFiles
+from nidm.experiment.Instrumentation import trace
+from nidm.experiment import Navigate, FileCache
+from nidm.core import Constants
 from json import dumps, loads
 
 
 @cli.command()
-@click.option("--nidm_file_list", "-nl", required=True,
+@click.option("--nidm_file_list", "-nl", required=False,
               help="A comma separated list of NIDM files with full path")
 @click.option("--cde_file_list", "-nc", required=False,
               help="A comma separated list of NIDM CDE files with full path. Can also be set in the CDE_DIR environment variable")
-@optgroup.group('Query Type',help='Pick among the following query type selections',cls=RequiredMutuallyExclusiveOptionGroup)
+@optgroup.group('Query Type',help='Pick among the following query type selections',cls=MutuallyExclusiveOptionGroup)
 @optgroup.option("--query_file", "-q", type=click.File('r'),
               help="Text file containing a SPARQL query to execute")
 @optgroup.option("--get_participants", "-p", is_flag=True,
@@ -69,16 +75,63 @@ from json import dumps, loads
               help="This parameter will return data for only the field names in the comma separated list (e.g. -gf age,fs_00003) from all nidm files supplied")
 @optgroup.option("--uri", "-u",
               help="A REST API URI query")
+@click.option("--jobs", required=False, type=int, default=1,
+              help="Number of processes extracting --get_fields from the NIDM files in parallel, 1 is default")
 @click.option("--output_file", "-o", required=False,
-              help="Optional output file (CSV) to store results of query")
+              help="Optional output file to store results of query, CSV unless it ends in .parquet or .arrow")
 @click.option("-j/-no_j", required=False, default=False,
               help="Return result of a uri query as JSON")
 @click.option('-v', '--verbosity', required=False, help="Verbosity level 0-5, 0 is default", default="0")
+@click.option("--explain", required=False, is_flag=True,
+              help="Print a breakdown of where the query time went (per function timings, cache hits, stages)")
+@click.option("--trace_file", required=False,
+              help="Optional file to write the full JSON timing trace of the query to")
+@click.option("--daemon", required=False, is_flag=True,
+              help="Keep running and answer later pynidm query calls with warm graphs (the -nl files are loaded up front)")
+@click.option("--stop_daemon", required=False, is_flag=True,
+              help="Stop a running query daemon")
+@click.option("--socket", "socket_path", required=False,
+              help="Unix socket of the query daemon, defaults to $PYNIDM_QUERY_SOCKET or one in $XDG_RUNTIME_DIR or a private directory of the temp directory")
+@click.option("--idle_timeout", required=False, type=float,
+              help="Seconds without a query after which the daemon exits")
 
-def query(nidm_file_list, cde_file_list, query_file, output_file, get_participants, get_instruments, get_instrument_vars, get_dataelements, get_brainvols,get_dataelements_brainvols, get_fields, uri, j, verbosity):
+def query(nidm_file_list, cde_file_list, query_file, output_file, get_participants, get_instruments, get_instrument_vars, get_dataelements, get_brainvols,get_dataelements_brainvols, get_fields, uri, j, verbosity, explain, trace_file, daemon, stop_daemon, socket_path, idle_timeout, jobs):
     """
     This function provides query support for NIDM graphs.
     """
+    if stop_daemon:
+        if not query_daemon.stop(socket_path):
+            raise click.ClickException("No query daemon is running")
+        return
+
+    if daemon:
+        if cde_file_list:
+            getCDEs(cde_file_list.split(","))
+        query_daemon.serve(socket_path, nidm_file_list.split(',') if nidm_file_list else [], idle_timeout, int(verbosity))
+        return
+
+    if not nidm_file_list:
+        raise click.UsageError("Missing option '--nidm_file_list' / '-nl'.")
+    if not any([query_file, get_participants, get_instruments, get_instrument_vars, get_dataelements, get_dataelements_brainvols, get_brainvols, get_fields, uri]):
+        raise click.UsageError("Missing one of the Query Type options, see --help.")
+
+    if jobs < 1:
+        raise click.BadParameter("must be at least 1", param_hint="--jobs")
+
+    if explain or trace_file:
+        # the files are only checked for changes once per query
+        with trace(trace_file) as t, FileCache.VersionSnapshot():
+            result = runQuery(nidm_file_list, cde_file_list, query_file, output_file, get_participants, get_instruments, get_instrument_vars, get_dataelements, get_brainvols,get_dataelements_brainvols, get_fields, uri, j, verbosity, jobs)
+        if explain:
+            print()
+            print(t.report())
+        return result
+
+    with FileCache.VersionSnapshot():
+        return runQuery(nidm_file_list, cde_file_list, query_file, output_file, get_participants, get_instruments, get_instrument_vars, get_dataelements, get_brainvols,get_dataelements_brainvols, get_fields, uri, j, verbosity, jobs)
+
+
+def runQuery(nidm_file_list, cde_file_list, query_file, output_file, get_participants, get_instruments, get_instrument_vars, get_dataelements, get_brainvols,get_dataelements_brainvols, get_fields, uri, j, verbosity, jobs=1):
     #query result list
     results = []
 
@@ -94,39 +147,9 @@ def query(nidm_file_list, cde_file_list, query_file, output_file, get_participan
 
 
         return df
-    elif get_instruments:
-        #first get all project UUIDs then iterate and get instruments adding to output dataframe
-        project_list = GetProjectsUUID(nidm_file_list.split(','))
-        count=1
-        for project in project_list:
-            if count == 1:
-                df = GetProjectInstruments(nidm_file_list.split(','),project_id=project)
-                count+=1
-            else:
-                df = df.append(GetProjectInstruments(nidm_file_list.split(','),project_id=project))
-
-        #write dataframe
-        #if output file parameter specified
-        if (output_file is not None):
-
-            df.to_csv(output_file)
-            #with open(output_file,'w') as myfile:
-            #    wr=csv.writer(myfile,quoting=csv.QUOTE_ALL)
-            #    wr.writerow(df)
-
-            #pd.DataFrame.from_records(df,columns=["Instruments"]).to_csv(output_file)
-        else:
-            print(df.to_string())
-    elif get_instrument_vars:
-        #first get all project UUIDs then iterate and get instruments adding to output dataframe
-        project_list = GetProjectsUUID(nidm_file_list.split(','))
-        count=1
-        for project in project_list:
-            if count == 1:
-                df = GetInstrumentVariables(nidm_file_list.split(','),project_id=project)
-                count+=1
-            else:
-                df = df.append(GetInstrumentVariables(nidm_file_list.split(','),project_id=project))
+    elif get_instruments or get_instrument_vars:
+        # every project's instruments (and variables) come from the instrument catalog
+        df = instrumentCatalog(nidm_file_list.split(','), variables=bool(get_instrument_vars))
 
         #write dataframe
         #if output file parameter specified
@@ -145,43 +168,53 @@ def query(nidm_file_list, cde_file_list, query_file, output_file, get_participan
             print(datael.to_string())
     elif get_fields:
         # fields only query.  We'll do it with the rest api
-        restParser = RestParser(verbosity_level=int(verbosity))
-        if (output_file is not None):
-            restParser.setOutputFormat(RestParser.OBJECT_FORMAT)
-            df_list = []
-        else:
-            restParser.setOutputFormat(RestParser.CLI_FORMAT)
-        # set up uri to do fields query for each nidm file
-        for nidm_file in nidm_file_list.split(","):
-            # get project UUID
-            project = GetProjectsUUID([nidm_file])
-            uri = "/projects/" +  project[0].toPython().split("/")[-1] + "?fields=" + get_fields
-            # get fields output from each file and concatenate
-            if (output_file is None):
-                # just print results
-                print(restParser.run([nidm_file], uri))
-            else:
-                df_list.append(pd.DataFrame(restParser.run([nidm_file], uri)))
+        output_format = RestParser.CLI_FORMAT if output_file is None else RestParser.OBJECT_FORMAT
+        results = mapFiles(functools.partial(getFieldsForFile, fields=get_fields, verbosity=int(verbosity), output_format=output_format),
+                           nidm_file_list.split(","), jobs, cde_file_list)
 
-        if (output_file is not None):
-            # concatenate data frames
-            df = pd.concat(df_list)
-            # output to csv file
-            df.to_csv(output_file)
+        if (output_file is None):
+            # just print results, file by file as they come in
+            for result in results:
+                print(result)
+        elif rest_tables.writerForFile(output_file):
+            # one row per value (see rest_tables.fieldValuesDataFrame), written in one piece with a
+            # single schema whose column types depend on all the values, so every file is needed first
+            writeTable([value for result in results for value in result], output_file)
+        else:
+            # append each file's rows to the csv file, same as concatenating the data frames
+            columns = None
+            for result in results:
+                if len(result) == 0:
+                    continue
+                df = pd.DataFrame(result)
+                if columns is None:
+                    columns = list(df.columns)
+                    df.to_csv(output_file)
+                else:
+                    df.reindex(columns=columns).to_csv(output_file, mode='a', header=False)
+            if columns is None:
+                pd.DataFrame().to_csv(output_file)
 
     elif uri:
         restParser = RestParser(verbosity_level = int(verbosity))
         if j:
             restParser.setOutputFormat(RestParser.JSON_FORMAT)
+            # indent the JSON printed to the terminal
+            restParser.pretty = output_file is None
         elif (output_file is not None):
             restParser.setOutputFormat(RestParser.OBJECT_FORMAT)
         else:
             restParser.setOutputFormat(RestParser.CLI_FORMAT)
         df = restParser.run(nidm_file_list.split(','), uri)
+        if restParser.truncated:
+            click.echo("Partial result, the query's {} limit was reached".format(restParser.truncated), err=True)
         if (output_file is not None):
             if j:
+                # df is already JSON text
                 with open(output_file,"w+") as f:
-                    f.write(dumps(df))
+                    f.write(df)
+            elif rest_tables.writerForFile(output_file):
+                writeTable(df, output_file)
             else:
                 # convert object df to dataframe and output
                 pd.DataFrame(df).to_csv(output_file)
@@ -220,6 +253,49 @@ def query(nidm_file_list, cde_file_list, query_file, output_file, get_participan
         exit(1)
 
 
+def instrumentCatalog(nidm_files, variables=False):
+    '''
+    The --get_instruments / --get_instrument_vars table, one row per project and instrument type
+    (and variable) with the number of instruments, see Navigate.getInstrumentCatalog
+
+    :return: DataFrame
+    '''
+    columns = ['project', 'project_title', 'assessment_type'] + (['variables'] if variables else []) + ['count']
+    rows = []
+    for row in Navigate.getInstrumentCatalog(tuple(nidm_files)):
+        if (row.variable is not None) == variables:
+            values = [row.project.replace(Constants.NIIRI, ''), row.project_title, row.instrument]
+            rows.append(values + ([row.variable] if variables else []) + [row.count])
+    return pd.DataFrame(rows, columns=columns)
+
+
+def getFieldsForFile(nidm_file, fields, verbosity, output_format):
+    '''
+    Runs the --get_fields query on one NIDM file
+
+    :return: the RestParser result in output_format
+    '''
+    restParser = RestParser(verbosity_level=verbosity)
+    restParser.setOutputFormat(output_format)
+    # get project UUID
+    project = GetProjectsUUID([nidm_file])
+    uri = "/projects/" +  str(project[0]).split("/")[-1] + "?fields=" + fields
+    return restParser.run([nidm_file], uri)
+
+
+def writeTable(result, output_file):
+    '''
+    Writes a RestParser object format result as a Parquet or Arrow file with typed columns
+    '''
+    writer = rest_tables.writerForFile(output_file)
+    try:
+        data = writer(rest_tables.resultToDataFrame(result))
+    except rest_tables.TableFormatError as e:
+        raise click.ClickException(str(e))
+    with open(output_file, "wb") as f:
+        f.write(data)
+
+
 # it can be used calling the script `python nidm_query.py -nl ... -q ..
 if __name__ == "__main__":
     query()
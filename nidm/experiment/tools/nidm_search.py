@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#**************************************************************************************
+#**************************************************************************************
+#  nidm_search.py
+#  License: GPL
+#**************************************************************************************
+#**************************************************************************************
+# Filename: nidm_search.py
+#
+# Program description:  Searches the data elements of NIDM files and the CDEs by their
+#   labels, descriptions, source variables and concepts
+#
+#**************************************************************************************
+# System requirements:  Python 3.X
+# Libraries: click, pandas, tabulate
+#**************************************************************************************
+# Programmer comments:
+#   The ranking and the fuzzy matching of misspelled words are in nidm.experiment.SearchIndex,
+#   the same index answers the REST /search?q= route.
+#
+#**************************************************************************************
+#**************************************************************************************
+
+import click
+import pandas as pd
+from tabulate import tabulate
+from nidm.experiment.tools.click_base import cli
+from nidm.experiment.Query import getCDEFileList
+from nidm.experiment import SearchIndex
+from nidm.experiment.tools import rest_json
+
+
+@cli.command()
+@click.option("--nidm_file_list", "-nl", required=True,
+              help="A comma separated list of NIDM files with full path")
+@click.option("--cde_file_list", "-nc", required=False,
+              help="A comma separated list of NIDM CDE files with full path. Can also be set in the CDE_DIR environment variable")
+@click.option("--query", "-q", "words", required=True,
+              help="Words to search the data element labels, descriptions, source variables and concepts for")
+@click.option("--limit", "-n", required=False, default=10, type=int, show_default=True,
+              help="Number of data elements to return")
+@click.option("--cdes/--no_cdes", default=True, show_default=True,
+              help="Also search the common data elements (FreeSurfer, FSL and ANTS measures)")
+@click.option("-j/-no_j", default=False, help="Return the results as JSON")
+@click.option("--output_file", "-o", required=False,
+              help="Optional output file (CSV) to store the results")
+def search(nidm_file_list, cde_file_list, words, limit, cdes, j, output_file):
+    """
+    This function searches the data elements of NIDM files.
+    """
+    if limit < 1:
+        raise click.BadParameter("must be at least 1", param_hint="--limit")
+
+    files = tuple(nidm_file_list.split(','))
+    if cdes:
+        files += tuple(getCDEFileList(cde_file_list.split(',') if cde_file_list else None))
+    results = SearchIndex.getSearchIndex(files).search(words, limit=limit)
+
+    if output_file is not None:
+        pd.DataFrame([searchRecord(r) for r in results], columns=SearchIndex.SearchResult._fields).to_csv(output_file)
+    elif j:
+        print(rest_json.dumpsText([searchRecord(r, flat=False) for r in results], pretty=True))
+    else:
+        print(tabulate([[r.score, r.label, r.uri, r.source_variable, ", ".join(r.concepts)] for r in results],
+                       headers=['score', 'label', 'uri', 'source variable', 'concepts']))
+
+
+def searchRecord(result, flat=True):
+    '''
+    A SearchResult as a dict, with the concepts and sources joined into one string if flat
+    '''
+    record = result._asdict()
+    for key in ['concepts', 'sources']:
+        record[key] = ", ".join(record[key]) if flat else list(record[key])
+    return record
+
+
+# it can be used calling the script `python nidm_search.py -nl ... -q ..
+if __name__ == "__main__":
+    search()
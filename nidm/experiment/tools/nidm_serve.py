@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#**************************************************************************************
+#**************************************************************************************
+#  nidm_serve.py
+#  License: GPL
+#**************************************************************************************
+#**************************************************************************************
+# Filename: nidm_serve.py
+#
+# Program description:  Runs the PyNIDM REST API server over a set of NIDM files
+#
+#**************************************************************************************
+# System requirements:  Python 3.X
+# Libraries: os, click, wsgiref
+#**************************************************************************************
+# Programmer comments:
+#   The files are loaded once before the workers are forked so every worker shares the
+#   parsed graphs.  GET /health reports ready once loading is complete.
+#   --mode async serves on an asyncio event loop with the queries run in a process pool.
+#   --dataset NAME=PATH serves several datasets under /datasets/NAME/ instead of one file list.
+#   --timeout, --max_rows and --max_subjects bound every query, a query also stops when its
+#   client disconnects.
+#
+#**************************************************************************************
+#**************************************************************************************
+
+import click
+from nidm.experiment.tools.click_base import cli
+from nidm.experiment.tools import rest_server, rest_datasets
+
+
+@cli.command()
+@click.option("--nidm_file_list", "-nl", required=False,
+              help="A comma separated list of NIDM files with full path")
+@click.option("--nidm_dir", "-d", required=False,
+              help="A directory that will be searched recursively for NIDM .ttl files")
+@click.option("--host", required=False, default="0.0.0.0", show_default=True,
+              help="Address to listen on")
+@click.option("--port", "-p", required=False, default=5000, type=int, show_default=True,
+              help="Port to listen on")
+@click.option("--workers", "-w", required=False, default=1, type=int, show_default=True,
+              help="Number of worker processes forked after the NIDM files are loaded")
+@click.option("--mode", required=False, default="prefork", type=click.Choice(["prefork", "async"]), show_default=True,
+              help="prefork: each worker handles one request at a time. async: requests are accepted concurrently "
+                   "and queries run in a pool of --workers processes")
+@click.option("--timeout", required=False, type=float,
+              help="Seconds a query may run before it is stopped with a 504 (or a partial result when the URI "
+                   "has ?partial), no limit by default in prefork mode and 60 in async mode")
+@click.option("--max_rows", required=False, type=int,
+              help="Number of rows a query may return before it is stopped with a 413 (or a partial result)")
+@click.option("--max_subjects", required=False, type=int,
+              help="Number of subjects a query may visit before it is stopped with a 413 (or a partial result)")
+@click.option("--max_queue", required=False, default=32, type=int, show_default=True,
+              help="async mode: number of queued or running queries after which new ones get a 503")
+@click.option("--cache_size", required=False, default=256, type=int, show_default=True,
+              help="Number of responses kept in the server side response cache (0 disables it)")
+@click.option("--dataset", "-D", "datasets", required=False, multiple=True,
+              help="NAME=PATH[,PATH...] serves the NIDM files (or directories) under /datasets/NAME/, can be repeated")
+@click.option("--dataset_budget", required=False, multiple=True,
+              help="NAME=MB memory budget of one dataset (graphs and cached responses), can be repeated")
+@click.option("--memory_budget", required=False, type=int,
+              help="MB all loaded datasets may use together in each worker, the least recently used are unloaded beyond that")
+@click.option("--idle_timeout", required=False, type=float,
+              help="Seconds after which a dataset nobody asked for is unloaded")
+@click.option('-v', '--verbosity', required=False, help="Verbosity level 0-5, 0 is default", default="0")
+def serve(nidm_file_list, nidm_dir, host, port, workers, mode, timeout, max_rows, max_subjects, max_queue, cache_size,
+          datasets, dataset_budget, memory_budget, idle_timeout, verbosity):
+    """
+    This function serves the PyNIDM REST API over HTTP.
+    """
+    limits = {'timeout': timeout, 'max_rows': max_rows, 'max_subjects': max_subjects}
+    if datasets:
+        if nidm_file_list or nidm_dir:
+            raise click.UsageError("Use either --dataset or --nidm_file_list/--nidm_dir")
+        if mode == "async":
+            raise click.UsageError("--dataset is only supported with --mode prefork")
+        try:
+            specs = [rest_datasets.parseDatasetSpec(spec) for spec in datasets]
+            budgets = {}
+            for spec in dataset_budget:
+                name, sep, mb = spec.partition('=')
+                if not sep or not mb.isdigit():
+                    raise rest_datasets.DatasetError("Dataset budgets are given as NAME=MB: {}".format(spec))
+                budgets[name] = int(mb) * rest_datasets.MB
+        except rest_datasets.DatasetError as e:
+            raise click.UsageError(str(e))
+        rest_datasets.serveDatasets(specs, host=host, port=port, workers=workers, verbosity=int(verbosity),
+                                    cache_size=cache_size, dataset_budgets=budgets, idle_timeout=idle_timeout, limits=limits,
+                                    memory_budget=memory_budget * rest_datasets.MB if memory_budget else None)
+        return
+
+    files = rest_server.findNIDMFiles(nidm_file_list, nidm_dir)
+    if len(files) == 0:
+        raise click.UsageError("No NIDM files found. Use --nidm_file_list and/or --nidm_dir")
+
+    if mode == "async":
+        rest_server.serveAsync(files, host=host, port=port, workers=workers, verbosity=int(verbosity),
+                               timeout=timeout or 60, max_queue=max_queue, cache_size=cache_size, limits=limits)
+    else:
+        rest_server.serve(files, host=host, port=port, workers=workers, verbosity=int(verbosity), cache_size=cache_size,
+                          limits=limits)
+
+
+if __name__ == "__main__":
+    serve()
@@ -40,6 +40,7 @@ from os.path import basename,splitext
 import subprocess
 from graphviz import Source
 import tempfile
+from nidm.experiment.tools import rdf_stream
 
 def main(argv):
 
@@ -53,6 +54,7 @@ def main(argv):
         arg.add_argument('-nl', '--nl', dest="nidm_files", nargs="+", required=True, help="A comma separated list of NIDM files with full path")
 
     concat.add_argument('-o', '--o', dest='output_file', required=True, help="Merged NIDM output file name + path")
+    concat.add_argument('--stream', dest='stream', action='store_true', help="Write the files one at a time instead of combining them in memory first (.nt and .nq output files are always streamed)")
     # visualize.add_argument('-o', '--o', dest='output_file', required=True, help="Output file name+path of dot graph")
 
 
@@ -61,6 +63,10 @@ def main(argv):
     #concatenate nidm files
     if args.command == 'concat':
 
+        if args.stream or rdf_stream.streamFormat(args.output_file) != 'turtle':
+            rdf_stream.concatFiles(args.nidm_files, args.output_file)
+            return
+
         #create empty graph
         graph=Graph()
         for nidm_file in args.nidm_files:
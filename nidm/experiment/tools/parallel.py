@@ -0,0 +1,38 @@
+'''
+Runs a function over a list of NIDM files in a pool of processes, for the command line tools that
+work file by file (nidm_query --get_fields, nidm_convert):
+
+    for result in mapFiles(functools.partial(convertFile, type='nt'), nidm_files, jobs=4):
+        ...
+
+Kept apart from the tools so importing it doesn't load them (see click_base.LazyGroup).
+'''
+import multiprocessing
+
+
+def _initFileWorker(cde_file_list):
+    # the CDE cache is per process
+    if cde_file_list:
+        from nidm.experiment.Query import getCDEs
+        getCDEs(cde_file_list.split(","))
+
+
+def mapFiles(function, nidm_files, jobs=1, cde_file_list=None):
+    '''
+    Yields function(file) for every file, in the order of the files.  With more than one job the
+    files are handed to a pool of processes and each result is yielded as soon as it and the ones
+    before it are done.
+    '''
+    if jobs <= 1 or len(nidm_files) <= 1:
+        for nidm_file in nidm_files:
+            yield function(nidm_file)
+        return
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    with context.Pool(processes=min(jobs, len(nidm_files)), initializer=_initFileWorker, initargs=(cde_file_list,)) as pool:
+        # one file per task, the files are big units of work
+        for result in pool.imap(function, nidm_files, chunksize=1):
+            yield result
@@ -0,0 +1,395 @@
+'''
+A warm `pynidm query` process that later `pynidm query` calls hand their arguments to.
+
+    $ pynidm query --daemon -nl a.ttl,b.ttl &
+    $ pynidm query -nl a.ttl,b.ttl -u /projects      # answered by the daemon
+
+The daemon listens on a Unix socket only the current user can use ($PYNIDM_QUERY_SOCKET or
+pynidm_query.sock in $XDG_RUNTIME_DIR, or else in a pynidm-{uid} directory of the temp directory).
+The pynidm entry point (see click_base.main) checks for the socket before importing any of the
+commands; if a daemon answers, the command line, working directory and the environment variables
+the queries read (FORWARDED_ENV) are sent to it and the daemon runs the query with the graphs,
+query caches and imports it already has.  Its stdout and stderr are streamed back as frames:
+
+    one byte channel (o = stdout, e = stderr, x = exit status) | 4 byte length | data
+
+Queries run one at a time in the daemon.  Set PYNIDM_NO_DAEMON to always run queries locally.
+
+Another user must not be able to stand in for the daemon or talk to it: the client only connects to
+a socket owned by the current user in a directory no one else can write to (see safeSocket) and
+both ends check the user of the other end of the connection where the platform reports it
+(SO_PEERCRED).  The socket is created with a umask that leaves it accessible to its owner only.
+'''
+import io
+import os
+import sys
+import json
+import struct
+import stat
+import socket
+import tempfile
+import traceback
+import contextlib
+import socketserver
+
+SOCKET_ENV = 'PYNIDM_QUERY_SOCKET'
+NO_DAEMON_ENV = 'PYNIDM_NO_DAEMON'
+
+STDOUT = b'o'
+STDERR = b'e'
+EXIT = b'x'
+FRAME_HEADER = struct.Struct('!cI')
+
+# options of `pynidm query` that are about the daemon itself, never forwarded
+DAEMON_OPTIONS = ['--daemon', '--stop_daemon']
+# the environment variables a query reads, the only ones sent to the daemon
+FORWARDED_ENV = ['CDE_DIR', 'PYNIDM_TRACE']
+PEER_CREDENTIALS = struct.Struct('3i')
+
+
+def currentUser():
+    return os.getuid() if hasattr(os, 'getuid') else 0
+
+
+def socketDirectory():
+    '''
+    $XDG_RUNTIME_DIR, or a directory of the temp directory only the current user can use
+    '''
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and privateDirectory(runtime_dir):
+        return runtime_dir
+    directory = os.path.join(tempfile.gettempdir(), 'pynidm-{}'.format(currentUser()))
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    return directory
+
+
+def defaultSocket():
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    return os.path.join(socketDirectory(), 'pynidm_query.sock')
+
+
+def privateDirectory(directory):
+    '''
+    True if directory is a real directory of the current user that no one else can write to
+    '''
+    try:
+        info = os.lstat(directory)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == currentUser() and info.st_mode & 0o077 == 0
+
+
+def safeSocket(socket_path):
+    '''
+    True if socket_path is a socket of the current user in a private directory, so it can't have
+    been put there by someone else
+    '''
+    try:
+        info = os.lstat(socket_path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == currentUser() and \
+        privateDirectory(os.path.dirname(os.path.abspath(socket_path)))
+
+
+def peerUser(connection):
+    '''
+    The user id of the process at the other end of a Unix socket, None where the platform doesn't say
+    '''
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    pid, uid, gid = PEER_CREDENTIALS.unpack(connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size))
+    return uid
+
+
+def trustedPeer(connection):
+    uid = peerUser(connection)
+    return uid is None or uid == currentUser()
+
+
+def writeFrame(connection, channel, data):
+    connection.sendall(FRAME_HEADER.pack(channel, len(data)) + data)
+
+
+def readExactly(connection, size):
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise EOFError("The query daemon closed the connection")
+        data += chunk
+    return data
+
+
+def readFrames(connection):
+    '''
+    Yields (channel, data) until the exit status frame
+    '''
+    while True:
+        channel, size = FRAME_HEADER.unpack(readExactly(connection, FRAME_HEADER.size))
+        data = readExactly(connection, size)
+        yield channel, data
+        if channel == EXIT:
+            return
+
+
+def socketOption(argv):
+    '''
+    The value of --socket in a pynidm command line, or None
+    '''
+    for i, arg in enumerate(argv):
+        if arg == '--socket' and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith('--socket='):
+            return arg.split('=', 1)[1]
+    return None
+
+
+def connect(socket_path):
+    '''
+    Returns a socket connected to the daemon or None if no daemon of the current user is listening
+    '''
+    if not hasattr(socket, 'AF_UNIX') or not safeSocket(socket_path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        return None
+    if not trustedPeer(connection):
+        connection.close()
+        return None
+    return connection
+
+
+def forward(argv, stdout=None, stderr=None):
+    '''
+    Runs a `pynidm query ...` command line in the daemon if one is listening
+
+    :param argv: the pynidm arguments, e.g. sys.argv[1:]
+    :param stdout: binary stream for the query output, sys.stdout by default
+    :param stderr: binary stream for the query errors, sys.stderr by default
+    :return: the exit status of the query, or None if it has to run in this process
+    '''
+    if len(argv) == 0 or argv[0] != 'query' or os.environ.get(NO_DAEMON_ENV):
+        return None
+    # the daemon options are handled locally and a query file on stdin can't be forwarded
+    if any(arg in DAEMON_OPTIONS or arg == '-' for arg in argv):
+        return None
+
+    connection = connect(socketOption(argv) or defaultSocket())
+    if connection is None:
+        return None
+
+    stdout = stdout or sys.stdout.buffer
+    stderr = stderr or sys.stderr.buffer
+    with connection:
+        env = dict((name, os.environ[name]) for name in FORWARDED_ENV if name in os.environ)
+        request = {'argv': argv, 'cwd': os.getcwd(), 'env': env}
+        connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        try:
+            for channel, data in readFrames(connection):
+                if channel == STDOUT:
+                    stdout.write(data)
+                    stdout.flush()
+                elif channel == STDERR:
+                    stderr.write(data)
+                    stderr.flush()
+                else:
+                    return int(data)
+        except BrokenPipeError:
+            # our output was closed (e.g. piped into head), closing the connection stops the query
+            return 1
+
+
+def stop(socket_path=None):
+    '''
+    Asks the daemon to exit
+
+    :return: True if a daemon was listening
+    '''
+    connection = connect(socket_path or defaultSocket())
+    if connection is None:
+        return False
+    with connection:
+        connection.sendall(json.dumps({'stop': True}).encode('utf-8') + b'\n')
+        for channel, data in readFrames(connection):
+            pass
+    return True
+
+
+class FrameWriter(io.RawIOBase):
+    '''
+    Binary stream writing everything to the client as frames of one channel
+    '''
+
+    def __init__(self, connection, channel):
+        super().__init__()
+        self.connection = connection
+        self.channel = channel
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            writeFrame(self.connection, self.channel, bytes(data))
+        return len(data)
+
+
+def frameStream(connection, channel):
+    '''
+    A text stream (with a .buffer for binary output) sending frames of one channel
+    '''
+    return io.TextIOWrapper(FrameWriter(connection, channel), encoding='utf-8', errors='replace', write_through=True)
+
+
+@contextlib.contextmanager
+def requestContext(cwd, env):
+    '''
+    Runs a forwarded query in the client's working directory with the client's values of the
+    forwarded environment variables
+    '''
+    saved_cwd = os.getcwd()
+    saved_env = dict(os.environ)
+    for name in FORWARDED_ENV:
+        if name in env:
+            os.environ[name] = env[name]
+        else:
+            os.environ.pop(name, None)
+    # a query that starts pynidm again must not wait for this (busy) daemon
+    os.environ[NO_DAEMON_ENV] = '1'
+    try:
+        os.chdir(cwd)
+        yield
+    finally:
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+
+class QueryRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            return
+        if request.get('stop'):
+            self.server.stopping = True
+            writeFrame(self.connection, EXIT, b'0')
+            return
+
+        try:
+            status = self.server.runQuery(request, self.connection)
+            writeFrame(self.connection, EXIT, str(status).encode('utf-8'))
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away
+            pass
+
+
+class QueryDaemon(socketserver.UnixStreamServer):
+    '''
+    Runs forwarded `pynidm query` command lines one at a time
+    '''
+
+    def __init__(self, socket_path, verbosity=0):
+        self.socket_path = socket_path
+        self.verbosity = verbosity
+        self.stopping = False
+        self.served = 0
+        if not privateDirectory(os.path.dirname(os.path.abspath(socket_path))):
+            # the clients wouldn't connect
+            raise OSError("The query daemon socket must be in a directory only you can use (mode 0700): {}".format(socket_path))
+        if os.path.lexists(socket_path):
+            if not safeSocket(socket_path):
+                raise OSError("{} is not a query daemon socket of yours".format(socket_path))
+            probe = connect(socket_path)
+            if probe is not None:
+                probe.close()
+                raise OSError("A query daemon is already listening on {}".format(socket_path))
+            # left behind by a daemon that didn't shut down cleanly
+            os.remove(socket_path)
+        super().__init__(socket_path, QueryRequestHandler)
+
+    def server_bind(self):
+        # no moment where the socket exists with wider permissions than 0600
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def verify_request(self, request, client_address):
+        return trustedPeer(request)
+
+    def runQuery(self, request, connection):
+        from nidm.experiment.tools.nidm_query import query
+
+        argv = request.get('argv', [])
+        if self.verbosity > 0:
+            print("query {}".format(" ".join(argv[1:])))
+        self.served += 1
+        out = frameStream(connection, STDOUT)
+        err = frameStream(connection, STDERR)
+        try:
+            with requestContext(request.get('cwd', os.getcwd()), request.get('env', {})), \
+                    contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                query.main(args=argv[1:], prog_name='pynidm query', standalone_mode=True)
+            return 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            err.write("{}\n".format(e.code))
+            return 1
+        except (BrokenPipeError, ConnectionResetError):
+            raise
+        except Exception:
+            err.write(traceback.format_exc())
+            return 1
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def serve(socket_path=None, nidm_files=None, idle_timeout=None, verbosity=0):
+    '''
+    Runs the query daemon until it is stopped or has been idle for idle_timeout seconds
+
+    :param socket_path: Unix socket to listen on, see defaultSocket
+    :param nidm_files: files whose graphs are loaded up front
+    :param idle_timeout: seconds without a query after which the daemon exits, None to never exit
+    '''
+    from nidm.experiment import Query, Navigate
+    from nidm.experiment.SubjectIndex import getSubjectIndex
+    # load the modules the queries need now rather than on the first query
+    from nidm.experiment.tools import nidm_query
+
+    socket_path = socket_path or defaultSocket()
+    os.environ[NO_DAEMON_ENV] = '1'
+    nidm_files = list(nidm_files or [])
+    for f in nidm_files:
+        Query.OpenGraph(f)
+    if nidm_files:
+        getSubjectIndex(nidm_files)
+        Navigate.getProjects(tuple(nidm_files))
+
+    daemon = QueryDaemon(socket_path, verbosity)
+    daemon.timeout = idle_timeout
+    daemon.handle_timeout = lambda: setattr(daemon, 'stopping', True)
+    print("Query daemon ready on {} ({} files loaded)".format(socket_path, len(nidm_files)), flush=True)
+    try:
+        while not daemon.stopping:
+            daemon.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+    return daemon.served
@@ -0,0 +1,174 @@
+'''
+Streams the triples of NIDM files to an output file one input file at a time, so any number of
+files can be combined without holding more than one of them in memory:
+
+    concatFiles(['a.ttl', 'b.ttl'], 'all.nt')
+
+The output format is picked from the file name:
+
+    .nt    N-Triples, written in batches of BATCH_SIZE triples
+    .nq    N-Quads, the triples of each input file in a named graph (the file's URI)
+    other  Turtle, one Turtle document per input file appended to the output (Turtle allows
+           repeated @prefix declarations, so the result is a valid Turtle file)
+
+Blank node labels are only unique within a file, so every blank node is relabeled with the
+number of the file it came from (_:f0b1, _:f0b2, ... _:f1b1, ...).  Unlike concatenating in an
+rdflib Graph, a triple found in several files is written once per file.
+
+A remap dict renames URIs on the way through, every occurrence of a key (subject, predicate or
+object) is written as its value.  This is how nidm_merge -s gives the agents of the same subject
+in different files one UUID, with a dict lookup per term instead of a graph update per triple.
+
+N-Triples input files are read line by line, other formats are parsed one file at a time.
+'''
+import pathlib
+
+from rdflib import Graph, Dataset, BNode, URIRef, util
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser
+
+from nidm.core import Constants
+
+BATCH_SIZE = 10000
+
+STREAM_FORMATS = {'.nt': 'nt', '.nq': 'nquads'}
+QUAD_FORMATS = ['nquads', 'trig', 'trix']
+
+
+def streamFormat(file_name):
+    '''
+    The rdflib format concatFiles writes for an output file name: nt, nquads or turtle
+    '''
+    return STREAM_FORMATS.get(pathlib.Path(file_name).suffix.lower(), 'turtle')
+
+
+class BlankNodeRelabeler:
+    '''
+    Gives the blank nodes of one file labels that can't collide with those of other files and
+    renames the URIs found in remap
+    '''
+
+    def __init__(self, file_number, remap=None):
+        self.prefix = 'f{}b'.format(file_number)
+        self.labels = {}
+        self.remap = remap or {}
+
+    def __call__(self, term):
+        if not isinstance(term, BNode):
+            return self.remap.get(term, term)
+        label = self.labels.get(term)
+        if label is None:
+            label = self.labels[term] = BNode('{}{}'.format(self.prefix, len(self.labels) + 1))
+        return label
+
+    def triple(self, s, p, o):
+        return self(s), self(p), self(o)
+
+
+class TripleSink:
+    '''
+    Receives the triples of the N-Triples parser, see readTriples
+    '''
+
+    def __init__(self, write):
+        self.write = write
+
+    def triple(self, s, p, o):
+        self.write((s, p, o))
+
+
+def readTriples(file, consume):
+    '''
+    Calls consume(triple) for every triple of the file
+
+    :return: the (prefix, namespace) bindings of the file
+    '''
+    file_format = util.guess_format(str(file)) or 'turtle'
+    if file_format == 'nt':
+        # no graph at all, the parser hands over one line at a time
+        with open(file, 'rb') as f:
+            W3CNTriplesParser(TripleSink(consume)).parse(f)
+        return []
+    if file_format in QUAD_FORMATS:
+        graph = Dataset()
+        graph.parse(file, format=file_format)
+        for (s, p, o, context) in graph.quads((None, None, None, None)):
+            consume((s, p, o))
+    else:
+        graph = Graph()
+        graph.parse(file, format=file_format)
+        for triple in graph:
+            consume(triple)
+    return list(graph.namespaces())
+
+
+class StreamWriter:
+    '''
+    Writes batches of triples to an open binary file in one of the line based formats
+    '''
+
+    def __init__(self, out, output_format, batch_size=BATCH_SIZE):
+        self.out = out
+        self.output_format = output_format
+        self.batch_size = batch_size
+        self.context = None
+        self.written = 0
+        self.batch = []
+
+    def startFile(self, file):
+        self.flush()
+        self.context = URIRef(pathlib.Path(file).resolve().as_uri())
+
+    def add(self, triple):
+        self.batch.append(triple)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.batch) == 0:
+            return
+        if self.output_format == 'nquads':
+            graph = Dataset()
+            named_graph = graph.graph(self.context)
+        else:
+            graph = named_graph = Graph()
+        for triple in self.batch:
+            named_graph.add(triple)
+        self.out.write(graph.serialize(format=self.output_format, encoding='utf-8').rstrip(b'\n') + b'\n')
+        # duplicates inside a batch are only written once
+        self.written += len(named_graph)
+        self.batch = []
+
+
+def concatFiles(nidm_files, out_file, output_format=None, batch_size=BATCH_SIZE, remap=None):
+    '''
+    Writes the triples of every file to out_file, one input file at a time
+
+    :param nidm_files: list of RDF files in any format rdflib can guess from the file name
+    :param out_file: file name, its extension picks the format unless output_format is given
+    :param output_format: nt, nquads or turtle
+    :param remap: optional dict of URIRef -> URIRef to rename in every file
+    :return: number of triples written
+    '''
+    output_format = output_format or streamFormat(out_file)
+    written = 0
+    with open(out_file, 'wb') as out:
+        if output_format == 'turtle':
+            for file_number, file in enumerate(nidm_files):
+                relabel = BlankNodeRelabeler(file_number, remap)
+                graph = Graph()
+                for prefix, namespace in readTriples(file, lambda triple: graph.add(relabel.triple(*triple))):
+                    graph.bind(prefix, namespace, override=False)
+                # N-Triples files have no prefixes of their own
+                for prefix, namespace in Constants.namespaces.items():
+                    graph.bind(prefix, namespace, override=False)
+                out.write(graph.serialize(format='turtle', encoding='utf-8').rstrip(b'\n') + b'\n\n')
+                written += len(graph)
+            return written
+
+        writer = StreamWriter(out, output_format, batch_size)
+        for file_number, file in enumerate(nidm_files):
+            relabel = BlankNodeRelabeler(file_number, remap)
+            writer.startFile(file)
+            readTriples(file, lambda triple: writer.add(relabel.triple(*triple)))
+        writer.flush()
+        return writer.written
@@ -47,6 +47,7 @@ from nidm.core import Constants
 from nidm.experiment.Utils import read_nidm, map_variables_to_terms, getSubjIDColumn
 from nidm.experiment.Core import getUUID
 from nidm.experiment.Core import Core
+from nidm.experiment.SubjectIndex import indexDataFrame, normalizeSubjectID
 from prov.model import QualifiedName,PROV_ROLE, ProvDocument, PROV_ATTR_USED_ENTITY
 from prov.model import Namespace as provNamespace
 import prov as pm
@@ -177,7 +178,8 @@ def add_brainvolume_data(nidmdoc, df, id_field, source_row, column_to_terms, png
         #print(query)
         qres = rdf_graph_parse.query(query)
 
-
+        # index the CSV subject ID column once so finding each participant's row is a dict lookup
+        csv_subjects = indexDataFrame(df, id_field)
 
         for row in qres:
             print('%s \t %s' %(row[2],row[1]))
@@ -186,9 +188,9 @@ def add_brainvolume_data(nidmdoc, df, id_field, source_row, column_to_terms, png
             #csv_row = df.loc[df[id_field]==type(df[id_field][0])(row[1])]
             #find row in CSV file with matching subject id to the agent in the NIDM file
             #be careful about data types...simply type-change dataframe subject id column and query to strings.
-            #here we're removing the leading 0's from IDs because pandas.read_csv strips those unless you know ahead of
-            #time which column is the subject id....
-            csv_row = df.loc[df[id_field].astype('str').str.contains(str(row[1]).lstrip("0"))]
+            #here we're matching on normalized IDs (no leading 0's or sub- prefix) because pandas.read_csv strips those
+            #unless you know ahead of time which column is the subject id....
+            csv_row = df.loc[csv_subjects.get(normalizeSubjectID(row[1]), [])]
 
             #if there was data about this subject in the NIDM file already (i.e. an agent already exists with this subject id)
             #then add this brain volumes data to NIDM file, else skip it....
@@ -11,11 +11,19 @@ from tabulate import tabulate
 from copy import copy, deepcopy
 from urllib.parse import urlparse, parse_qs
 from  nidm.experiment import Navigate
+from nidm.experiment.Instrumentation import stage
+from nidm.experiment.ValueColumn import outputValue
+from nidm.experiment import FieldStatistics
+from nidm.experiment import SearchIndex
+from nidm.experiment import QueryBudget
+from nidm.experiment import FileCache
+from nidm.experiment.QueryBudget import BudgetExceeded
+from nidm.experiment.tools import rest_tables, rest_json
 
 
-from numpy import std, mean, median
 import functools
 import operator
+import itertools
 
 from joblib import Memory
 memory = Memory(gettempdir(), verbose=0)
@@ -31,16 +39,50 @@ def convertListtoDict(lst):
     '''
     res_dct = {lst[i]: lst[i+1] for i in range(0,len(lst),2)}
     return res_dct
+class QueryParameterError(ValueError):
+    pass
+
+
+class PagingError(QueryParameterError):
+    pass
+
+
 class RestParser:
 
 
     OBJECT_FORMAT = 0
     JSON_FORMAT = 1
     CLI_FORMAT = 2
+    CSV_FORMAT = 3
+    ARROW_FORMAT = 4
+    PARQUET_FORMAT = 5
+    TABLE_FORMATS = (CSV_FORMAT, ARROW_FORMAT, PARQUET_FORMAT)
+
+    # columns of /projects/{id}/subjects, see Navigate.getProjectSubjectTable
+    SUBJECT_TABLE_COLUMNS = ['uuid', 'subject id', 'sessions', 'acquisitions', 'instruments', 'derivatives']
+
+    # query parameters that lower the limits of the query budget, see QueryBudget
+    BUDGET_PARAMETERS = [('timeout', float), ('max_rows', int), ('max_subjects', int)]
+
+    # number of /search results without a limit parameter
+    SEARCH_LIMIT = 10
 
-    def __init__(self, verbosity_level = 0, output_format = 0):
+    def __init__(self, verbosity_level = 0, output_format = 0, pretty = False, limits = None, cancelled = None):
+        '''
+        :param limits: {'timeout': seconds, 'max_rows': n, 'max_subjects': n} no query may exceed, the
+                       timeout, max_rows and max_subjects query parameters can only lower them
+        :param cancelled: callable returning True once the result is no longer wanted
+        '''
         self.verbosity_level = verbosity_level
         self.output_format = output_format
+        # JSON_FORMAT output is compact unless pretty is set
+        self.pretty = pretty
+        self.batch_memo = None
+        self.limits = dict(limits or {})
+        self.cancelled = cancelled
+        self.budget = QueryBudget.Budget(cancelled=cancelled)
+        # the budget reason when the last result was cut short, None if it is complete
+        self.truncated = None
         self.restLog ("Setting output format {}".format(self.output_format), 4)
 
     def setOutputFormat(self, output_format):
@@ -62,7 +104,7 @@ class RestParser:
 
 
         if self.output_format == RestParser.JSON_FORMAT:
-            return json.dumps(result, indent=2)
+            return rest_json.dumpsText(result, pretty=self.pretty)
         elif self.output_format == RestParser.CLI_FORMAT:
             # most likely this is an array of strings but tabulate wants an array of arrays
             table = []
@@ -88,7 +130,7 @@ class RestParser:
 
                     # also put really short lists in as comma separated values
                     if len ( json.dumps(result[key]) ) < 40:
-                        table.append( [ json.dumps(key), ",".join(result[key]) ] )
+                        table.append( [ json.dumps(key), ",".join(str(x) for x in result[key]) ] )
 
                 # format a string
                 elif type(result[key]) == str:
@@ -151,6 +193,16 @@ class RestParser:
     def projectSummaryFormat(self, result):
 
         if self.output_format == self.CLI_FORMAT:
+            if 'field_values' in result:
+                # with ?fields= the summary only has the field values (no subjects or data elements)
+                fh_header = ['subject', 'label', 'value', 'unit'] #result['field_values'][0].keys()
+                fh_rows = [ [x.subject, x.label, x.value, x.hasUnit] for x in result['field_values']]
+                field_table = tabulate(fh_rows, fh_header)
+                #added by DBK, if they asked for fields then just give them the fields
+                return "{}".format(field_table)
+            else:
+                field_table = ''
+
             ### added by DBK to sort things
             result["subjects"]["uuid"],result["subjects"]["subject id"] = self.sort_list(result["subjects"]["uuid"], result["subjects"]["subject id"])
             result["data_elements"]["uuid"],result["data_elements"]["label"] = self.sort_list(result["data_elements"]["uuid"], result["data_elements"]["label"])
@@ -160,15 +212,6 @@ class RestParser:
                 if not key in ['subjects', 'data_elements', 'field_values']:
                     toptable.append([ key, simplejson.dumps(result[key]) ])
 
-            if 'field_values' in result and len(result['field_values']) > 0 :
-                fh_header = ['subject', 'label', 'value', 'unit'] #result['field_values'][0].keys()
-                fh_rows = [ [x.subject, x.label, x.value, x.hasUnit] for x in result['field_values']]
-                field_table = tabulate(fh_rows, fh_header)
-                #added by DBK, if they asked for fields then just give them the fields
-                return "{}".format(field_table)
-            else:
-                field_table = ''
-
             return "{}\n\n{}\n{}\n\n{}\n{}\n\n{}".format(
                 tabulate(toptable),
                 ### modified by DBK to account for new dictionary format of results
@@ -284,6 +327,48 @@ class RestParser:
         return self.format(result)
 
 
+    def instrumentCatalog(self):
+        variables = re.match(r"^/?instruments/variables/?$", self.command) is not None
+        project = self.query['project'][0] if 'project' in self.query else None
+        project_uri = str(Navigate.expandID(parse.unquote(project), Constants.NIIRI)) if project else None
+        self.restLog("Returning the instrument {}catalog".format("variable " if variables else ""), 2)
+
+        result = []
+        for row in Navigate.getInstrumentCatalog(self.nidm_files):
+            if (row.variable is not None) != variables or (project_uri and row.project != project_uri):
+                continue
+            record = {'project': row.project.replace(Constants.NIIRI, ""), 'project_title': row.project_title,
+                      'instrument': row.instrument}
+            if variables:
+                record['variable'] = row.variable
+            record['count'] = row.count
+            result.append(record)
+
+        if self.output_format == self.CLI_FORMAT:
+            return tabulate(result, headers="keys")
+        return self.format(result)
+
+    def search(self):
+        words = self.query['q'][0] if 'q' in self.query else ''
+        if not words.strip():
+            raise QueryParameterError("q, the words to search for, is required")
+        limit = self.query['limit'] if self.query['limit'] is not None else self.SEARCH_LIMIT
+        self.restLog("Searching data elements for {}".format(words), 2)
+
+        index = SearchIndex.getSearchIndex(self.nidm_files + tuple(Query.getCDEFileList()))
+        result = []
+        for match in index.search(words, limit=self.query['offset'] + limit)[self.query['offset']:]:
+            record = match._asdict()
+            record['concepts'] = list(match.concepts)
+            # the file names, not where the files are on the server
+            record['sources'] = [os.path.basename(source) for source in match.sources]
+            result.append(record)
+
+        if self.output_format == self.CLI_FORMAT:
+            return tabulate([[r['score'], r['label'], r['uri'], r['source_variable'], ", ".join(r['concepts'])] for r in result],
+                            headers=['score', 'label', 'uri', 'source variable', 'concepts'])
+        return self.format(result)
+
     def projectStats(self):
         result = dict()
         subjects = None
@@ -307,17 +392,61 @@ class RestParser:
                     result[short_key] = projects['projects'][pid][key]
 
         # now get any fields they reqested
-        for field in self.query['fields']:
-            if subjects == None:
-                subjects = Query.GetParticipantUUIDsForProject(tuple(self.nidm_files), project_id=id, filter=self.query['filter'])
-                result['subjects'] = subjects['uuid']
-            bits = field.split('.')
-            if len(bits) > 1:
-                stat_type = self.getStatType(bits[0]) # should be either instruments or derivatives for now.
-                self.addFieldStats(result, id, subjects['uuid'], bits[1], stat_type) # bits[1] will be the ID
+        fields = [field for field in self.query['fields'] if len(field.split('.')) > 1]
+        if len(fields) > 0:
+            subjects = Query.GetParticipantUUIDsForProject(tuple(self.nidm_files), project_id=id, filter=self.query['filter'])
+            for s in subjects['uuid']:
+                self.budget.countSubject()
+            result['subjects'] = subjects['uuid']
+            table = self.projectFieldTable(id, list(dict.fromkeys(subjects['uuid'])), fields + self.query['group_by'])
+            result.update(FieldStatistics.fieldStatistics(table, [self.fieldName(field) for field in fields],
+                                                          [self.fieldName(field) for field in self.query['group_by']]))
 
         return self.dictFormat(result)
 
+    def fieldName(self, field):
+        '''
+        instruments.age -> age
+        '''
+        return field.split('.', 1)[-1]
+
+    def projectFieldTable(self, project, subjects, fields):
+        '''
+        Collects the values of the fields for all the subjects into a typed table, one row per subject
+        and one column per field.  Fields are written as instruments.<name> or derivatives.<name>, a
+        bare name is looked up in the instrument data.  When a subject has several values for a field
+        the first one is used.
+
+        :return: pandas DataFrame, see FieldStatistics.fieldTable
+        '''
+        instrument_data = None
+        derivatives_data = None
+        columns = {}
+        for field in fields:
+            name = self.fieldName(field)
+            stat_type = self.getStatType(field.split('.')[0]) if '.' in field else self.STAT_TYPE_INSTRUMENTS
+            values = []
+            if stat_type == self.STAT_TYPE_INSTRUMENTS:
+                if instrument_data is None:
+                    # all subjects in one pass over the acquisitions
+                    instrument_data = Query.GetProjectInstrumentDataTyped(self.nidm_files, project)
+                for s in subjects:
+                    found = [data[name] for data in instrument_data.get(s, {}).values() if name in data]
+                    values.append(found[0] if found else None)
+            # derivatives are of the form [UUID]['values'][URI]{datumType, label, values, units}
+            elif stat_type == self.STAT_TYPE_DERIVATIVES:
+                if derivatives_data is None:
+                    derivatives_data = Query.GetProjectDerivativesDataTyped(self.nidm_files, project)
+                for s in subjects:
+                    data = derivatives_data.get(s, {})
+                    found = [measures['value'] for deriv in data for URI, measures in data[deriv]['values'].items()
+                             if name == measures['label'] or name == self.getTailOfURI(URI)]
+                    values.append(found[0] if found else None)
+            else:
+                values = [None] * len(subjects)
+            columns[name] = values
+        return FieldStatistics.fieldTable(columns, index=subjects)
+
     STAT_TYPE_OTHER = 0
     STAT_TYPE_INSTRUMENTS = 1
     STAT_TYPE_DERIVATIVES = 2
@@ -334,39 +463,14 @@ class RestParser:
             return uri[uri.rfind('/') + 1:]
 
 
-    def addFieldStats(self, result, project, subjects, field, type):
+    def outputValueType(self, value_type):
         '''
-        Geneerates basic stats on a group of subjects and adds it to the result
-        :param result:
-        :param subjects:
-        :param field:
-        :return:
+        ValueTypes carry typed values, convert the value to a string on the way out
         '''
-        values = []
-        for s in subjects:
-            if type == self.STAT_TYPE_INSTRUMENTS:
-                data = Query.GetParticipantInstrumentData(tuple(self.nidm_files), project, s)
-                for i in data:
-                    if field in data[i]:
-                        values.append( float(data[i][field]) )
-            # derivatives are of the form [UUID]['values'][URI]{datumType, label, values, units}
-            if type == self.STAT_TYPE_DERIVATIVES:
-                data = Query.GetDerivativesDataForSubject(tuple(self.nidm_files), project, s)
-                for deriv in data:
-                    for URI in data[deriv]['values']:
-                        measures = data[deriv]['values'][URI]
-                        if field == measures['label'] or field == self.getTailOfURI(URI):
-                            values.append( float(measures['value']) )
-
-        if len(values) > 0:
-            med = median(values)
-            avg = mean(values)
-            st = std(values)
-            mn = min(values)
-            mx = max(values)
-        else:
-            med = avg = st = mn = mx = None
-        result[field] = {"max": mx, "min": mn, "median": med, "mean": avg, "standard_deviation": st}
+        return value_type._replace(value=outputValue(value_type.value))
+
+    def outputActivityData(self, activity_data):
+        return activity_data._replace(data=[self.outputValueType(x) for x in activity_data.data])
 
     def projectSummary(self):
 
@@ -374,53 +478,99 @@ class RestParser:
         id = parse.unquote(str(match.group(1)))
         self.restLog("Returing project {} summary".format(id), 2)
 
-        result = nidm.experiment.Navigate.GetProjectAttributes(self.nidm_files, project_id=id)
-        result['subjects']  = Query.GetParticipantUUIDsForProject(self.nidm_files, project_id=id, filter=self.query['filter'])
-        result['data_elements'] = Query.GetProjectDataElements(self.nidm_files, project_id=id)
-
-
         # if we got fields, drill into each subject and pull out the field data
         # subject details -> derivitives / instrument -> values -> element
         if 'fields' in self.query and len(self.query['fields']) > 0:
             self.restLog("Using fields {}".format(self.query['fields']), 2)
-            result['field_values'] = []
-            # get all the synonyms for all the fields
-            field_synonyms = functools.reduce( operator.iconcat, [ Query.GetDatatypeSynonyms(self.nidm_files, id, x) for x in self.query['fields'] ], [])
-            for sub in result['subjects']['uuid']:
-
-                for activity in Navigate.getActivities(self.nidm_files, sub):
-                    activity = Navigate.getActivityData(self.nidm_files, activity)
-                    for data_element in activity.data:
-                        if data_element.dataElement in field_synonyms:
-                            result['field_values'].append(data_element._replace(subject=sub))
-
-            if len(result['field_values']) == 0:
+            # only the field values are returned so don't compute the rest of the summary
+            result = {'field_values': self.collect(self.iterFieldValues(id))}
+            if len(result['field_values']) == 0 and self.query['offset'] == 0:
                 raise ValueError("Supplied field not found. (" + ", ".join(self.query['fields']) + ")")
+            return self.projectSummaryFormat(result)
+
+        result = nidm.experiment.Navigate.GetProjectAttributes(self.nidm_files, project_id=id)
+        result['subjects']  = Query.GetParticipantUUIDsForProject(self.nidm_files, project_id=id, filter=self.query['filter'])
+        result['data_elements'] = Query.GetProjectDataElements(self.nidm_files, project_id=id)
 
         return self.projectSummaryFormat(result)
 
+    def iterFieldValues(self, project_id):
+        '''
+        Yields the ValueType of every requested field for every subject matching the filter, in a stable
+        order so pages line up between calls
+        '''
+        # get all the synonyms for all the fields
+        field_synonyms = functools.reduce( operator.iconcat, [ Query.GetDatatypeSynonyms(self.nidm_files, project_id, x) for x in self.query['fields'] ], [])
+        subjects = Query.GetParticipantUUIDsForProject(self.nidm_files, project_id=project_id, filter=self.query['filter'])
+        for sub in subjects['uuid']:
+            self.budget.countSubject()
+            for activity in sorted(Navigate.getActivities(self.nidm_files, sub), key=str):
+                activity = Navigate.getActivityData(self.nidm_files, activity)
+                for data_element in activity.data:
+                    if data_element.dataElement in field_synonyms:
+                        yield self.outputValueType(data_element._replace(subject=sub))
+
+    def paginate(self, records):
+        '''
+        Applies the limit and offset query parameters to a stream of records without producing the
+        records past the end of the page
+        '''
+        stop = None if self.query['limit'] is None else self.query['offset'] + self.query['limit']
+        return itertools.islice(records, self.query['offset'], stop)
+
+    def collect(self, records):
+        '''
+        The page of records as a list, each record counts against the budget's row limit.  When the
+        budget runs out the records found so far are returned if the partial query parameter was given,
+        otherwise BudgetExceeded is raised.
+        '''
+        result = []
+        try:
+            for record in self.paginate(records):
+                self.budget.countRow()
+                result.append(record)
+        except BudgetExceeded as e:
+            if not self.query['partial']:
+                raise
+            self.restLog("Returning a partial result: {}".format(e), 1)
+            self.truncated = e.reason
+        return result
+
+    def budgetError(self, e):
+        return {"error": str(e), "budget": e.reason}
 
     def subjectsList(self):
         match = re.match(r"^/?projects/([^/]+)/subjects/?$", self.command)
         project = match.group((1))
         self.restLog("Returning all agents matching filter '{}' for project {}".format(self.query['filter'], project), 2)
         # result = Query.GetParticipantUUIDsForProject(self.nidm_files, project, self.query['filter'], None)
-        all_subjects = Navigate.getSubjects(self.nidm_files, project)
-        result = {}
-        result['uuid'] = []
-        result['subject id'] = []
-        for sub_uuid in all_subjects:
-            if Query.CheckSubjectMatchesFilter(self.nidm_files,project, sub_uuid, self.query['filter']):
-                uuid_string = (str(sub_uuid)).split('/')[-1]  # srip off the http://whatever/whatever/
-                result['uuid'].append(uuid_string)
-                sid = Navigate.getSubjectIDfromUUID(self.nidm_files, sub_uuid)
-                result['subject id'].append(str(sid))
+        result = {key: [] for key in self.SUBJECT_TABLE_COLUMNS}
+        for record in self.collect(self.iterSubjects(project)):
+            for key in self.SUBJECT_TABLE_COLUMNS:
+                result[key].append(record[key])
         return self.format(result)
 
+    def iterSubjects(self, project):
+        '''
+        Yields a row of the project's subject table (uuid, subject id and the number of sessions, acquisitions,
+        instruments and derivatives) for each subject matching the filter, sorted by UUID
+        '''
+        table = self.shared(Navigate.getProjectSubjectTable, tuple(self.nidm_files), project)
+        for row in table:
+            self.budget.countSubject()
+            if self.query['filter'] and not Query.CheckSubjectMatchesFilter(self.nidm_files, project, row.uuid, self.query['filter']):
+                continue
+            yield {'uuid': str(row.uuid).split('/')[-1],  # strip off the http://whatever/whatever/
+                   'subject id': str(row.subject_id),
+                   'sessions': len(row.sessions),
+                   'acquisitions': row.acquisitions,
+                   'instruments': len(row.instruments),
+                   'derivatives': len(row.derivatives)}
+
     def projectSubjectSummary(self):
         match = re.match(r"^/?projects/([^/]+)/subjects/([^/]+)/?$", self.command)
         self.restLog("Returning info about subject {}".format(match.group(2)), 2)
-        return self.subjectSummaryFormat(Query.GetParticipantDetails(self.nidm_files, match.group(1), match.group(2)))
+        return self.subjectSummaryFormat(self.shared(Query.GetParticipantDetails, self.nidm_files, match.group(1), match.group(2)))
 
     def subjectSummary(self):
         match = re.match(r"^/?subjects/([^/]+)/?$", self.command)
@@ -429,7 +579,7 @@ class RestParser:
         activityData = []
         for a in activities:
             data = Navigate.getActivityData(self.nidm_files, a)
-            activityData.append(data)
+            activityData.append(self.outputActivityData(data))
 
         return self.subjectSummaryFormat_v2( {'uuid': match.group(1),
                 'instruments' : list(filter(lambda x: x.category == 'instrument', activityData)),
@@ -441,7 +591,7 @@ class RestParser:
         result = []
         match = re.match(r"^/?projects/([^/]+)/subjects/([^/]+)$", self.command)
         self.restLog("Returning instruments in subject {}".format(match.group(2)), 2)
-        instruments = Query.GetParticipantInstrumentData(self.nidm_files, match.group(1), match.group(2))
+        instruments = self.shared(Query.GetParticipantInstrumentData, self.nidm_files, match.group(1), match.group(2))
         for i in instruments:
             result.append(i)
         return self.format(result)
@@ -449,14 +599,14 @@ class RestParser:
     def instrumentSummary(self):
         match = re.match(r"^/?projects/([^/]+)/subjects/([^/]+)/instruments/([^/]+)$", self.command)
         self.restLog("Returning instrument {} in subject {}".format(match.group(3), match.group(2)), 2)
-        instruments = Query.GetParticipantInstrumentData(self.nidm_files, match.group(1), match.group(2))
+        instruments = self.shared(Query.GetParticipantInstrumentData, self.nidm_files, match.group(1), match.group(2))
         return self.format(instruments[match.group(3)], headers=["Category", "Value"])
 
     def derivativesList(self):
         result = []
         match = re.match(r"^/?projects/([^/]+)/subjects/([^/]+)", self.command)
         self.restLog("Returning derivatives in subject {}".format(match.group(2)), 2)
-        derivatives = Query.GetDerivativesDataForSubject(self.nidm_files, match.group(1), match.group(2))
+        derivatives = self.shared(Query.GetDerivativesDataForSubject, self.nidm_files, match.group(1), match.group(2))
         for s in derivatives:
             result.append(s)
         return self.format(result)
@@ -465,7 +615,7 @@ class RestParser:
         match = re.match(r"^/?projects/([^/]+)/subjects/([^/]+)/derivatives/([^/]+)", self.command)
         uri = match.group(3)
         self.restLog("Returning stat {} in subject {}".format(uri, match.group(2)), 2)
-        derivatives = Query.GetDerivativesDataForSubject(self.nidm_files, match.group(1), match.group(2))
+        derivatives = self.shared(Query.GetDerivativesDataForSubject, self.nidm_files, match.group(1), match.group(2))
 
         single_derivative = { uri: derivatives[uri] }
 
@@ -474,38 +624,182 @@ class RestParser:
 
         return self.formatDerivatives(single_derivative)
 
-    def run(self, nidm_files, command):
-        try:
-            self.restLog("parsing command " + command, 1)
-            self.restLog("Files to read:" + str(nidm_files), 1)
-            self.restLog("Using {} as the graph cache directory".format(gettempdir()), 1)
+    def parseCommand(self, nidm_files, command):
+        self.restLog("parsing command " + command, 1)
+        self.restLog("Files to read:" + str(nidm_files), 1)
+        self.restLog("Using {} as the graph cache directory".format(gettempdir()), 1)
 
-            self.nidm_files = tuple(nidm_files)
-            u = urlparse(command)
-            self.command = u.path
-            self.query = parse_qs(u.query)
+        self.nidm_files = tuple(nidm_files)
+        u = urlparse(command)
+        self.command = u.path
+        self.query = parse_qs(u.query)
 
-            if 'filter' in self.query:
-                self.query['filter'] = self.query['filter'][0]
-            else:
-                self.query['filter'] = None
+        if 'filter' in self.query:
+            self.query['filter'] = self.query['filter'][0]
+        else:
+            self.query['filter'] = None
 
-            # normalize query dict for our particular situation
-            if 'fields' in self.query:
-                self.query['fields'] = str.split(self.query['fields'][0], ',')
+        # normalize query dict for our particular situation
+        if 'fields' in self.query:
+            self.query['fields'] = str.split(self.query['fields'][0], ',')
+        else:
+            self.query['fields'] = []
+
+        if 'group_by' in self.query:
+            self.query['group_by'] = str.split(self.query['group_by'][0], ',')
+        else:
+            self.query['group_by'] = []
+
+        # paging for the collection routes
+        for key, default in [('limit', None), ('offset', 0)]:
+            if key in self.query:
+                if not re.match(r"^\d+$", self.query[key][0]):
+                    raise PagingError("{} must be a non-negative integer".format(key))
+                self.query[key] = int(self.query[key][0])
             else:
-                self.query['fields'] = []
+                self.query[key] = default
+
+        # time and work budget, the query parameters may only make the configured limits tighter
+        limits = dict(self.limits)
+        for key, convert in self.BUDGET_PARAMETERS:
+            if key in self.query:
+                try:
+                    value = convert(self.query[key][0])
+                except ValueError:
+                    value = -1
+                if not value > 0:
+                    raise QueryParameterError("{} must be a positive number".format(key))
+                limits[key] = value if limits.get(key) is None else min(value, limits[key])
+        # ?partial (or partial=1/true) returns what was found when the budget runs out instead of an error
+        partial = parse_qs(urlparse(command).query, keep_blank_values=True).get('partial', [None])[0]
+        self.query['partial'] = partial is not None and partial.lower() not in ('0', 'false', 'no')
+        self.budget = QueryBudget.Budget(timeout=limits.get('timeout'), max_rows=limits.get('max_rows'),
+                                         max_subjects=limits.get('max_subjects'), cancelled=self.cancelled)
+        self.truncated = None
 
-            return self.route()
+    def run(self, nidm_files, command):
+        try:
+            self.parseCommand(nidm_files, command)
+            # the files are only checked for changes once per query
+            with QueryBudget.enforce(self.budget), FileCache.VersionSnapshot():
+                return self.route()
+        except QueryParameterError as e:
+            return (self.format({"error": str(e)}))
+        except BudgetExceeded as e:
+            return (self.format(self.budgetError(e)))
         except ValueError:
             return (self.format({"error": "One of the supplied field terms was not found."}))
 
+    def stream(self, nidm_files, command):
+        '''
+        Like run() but yields the records of collection routes (subjects of a project, field values) one
+        at a time as they are found.  Other routes yield their single result.  Records are always
+        returned as python objects.
+        '''
+        self.output_format = self.OBJECT_FORMAT
+        try:
+            self.parseCommand(nidm_files, command)
+        except QueryParameterError as e:
+            yield {"error": str(e)}
+            return
+        # entered while a record is produced, not while the caller has it
+        self.versions = FileCache.VersionSnapshot()
+
+        match = re.match(r"^/?projects/([^/]+)/subjects/?$", self.command)
+        if match:
+            yield from self.streamRecords(self.iterSubjects(match.group(1)))
+            return
+
+        match = re.match(r"^/?projects/([^/]+)$", self.command)
+        if match and len(self.query['fields']) > 0:
+            for value_type in self.streamRecords(self.iterFieldValues(parse.unquote(match.group(1)))):
+                yield value_type._asdict() if hasattr(value_type, '_asdict') else value_type
+            return
+
+        try:
+            with QueryBudget.enforce(self.budget), self.versions:
+                result = self.route()
+        except BudgetExceeded as e:
+            result = self.budgetError(e)
+        except ValueError:
+            result = {"error": "One of the supplied field terms was not found."}
+        if isinstance(result, list):
+            yield from result
+        else:
+            yield result
+
+    def streamRecords(self, records):
+        '''
+        Yields the page of records, the budget is only enforced while the next record is being produced.
+        If the budget runs out the last record is {"truncated": reason} when partial results were asked
+        for and an error otherwise.
+        '''
+        records = self.paginate(records)
+        end = object()
+        while True:
+            try:
+                with QueryBudget.enforce(self.budget), self.versions:
+                    record = next(records, end)
+                    if record is end:
+                        return
+                    self.budget.countRow()
+            except BudgetExceeded as e:
+                self.truncated = e.reason
+                yield {"truncated": e.reason} if self.query['partial'] else self.budgetError(e)
+                return
+            yield record
+
+
+    def runBatch(self, nidm_files, commands):
+        '''
+        Runs a list of REST URIs against the same files.  Repeated URIs are only executed once and the
+        per subject data behind the instrument, derivative and subject routes is shared between the
+        commands of the batch.
 
+        :param nidm_files: list of NIDM files
+        :param commands: list of REST URIs
+        :return: list of {"uri", "status", "result"} in the order of the commands
+        '''
+        output_format = self.output_format
+        self.output_format = self.OBJECT_FORMAT
+        self.batch_memo = {}
+        done = {}
+        results = []
+        try:
+            with FileCache.VersionSnapshot():
+                for command in commands:
+                    if command not in done:
+                        try:
+                            result = self.run(nidm_files, command)
+                            status = 404 if result == {"error": "No match for supplied URI"} else 200
+                        except Exception as e:
+                            result, status = {"error": str(e)}, 500
+                        done[command] = {"uri": command, "status": status, "result": result}
+                    results.append(done[command])
+        finally:
+            self.batch_memo = None
+            self.output_format = output_format
+        return self.format(results)
+
+    def shared(self, function, *args):
+        '''
+        Calls function(*args), reusing the result of an identical earlier call inside the same batch
+        '''
+        if self.batch_memo is None:
+            return function(*args)
+        key = (function.__name__,) + args
+        if key not in self.batch_memo:
+            self.batch_memo[key] = function(*args)
+        return self.batch_memo[key]
 
     def route(self):
 
         if re.match(r"^/?projects/?$", self.command): return self.projects()
 
+        if re.match(r"^/?instruments(/variables)?/?$", self.command): return self.instrumentCatalog()
+
+        if re.match(r"^/?search/?$", self.command): return self.search()
+
         if re.match(r"^/?statistics/projects/[^/]+$", self.command): return self.projectStats()
 
         if re.match(r"^/?projects/[^/]+$", self.command): return self.projectSummary()
@@ -529,6 +823,17 @@ class RestParser:
         return {"error": "No match for supplied URI"}
 
 
+    def tableFormat(self, result):
+        '''
+        CSV text, Arrow IPC stream bytes or Parquet bytes with typed columns, see rest_tables
+        '''
+        df = rest_tables.resultToDataFrame(result)
+        if self.output_format == self.CSV_FORMAT:
+            return rest_tables.dataFrameToCSV(df)
+        if self.output_format == self.ARROW_FORMAT:
+            return rest_tables.dataFrameToArrow(df)
+        return rest_tables.dataFrameToParquet(df)
+
     def restLog(self, message, verbosity_of_message):
         if verbosity_of_message <= self.verbosity_level:
             print (message)
@@ -536,16 +841,19 @@ class RestParser:
 
 
     def format(self, result, headers = [""]):
-        if self.output_format == RestParser.JSON_FORMAT:
-            json_str = simplejson.dumps(result, indent=2)
-            return json_str
-
-        elif self.output_format == RestParser.CLI_FORMAT:
-            if type(result) == dict:
-                return self.dictFormat(result, headers)
-            if type(result) == list:
-                return self.arrayFormat(result, headers)
-            else:
-                return str(result)
+        with stage('format', output_format=self.output_format):
+            if self.output_format in self.TABLE_FORMATS:
+                return self.tableFormat(result)
+
+            if self.output_format == RestParser.JSON_FORMAT:
+                return rest_json.dumpsText(result, pretty=self.pretty)
+
+            elif self.output_format == RestParser.CLI_FORMAT:
+                if type(result) == dict:
+                    return self.dictFormat(result, headers)
+                if type(result) == list:
+                    return self.arrayFormat(result, headers)
+                else:
+                    return str(result)
 
-        return result
+            return result
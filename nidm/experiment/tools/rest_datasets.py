@@ -0,0 +1,299 @@
+'''
+Serving several unrelated NIDM datasets from one server (see `pynidm serve --dataset`).
+
+Every dataset is a named set of files with its own Snapshot, response cache and optional memory
+budget, its REST API is mounted under /datasets/{name}/ so a query only ever touches that dataset's
+graphs.  Datasets are loaded on first use (or up front, as far as the budget allows) and the least
+recently used ones are unloaded when the loaded datasets need more than the server's memory budget
+or when they have been idle for longer than idle_timeout seconds.
+
+The parsed graphs and project tables of a loaded dataset are pinned in the per file caches (see
+Snapshot.load), so another dataset's traffic can't evict them and the memory measured when the
+dataset loads stays resident until it is unloaded.  Other query results share the process wide
+bounded caches of FileCache; they aren't counted against any budget and a busy dataset may push
+out another one's entries, which are then recomputed from the pinned graphs.
+
+With several workers, datasets loaded before the workers fork are shared by all of them, a dataset
+loaded later is loaded by each worker that gets a request for it.  The budgets are enforced by
+each worker on its own, so a server with N workers can hold up to N times the budget.
+'''
+import os
+import re
+import gc
+import time
+import shutil
+import tempfile
+import threading
+from wsgiref.simple_server import make_server
+
+from nidm.experiment import FileCache
+from nidm.experiment.SubjectIndex import getSubjectIndex
+from nidm.experiment.tools.rest_server import WSGIApplication, RestApplication, Snapshot, QuietRequestHandler, \
+    findNIDMFiles, runWorkers
+from nidm.experiment.tools.rest_metrics import ServerMetrics, residentMemory
+
+# rdflib's in memory store needs about this much per triple, used when the process size can't tell
+BYTES_PER_TRIPLE = 1200
+
+MB = 1024 * 1024
+
+
+class DatasetError(Exception):
+    pass
+
+
+def parseDatasetSpec(spec):
+    '''
+    Parses NAME=PATH[,PATH...] where every PATH is a NIDM file or a directory searched for .ttl files
+
+    :return: (name, list of files)
+    '''
+    name, sep, paths = spec.partition('=')
+    if not sep or not re.match(r"^[A-Za-z0-9_.-]+$", name):
+        raise DatasetError("Datasets are given as NAME=PATH[,PATH...] with a name of letters, digits, '_', '.' or '-': {}".format(spec))
+    files = []
+    for p in paths.split(','):
+        if os.path.isdir(p):
+            files.extend(findNIDMFiles(nidm_dir=p))
+        elif p:
+            files.extend(findNIDMFiles(nidm_file_list=p))
+    if len(files) == 0:
+        raise DatasetError("No NIDM files found for dataset {}".format(name))
+    return name, sorted(set(files))
+
+
+class Dataset:
+    '''
+    One named dataset: its files, the RestApplication answering its URIs and its memory accounting
+    '''
+
+    def __init__(self, name, files, verbosity=0, cache_size=256, memory_budget=None, metrics=None, limits=None):
+        self.name = name
+        self.files = tuple(files)
+        self.memory_budget = memory_budget
+        self.app = RestApplication(Snapshot(self.files), verbosity, cache_size, metrics, limits=limits)
+        self.graph_memory = 0
+        self.last_used = None
+        self.loads = 0
+        self.unloads = 0
+
+    @property
+    def snapshot(self):
+        return self.app.snapshot
+
+    def load(self):
+        before = residentMemory()
+        self.snapshot.load()
+        # the growth of the process is the best measure but memory freed earlier gets reused
+        self.graph_memory = max(residentMemory() - before, sum(self.snapshot.triples.values()) * BYTES_PER_TRIPLE)
+        self.loads += 1
+        if self.memory_budget is not None:
+            if self.graph_memory > self.memory_budget:
+                self.unload()
+                raise DatasetError("Dataset {} needs about {} MB, its budget is {} MB".format(
+                    self.name, self.graph_memory // MB, self.memory_budget // MB))
+            # cached responses may use what the graphs leave of the budget
+            self.app.response_cache.max_bytes = self.memory_budget - self.graph_memory
+        return self
+
+    def unload(self):
+        '''
+        Forgets the loaded snapshot, cached responses and everything the query caches hold for
+        the dataset's files
+        '''
+        index = getSubjectIndex([])
+        for f in self.files:
+            index.remove(f)
+            FileCache.invalidate(f)
+        self.app.snapshot = Snapshot(self.files)
+        self.app.response_cache.entries.clear()
+        self.app.response_cache.size = 0
+        self.graph_memory = 0
+        self.unloads += 1
+
+    def memoryUsed(self):
+        if not self.snapshot.ready:
+            return 0
+        return self.graph_memory + self.app.response_cache.size
+
+    def status(self):
+        status = self.snapshot.status()
+        status.update({'name': self.name, 'memory_bytes': self.memoryUsed(), 'memory_budget_bytes': self.memory_budget,
+                       'last_used': self.last_used, 'loads': self.loads, 'unloads': self.unloads})
+        return status
+
+
+class DatasetsApplication(WSGIApplication):
+    '''
+    Routes /datasets/{name}/... to the dataset's RestApplication, loading it first if needed and
+    unloading other datasets to stay within memory_budget (bytes, None for no limit)
+    '''
+
+    CHEAP_ROUTES = [r"^/?$", r"^/health$", r"^/metrics$", r"^/datasets/?$"]
+
+    def __init__(self, datasets, memory_budget=None, idle_timeout=None, metrics=None):
+        self.datasets = {dataset.name: dataset for dataset in datasets}
+        self.memory_budget = memory_budget
+        self.idle_timeout = idle_timeout
+        self.metrics = metrics or ServerMetrics()
+        for dataset in datasets:
+            dataset.app.metrics = self.metrics
+
+    def route(self, request):
+        if request.path == '/health':
+            return self.respond('200 OK', {'status': 'ready', 'datasets': self.statuses()})
+
+        if request.path == '/metrics':
+            return self.metricsResponse()
+
+        if request.path == '/':
+            return self.respond('200 OK', {'message': 'You probably want to start at /datasets/{name}/projects',
+                                           'datasets': sorted(self.datasets)})
+
+        if request.path.rstrip('/') == '/datasets':
+            return self.respond('200 OK', self.statuses())
+
+        match = re.match(r"^/datasets/([^/]+)(/.*)?$", request.path)
+        if match is None:
+            return self.respond('404 Not Found', {'error': 'No match for supplied URI, use /datasets/{name}/...'})
+        dataset = self.datasets.get(match.group(1))
+        if dataset is None:
+            return self.respond('404 Not Found', {'error': 'No dataset named {}'.format(match.group(1))})
+        path = match.group(2) or '/'
+        if path in ('/', '/health'):
+            return self.respond('200 OK', dataset.status())
+
+        try:
+            self.acquire(dataset)
+        except DatasetError as e:
+            return self.respond('507 Insufficient Storage', {'error': str(e)})
+        except Exception as e:
+            return self.respond('500 Internal Server Error', {'error': 'Unable to load dataset {}: {}'.format(dataset.name, e)})
+        return dataset.app.route(request._replace(path=path))
+
+    def statuses(self):
+        return {name: self.datasets[name].status() for name in sorted(self.datasets)}
+
+    def acquire(self, dataset):
+        '''
+        Makes sure the dataset is loaded and marks it as the most recently used
+        '''
+        dataset.last_used = time.time()
+        self.unloadIdle()
+        if not dataset.snapshot.ready:
+            dataset.load()
+        self.enforceBudget(keep=dataset)
+        return dataset
+
+    def loaded(self):
+        return [d for d in self.datasets.values() if d.snapshot.ready]
+
+    def memoryUsed(self):
+        return sum(d.memoryUsed() for d in self.loaded())
+
+    def unloadIdle(self):
+        if self.idle_timeout is None:
+            return
+        now = time.time()
+        idle = [d for d in self.loaded() if d.last_used is not None and now - d.last_used > self.idle_timeout]
+        self.unload(idle)
+
+    def enforceBudget(self, keep=None):
+        '''
+        Unloads the least recently used datasets, except keep, until the loaded ones fit the budget
+        '''
+        if self.memory_budget is None:
+            return
+        victims = []
+        used = self.memoryUsed()
+        for dataset in sorted(self.loaded(), key=lambda d: d.last_used or 0):
+            if used <= self.memory_budget:
+                break
+            if dataset is keep:
+                continue
+            victims.append(dataset)
+            used -= dataset.memoryUsed()
+        self.unload(victims)
+
+    def unload(self, datasets):
+        if len(datasets) == 0:
+            return
+        for dataset in datasets:
+            dataset.unload()
+        gc.collect()
+
+    def preload(self):
+        '''
+        Loads datasets in the given order for as long as they fit the budget, the rest load on first use
+        '''
+        for dataset in self.datasets.values():
+            if self.memory_budget is not None and self.memoryUsed() >= self.memory_budget:
+                break
+            try:
+                dataset.load()
+            except DatasetError as e:
+                print(e)
+                continue
+            if self.memory_budget is not None and self.memoryUsed() > self.memory_budget:
+                self.unload([dataset])
+                break
+        return self.loaded()
+
+    def cacheStats(self):
+        stats = {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0}
+        for dataset in self.datasets.values():
+            for key, value in dataset.app.cacheStats().items():
+                stats[key] += value
+        return stats
+
+    def graphTriples(self):
+        triples = {}
+        for dataset in self.loaded():
+            triples.update(dataset.snapshot.triples)
+        return triples
+
+
+def serveDatasets(datasets, host='0.0.0.0', port=5000, workers=1, verbosity=0, cache_size=256,
+                  memory_budget=None, dataset_budgets=None, idle_timeout=None, limits=None):
+    '''
+    Serves several datasets under /datasets/{name}/ with pre-forked WSGI workers
+
+    :param datasets: list of (name, files)
+    :param memory_budget: bytes all loaded datasets may use together, None for no limit
+    :param dataset_budgets: {name: bytes} for the datasets that have a budget of their own
+    :param idle_timeout: seconds after which an unused dataset is unloaded
+    :param limits: query limits of every dataset, see RestParser
+    '''
+    dataset_budgets = dataset_budgets or {}
+    app = DatasetsApplication([Dataset(name, files, verbosity, cache_size, dataset_budgets.get(name), limits=limits)
+                               for name, files in datasets], memory_budget, idle_timeout)
+    QuietRequestHandler.verbosity = verbosity
+    server = make_server(host, port, app, handler_class=QuietRequestHandler)
+
+    # datasets loaded before the workers fork are shared by all of them
+    loading = threading.Thread(target=server.serve_forever, daemon=True)
+    loading.start()
+    try:
+        loaded = app.preload()
+    finally:
+        server.shutdown()
+        loading.join()
+    print("Loaded {} of {} datasets ({}), serving on http://{}:{}/datasets/ with {} worker(s)".format(
+        len(loaded), len(app.datasets), ", ".join(d.name for d in loaded), host, port, workers))
+
+    gc.freeze()
+
+    if workers <= 1 or not hasattr(os, 'fork'):
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    app.metrics.spool_dir = tempfile.mkdtemp(prefix='pynidm_metrics_')
+    try:
+        runWorkers(server, workers, app)
+    finally:
+        shutil.rmtree(app.metrics.spool_dir, ignore_errors=True)
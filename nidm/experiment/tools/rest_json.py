@@ -0,0 +1,100 @@
+'''
+JSON encoding for REST output.
+
+orjson is used when it is installed, otherwise simplejson.  Both encoders write ValueType and
+ActivityData namedtuples as objects, sets as lists and NumPy scalars and arrays as numbers and
+lists, so results can be passed in as the query functions return them.  Output is compact unless
+pretty=True is given.  NaN is written as null by orjson and as NaN by simplejson.
+
+The encoder can be picked with setEncoder() or the PYNIDM_JSON_ENCODER environment variable.
+'''
+import os
+from decimal import Decimal
+
+import numpy as np
+import simplejson
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    '''
+    Converts the types the encoders don't know about
+    '''
+    if hasattr(obj, '_asdict'):
+        return obj._asdict()
+    if isinstance(obj, (set, frozenset)):
+        try:
+            return sorted(obj)
+        except TypeError:
+            return list(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (Decimal, float)):
+        # float subclasses such as ValueColumn.LexicalFloat
+        return float(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+def orjsonDumps(obj, pretty=False):
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    if pretty:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, default=default, option=option)
+
+
+def simplejsonDumps(obj, pretty=False):
+    if pretty:
+        text = simplejson.dumps(obj, default=default, namedtuple_as_object=True, indent=2)
+    else:
+        text = simplejson.dumps(obj, default=default, namedtuple_as_object=True, separators=(',', ':'))
+    return text.encode('utf-8')
+
+
+ENCODERS = {'simplejson': simplejsonDumps}
+if orjson is not None:
+    ENCODERS['orjson'] = orjsonDumps
+
+encoder = None
+
+
+def setEncoder(name=None):
+    '''
+    Selects the encoder by name, None picks orjson when it is available
+
+    :param name: 'orjson', 'simplejson' or None
+    '''
+    global encoder
+    if name is None:
+        name = 'orjson' if 'orjson' in ENCODERS else 'simplejson'
+    if name not in ENCODERS:
+        raise ValueError("Unknown JSON encoder {}, available: {}".format(name, ", ".join(sorted(ENCODERS))))
+    encoder = name
+
+
+def dumps(obj, pretty=False):
+    '''
+    :return: UTF-8 encoded JSON bytes
+    '''
+    return ENCODERS[encoder](obj, pretty)
+
+
+def dumpsText(obj, pretty=False):
+    '''
+    :return: JSON as a str
+    '''
+    return dumps(obj, pretty).decode('utf-8')
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return simplejson.loads(data)
+
+
+setEncoder(os.environ.get('PYNIDM_JSON_ENCODER') or None)
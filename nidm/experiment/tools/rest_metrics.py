@@ -0,0 +1,362 @@
+'''
+Request metrics for the PyNIDM REST server, exposed in the Prometheus text format on /metrics.
+
+Every request is counted per route (the URI with its IDs replaced by placeholders, and per dataset
+for the /datasets/{name}/ URIs of a multi-dataset server) and status, its
+latency goes into a per route histogram and the number of requests in flight is tracked.  The
+rendered output also reports the response cache and lru_cache hit ratios, the triple counts of the
+loaded graphs and the process memory.
+
+With pre-forked workers every worker keeps its own counts and writes them to a spool directory
+(at most once a second), the worker answering /metrics adds up the files of all workers.  With the
+asyncio server requests are counted by the event loop process and the pool workers, which run the
+queries, spool their query cache and memory figures the same way.
+
+A streamed (NDJSON) request is timed until its last line has been sent.
+'''
+import os
+import re
+import json
+import time
+import glob
+import inspect
+
+from nidm.experiment import Query, Navigate
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+ROUTES = [
+    (r"^/?$", "/"),
+    (r"^/health/?$", "/health"),
+    (r"^/metrics/?$", "/metrics"),
+    (r"^/batch/?$", "/batch"),
+    (r"^/datasets/?$", "/datasets"),
+    (r"^/?projects/?$", "/projects"),
+    (r"^/?search/?$", "/search"),
+    (r"^/?instruments/?$", "/instruments"),
+    (r"^/?instruments/variables/?$", "/instruments/variables"),
+    (r"^/?statistics/projects/[^/]+/?$", "/statistics/projects/{project}"),
+    (r"^/?projects/[^/]+/?$", "/projects/{project}"),
+    (r"^/?subjects/[^/]+/?$", "/subjects/{subject}"),
+    (r"^/?projects/[^/]+/subjects/?$", "/projects/{project}/subjects"),
+    (r"^/?projects/[^/]+/subjects/[^/]+/?$", "/projects/{project}/subjects/{subject}"),
+    (r"^/?projects/[^/]+/subjects/[^/]+/instruments/?$", "/projects/{project}/subjects/{subject}/instruments"),
+    (r"^/?projects/[^/]+/subjects/[^/]+/instruments/[^/]+/?$", "/projects/{project}/subjects/{subject}/instruments/{instrument}"),
+    (r"^/?projects/[^/]+/subjects/[^/]+/derivatives/?$", "/projects/{project}/subjects/{subject}/derivatives"),
+    (r"^/?projects/[^/]+/subjects/[^/]+/derivatives/[^/]+/?$", "/projects/{project}/subjects/{subject}/derivatives/{derivative}"),
+]
+
+
+DATASET_PATH = re.compile(r"^/datasets/([^/]+)(/.*)?$")
+
+
+def datasetName(path):
+    '''
+    The dataset a /datasets/{name}/... path belongs to, None for other paths
+    '''
+    match = DATASET_PATH.match(path)
+    return match.group(1) if match else None
+
+
+def routeName(path):
+    '''
+    Maps a request path to its route template so IDs don't each get their own time series, the
+    /datasets/{name} prefix of a dataset's URIs is left out (see datasetName)
+    '''
+    match = DATASET_PATH.match(path)
+    if match:
+        path = match.group(2) or '/'
+    for pattern, name in ROUTES:
+        if re.match(pattern, path):
+            return name
+    return "other"
+
+
+def lruFunctions():
+    '''
+    Returns {name: function} for the lru_cache decorated functions of the Query and Navigate modules
+    '''
+    result = {}
+    for module in (Query, Navigate):
+        for key, value in vars(module).items():
+            if not inspect.isfunction(value) and not hasattr(value, 'cache_info'):
+                continue
+            # instrumented functions keep the lru_cache wrapper in __wrapped__
+            cached = value if hasattr(value, 'cache_info') else getattr(value, '__wrapped__', None)
+            # skip functions that are only imported into the module
+            if cached is not None and hasattr(cached, 'cache_info') and getattr(cached, '__module__', None) == module.__name__:
+                result["{}.{}".format(module.__name__.split('.')[-1], key)] = cached
+    return result
+
+
+def lruCaches():
+    '''
+    Returns {name: cache_info()} for the lru_cache decorated functions of the Query and Navigate modules
+    '''
+    return {name: cached.cache_info() for name, cached in lruFunctions().items()}
+
+
+def residentMemory():
+    '''
+    Resident set size of this process in bytes
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # ru_maxrss is in kilobytes on Linux, this is the peak rather than the current size
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def newRouteStats(route, dataset=None):
+    return {'route': route, 'dataset': dataset, 'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0, 'status': {}}
+
+
+def routeLabels(stats, **kwargs):
+    '''
+    The labels of a route's time series, with a dataset label for the routes of a dataset
+    '''
+    if stats.get('dataset') is None:
+        return labels(route=stats['route'], **kwargs)
+    return labels(route=stats['route'], dataset=stats['dataset'], **kwargs)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**kwargs):
+    return "{" + ",".join('{}="{}"'.format(k, escape(v)) for k, v in kwargs.items()) + "}"
+
+
+class TimedBody:
+    '''
+    A streamed response body that calls done() once, when it has been sent or closed
+    '''
+
+    def __init__(self, body, done):
+        self.body = body
+        self.done = done
+
+    def __iter__(self):
+        try:
+            for chunk in self.body:
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+        if self.done is not None:
+            done, self.done = self.done, None
+            done()
+
+
+class ServerMetrics:
+
+    def __init__(self, spool_dir=None, save_interval=1.0):
+        self.spool_dir = spool_dir
+        self.save_interval = save_interval
+        self.reset()
+
+    def reset(self):
+        '''
+        Starts counting from zero, used by freshly forked workers
+        '''
+        self.pid = os.getpid()
+        self.routes = {}
+        self.in_flight = 0
+        self.last_saved = 0.0
+
+    def started(self, path):
+        self.in_flight += 1
+        return routeName(path), datasetName(path), time.perf_counter()
+
+    def finished(self, token, status, app=None):
+        route, dataset, start = token
+        elapsed = time.perf_counter() - start
+        self.in_flight -= 1
+        # keyed by dataset and route, the spool files are JSON so the key is a string
+        key = route if dataset is None else '{}:{}'.format(dataset, route)
+        stats = self.routes.setdefault(key, newRouteStats(route, dataset))
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                stats['buckets'][i] += 1
+        stats['sum'] += elapsed
+        stats['count'] += 1
+        code = str(status).split(' ')[0]
+        stats['status'][code] = stats['status'].get(code, 0) + 1
+        self.save(app)
+
+    def finishedWith(self, token, response, app=None):
+        '''
+        Records a request once its response has been sent: now for a body of bytes, after the last
+        chunk (or when the client goes away) for a streamed body
+
+        :return: the response, with a streamed body wrapped
+        '''
+        if response is None or isinstance(response.body, bytes):
+            self.finished(token, response.status if response else '500', app)
+            return response
+        return response._replace(body=TimedBody(response.body, lambda: self.finished(token, response.status, app)))
+
+    def toDict(self, app=None):
+        result = {'pid': self.pid, 'routes': self.routes, 'in_flight': self.in_flight, 'memory': residentMemory()}
+        if app is not None:
+            result['response_cache'] = app.cacheStats()
+        result['lru'] = {name: {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
+                         for name, info in lruCaches().items()}
+        return result
+
+    def save(self, app=None, force=False):
+        if self.spool_dir is None:
+            return
+        now = time.time()
+        if not force and now - self.last_saved < self.save_interval:
+            return
+        self.last_saved = now
+        spool_file = os.path.join(self.spool_dir, 'metrics.{}.json'.format(self.pid))
+        with open(spool_file + '.tmp', 'w') as f:
+            json.dump(self.toDict(app), f)
+        os.replace(spool_file + '.tmp', spool_file)
+
+    def collect(self, app=None):
+        '''
+        Returns the metrics of this process, or of every worker when there is a spool directory
+        '''
+        own = self.toDict(app)
+        if self.spool_dir is None:
+            return [own]
+        workers = [own]
+        for spool_file in glob.glob(os.path.join(self.spool_dir, 'metrics.*.json')):
+            try:
+                with open(spool_file) as f:
+                    worker = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if worker['pid'] == self.pid:
+                continue
+            if not self.alive(worker['pid']):
+                # counters of dead workers still count, their gauges don't
+                worker['in_flight'] = 0
+                worker['memory'] = 0
+            workers.append(worker)
+        return workers
+
+    def alive(self, pid):
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+    def render(self, app):
+        '''
+        The Prometheus text exposition of all metrics
+        '''
+        workers = self.collect(app)
+        lines = []
+
+        routes = {}
+        for worker in workers:
+            for key, stats in worker['routes'].items():
+                total = routes.setdefault(key, newRouteStats(stats['route'], stats['dataset']))
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], stats['buckets'])]
+                total['sum'] += stats['sum']
+                total['count'] += stats['count']
+                for code, count in stats['status'].items():
+                    total['status'][code] = total['status'].get(code, 0) + count
+
+        lines.append("# HELP pynidm_requests_total REST requests by route and HTTP status")
+        lines.append("# TYPE pynidm_requests_total counter")
+        for key in sorted(routes):
+            for code in sorted(routes[key]['status']):
+                lines.append("pynidm_requests_total{} {}".format(routeLabels(routes[key], status=code), routes[key]['status'][code]))
+
+        lines.append("# HELP pynidm_request_duration_seconds REST request latency by route")
+        lines.append("# TYPE pynidm_request_duration_seconds histogram")
+        for key in sorted(routes):
+            stats = routes[key]
+            for bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+                lines.append("pynidm_request_duration_seconds_bucket{} {}".format(routeLabels(stats, le=bound), count))
+            lines.append("pynidm_request_duration_seconds_bucket{} {}".format(routeLabels(stats, le="+Inf"), stats['count']))
+            lines.append("pynidm_request_duration_seconds_sum{} {}".format(routeLabels(stats), stats['sum']))
+            lines.append("pynidm_request_duration_seconds_count{} {}".format(routeLabels(stats), stats['count']))
+
+        lines.append("# HELP pynidm_requests_in_flight REST requests currently being processed")
+        lines.append("# TYPE pynidm_requests_in_flight gauge")
+        lines.append("pynidm_requests_in_flight {}".format(sum(w['in_flight'] for w in workers)))
+
+        cache = {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0}
+        for worker in workers:
+            for key in cache:
+                cache[key] += worker.get('response_cache', {}).get(key, 0)
+        lines.append("# HELP pynidm_response_cache_requests_total Response cache lookups by result")
+        lines.append("# TYPE pynidm_response_cache_requests_total counter")
+        lines.append("pynidm_response_cache_requests_total{} {}".format(labels(result="hit"), cache['hits']))
+        lines.append("pynidm_response_cache_requests_total{} {}".format(labels(result="miss"), cache['misses']))
+        lines.append("# HELP pynidm_response_cache_hit_ratio Fraction of response cache lookups that were hits")
+        lines.append("# TYPE pynidm_response_cache_hit_ratio gauge")
+        lines.append("pynidm_response_cache_hit_ratio {}".format(self.ratio(cache['hits'], cache['misses'])))
+        lines.append("# HELP pynidm_response_cache_bytes Size of the cached response bodies")
+        lines.append("# TYPE pynidm_response_cache_bytes gauge")
+        lines.append("pynidm_response_cache_bytes {}".format(cache['bytes']))
+
+        lru = {}
+        for worker in workers:
+            for name, info in worker['lru'].items():
+                total = lru.setdefault(name, {'hits': 0, 'misses': 0, 'size': 0})
+                for key in total:
+                    total[key] += info[key]
+        lines.append("# HELP pynidm_lru_cache_hit_ratio Hit ratio of the in memory query caches")
+        lines.append("# TYPE pynidm_lru_cache_hit_ratio gauge")
+        for name in sorted(lru):
+            lines.append("pynidm_lru_cache_hit_ratio{} {}".format(labels(function=name), self.ratio(lru[name]['hits'], lru[name]['misses'])))
+        lines.append("# HELP pynidm_lru_cache_entries Entries held by the in memory query caches")
+        lines.append("# TYPE pynidm_lru_cache_entries gauge")
+        for name in sorted(lru):
+            lines.append("pynidm_lru_cache_entries{} {}".format(labels(function=name), lru[name]['size']))
+
+        lines.append("# HELP pynidm_graph_triples Triples in each loaded NIDM file")
+        lines.append("# TYPE pynidm_graph_triples gauge")
+        triples = app.graphTriples()
+        for f in sorted(triples):
+            lines.append("pynidm_graph_triples{} {}".format(labels(file=f), triples[f]))
+        lines.append("# HELP pynidm_loaded_graphs Number of loaded NIDM files")
+        lines.append("# TYPE pynidm_loaded_graphs gauge")
+        lines.append("pynidm_loaded_graphs {}".format(len(triples)))
+
+        if hasattr(app, 'datasets'):
+            # the datasets loaded in the process answering /metrics
+            lines.append("# HELP pynidm_dataset_loaded Whether a dataset is loaded")
+            lines.append("# TYPE pynidm_dataset_loaded gauge")
+            for name in sorted(app.datasets):
+                lines.append("pynidm_dataset_loaded{} {}".format(labels(dataset=name), int(app.datasets[name].snapshot.ready)))
+            lines.append("# HELP pynidm_dataset_memory_bytes Estimated memory of a loaded dataset (graphs and cached responses)")
+            lines.append("# TYPE pynidm_dataset_memory_bytes gauge")
+            for name in sorted(app.datasets):
+                lines.append("pynidm_dataset_memory_bytes{} {}".format(labels(dataset=name), app.datasets[name].memoryUsed()))
+            lines.append("# HELP pynidm_dataset_unloads_total Datasets unloaded to stay within the memory budget or when idle")
+            lines.append("# TYPE pynidm_dataset_unloads_total counter")
+            for name in sorted(app.datasets):
+                lines.append("pynidm_dataset_unloads_total{} {}".format(labels(dataset=name), app.datasets[name].unloads))
+
+        lines.append("# HELP pynidm_resident_memory_bytes Resident memory of the server processes")
+        lines.append("# TYPE pynidm_resident_memory_bytes gauge")
+        for worker in workers:
+            if worker['memory']:
+                lines.append("pynidm_resident_memory_bytes{} {}".format(labels(pid=worker['pid']), worker['memory']))
+        lines.append("# HELP pynidm_workers Number of live server processes reporting metrics")
+        lines.append("# TYPE pynidm_workers gauge")
+        lines.append("pynidm_workers {}".format(len([w for w in workers if w['memory']])))
+
+        return "\n".join(lines) + "\n"
+
+    def ratio(self, hits, misses):
+        if hits + misses == 0:
+            return 0.0
+        return hits / (hits + misses)
@@ -0,0 +1,799 @@
+'''
+Production server for the PyNIDM REST API (see `pynidm serve`).
+
+All NIDM files are loaded once into a Snapshot: every graph is parsed and pinned in OpenGraph's
+in-memory cache (so it isn't evicted however many files are served) and the subject index is built
+before any request is served.  The snapshot is treated as
+read-only from then on, so worker processes forked after loading share it copy-on-write instead
+of each re-reading the files.
+
+Two server modes are available: serve() runs pre-forked WSGI workers, serveAsync() accepts
+connections on an asyncio event loop and runs the query work in a bounded process pool.
+'''
+import os
+import sys
+import gc
+import select
+import socket
+import hashlib
+import re
+import glob
+import shutil
+import tempfile
+import time
+import collections
+import signal
+import asyncio
+import threading
+import multiprocessing
+from urllib import parse
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+from nidm.core import Constants
+from nidm.experiment import Query, Navigate, FileCache
+from nidm.experiment.SubjectIndex import getSubjectIndex
+from nidm.experiment.tools.rest import RestParser
+from nidm.experiment.tools.rest_metrics import ServerMetrics
+from nidm.experiment.tools import rest_tables, rest_json
+
+
+def findNIDMFiles(nidm_file_list=None, nidm_dir=None):
+    '''
+    Collects the files to serve from a comma separated list and/or a directory searched recursively for .ttl files
+
+    :param nidm_file_list: comma separated list of NIDM files
+    :param nidm_dir: directory to search
+    :return: sorted list of file names
+    '''
+    files = []
+    if nidm_file_list:
+        files.extend([f for f in nidm_file_list.split(',') if f])
+    if nidm_dir:
+        files.extend(glob.glob(os.path.join(nidm_dir, '**', '*.ttl'), recursive=True))
+    return sorted(set(files))
+
+
+class Snapshot:
+    '''
+    The set of NIDM files being served along with everything derived from them at load time
+    '''
+
+    def __init__(self, nidm_files):
+        self.files = tuple(nidm_files)
+        self.fingerprints = {}
+        self.triples = {}
+        self.fingerprint = None
+        self.last_modified = None
+        self.ready = False
+        self.error = None
+        self.load_seconds = None
+
+    def load(self):
+        '''
+        Parses every graph, builds the subject index and warms the project list, subject tables and
+        instrument catalog.  They are pinned in the query caches, so however many files there are
+        none of them is evicted and re-read (in each worker) while serving.
+        '''
+        start = time.time()
+        try:
+            with FileCache.VersionSnapshot():
+                for f in self.files:
+                    self.fingerprints[f] = Query.hashFile(f)
+                    self.triples[f] = len(FileCache.pin(Query.OpenGraph, f))
+                self.fingerprint = hashlib.md5(
+                    "".join("{}={}\n".format(f, self.fingerprints[f]) for f in sorted(self.files)).encode('utf-8')).hexdigest()
+                self.last_modified = max([os.path.getmtime(f) for f in self.files] or [time.time()])
+                getSubjectIndex(self.files)
+                for project in FileCache.pin(Navigate.getProjects, self.files):
+                    FileCache.pin(Navigate.getProjectSubjectTableCached, self.files, Navigate.expandID(project, Constants.NIIRI))
+                FileCache.pin(Navigate.getInstrumentCatalog, self.files)
+        except Exception as e:
+            self.error = str(e)
+            raise
+        self.load_seconds = time.time() - start
+        self.ready = True
+        return self
+
+    def status(self):
+        return {'status': 'ready' if self.ready else ('error' if self.error else 'loading'),
+                'files': len(self.files),
+                'triples': sum(self.triples.values()),
+                'load_seconds': self.load_seconds,
+                'error': self.error}
+
+
+NDJSON = 'application/x-ndjson'
+
+# set on responses that hold only part of the result because the query budget ran out
+TRUNCATED_HEADER = 'X-PyNIDM-Truncated'
+
+# the HTTP status of a query that ran out of budget, by QueryBudget.BudgetExceeded reason
+BUDGET_STATUS = {
+    'deadline': '504 Gateway Timeout',
+    'rows': '413 Payload Too Large',
+    'subjects': '413 Payload Too Large',
+    'cancelled': '499 Client Closed Request',
+}
+
+# the WSGI environ key QuietRequestHandler stores the client socket under
+CONNECTION_KEY = 'pynidm.connection'
+
+
+def connectionClosed(connection):
+    '''
+    True once the client closed its end of the socket (without reading anything the request left)
+    '''
+    try:
+        readable, _, _ = select.select([connection], [], [], 0)
+        if not readable:
+            return False
+        return connection.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+# Accept header media types served as tables, see rest_tables
+TABLE_MIMETYPES = [
+    (rest_tables.CSV_MIMETYPE, rest_tables.dataFrameToCSV),
+    (rest_tables.ARROW_MIMETYPE, rest_tables.dataFrameToArrow),
+    (rest_tables.PARQUET_MIMETYPE, rest_tables.dataFrameToParquet),
+    ('application/x-parquet', rest_tables.dataFrameToParquet),
+]
+
+# cancelled is an optional callable telling whether the client has gone away
+Request = collections.namedtuple('Request', ['method', 'path', 'query', 'headers', 'body', 'cancelled'], defaults=[None])
+Response = collections.namedtuple('Response', ['status', 'headers', 'body'])
+
+
+class ResponseCache:
+    '''
+    Bounded LRU cache of complete responses, limited both by entry count and by total body size
+    '''
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        response = self.entries.get(key)
+        if response is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key, response):
+        if self.max_entries <= 0 or len(response.body) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key).body)
+        self.entries[key] = response
+        self.size += len(response.body)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            key, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.body)
+
+
+class WSGIApplication:
+    '''
+    The WSGI entry point and the metrics around it, subclasses implement route(request)
+    '''
+
+    def __call__(self, environ, start_response):
+        headers = {key[5:].replace('_', '-').lower(): value for key, value in environ.items() if key.startswith('HTTP_')}
+        body = b''
+        length = environ.get('CONTENT_LENGTH')
+        if length:
+            body = environ['wsgi.input'].read(int(length))
+        connection = environ.get(CONNECTION_KEY)
+        request = Request(environ.get('REQUEST_METHOD', 'GET'), environ.get('PATH_INFO', '/') or '/',
+                          environ.get('QUERY_STRING', ''), headers, body,
+                          (lambda: connectionClosed(connection)) if connection is not None else None)
+        response = self.dispatch(request)
+        start_response(response.status, response.headers)
+        if isinstance(response.body, bytes):
+            return [response.body]
+        return response.body
+
+    def dispatch(self, request):
+        '''
+        :param request: Request
+        :return: Response
+        '''
+        token = self.metrics.started(request.path)
+        response = None
+        try:
+            response = self.route(request)
+        finally:
+            response = self.metrics.finishedWith(token, response, self)
+        return response
+
+    def route(self, request):
+        raise NotImplementedError
+
+    def respond(self, status, result, headers=None, pretty=False):
+        body = rest_json.dumps(result, pretty=pretty)
+        response_headers = [('Content-Type', 'application/json'), ('Content-Length', str(len(body))),
+                            ('Access-Control-Allow-Origin', '*')]
+        if headers:
+            response_headers.extend(headers)
+        return Response(status, response_headers, body)
+
+    def metricsResponse(self):
+        body = self.metrics.render(self).encode('utf-8')
+        return Response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'), ('Content-Length', str(len(body)))], body)
+
+
+class RestApplication(WSGIApplication):
+    '''
+    Answers REST API URIs from a Snapshot.  dispatch() works on plain Request / Response tuples so the
+    same application can be driven by the WSGI server or by the asyncio server.  /health returns 200
+    once the snapshot is loaded and 503 before that.  Every query runs within the limits, see
+    RestParser and QueryBudget.
+    '''
+
+    # routes answered straight from already cached data, these never need to wait behind heavy queries
+    CHEAP_ROUTES = [r"^/?$", r"^/health$", r"^/metrics$", r"^/?projects/?$"]
+
+    def __init__(self, snapshot, verbosity=0, cache_size=256, metrics=None, max_batch=100, limits=None):
+        self.snapshot = snapshot
+        self.verbosity = verbosity
+        self.max_batch = max_batch
+        self.limits = dict(limits or {})
+        self.response_cache = ResponseCache(max_entries=cache_size)
+        self.metrics = metrics or ServerMetrics()
+
+    def isCheap(self, request):
+        return any(re.match(route, request.path) for route in self.CHEAP_ROUTES)
+
+    def route(self, request):
+        if request.path == '/health':
+            return self.health()
+
+        if request.path == '/metrics':
+            return self.metricsResponse()
+
+        if not self.snapshot.ready:
+            return self.respond('503 Service Unavailable', {'error': 'NIDM files are still loading'})
+
+        if request.path == '/':
+            return self.respond('200 OK',
+                                {'message': 'You probably want to start at /projects  See docs/REST_API_definition.openapi.yaml for details on the API.'})
+
+        response = self.cachedResponse(request)
+        if response is None:
+            response = self.storeResponse(request, self.handle(request))
+        return response
+
+    def etag(self, request):
+        '''
+        The ETag of a REST response: a hash of the route, the normalized query parameters, the Accept
+        header and the fingerprint of the loaded files.  It only changes when one of those does.
+        '''
+        query = parse.urlencode(sorted(parse.parse_qsl(request.query, keep_blank_values=True)))
+        key = "\n".join([request.method, request.path.rstrip('/'), query, request.headers.get('accept', ''),
+                         str(self.snapshot.fingerprint)])
+        return '"{}"'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def validatorHeaders(self, etag):
+        return [('ETag', etag), ('Last-Modified', formatdate(self.snapshot.last_modified, usegmt=True)),
+                ('Cache-Control', 'no-cache'), ('Vary', 'Accept')]
+
+    def notModified(self, request, etag):
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+        if_modified_since = request.headers.get('if-modified-since')
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= int(self.snapshot.last_modified)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def cachedResponse(self, request):
+        '''
+        Returns a 304 if the client already has the current response, the cached response if there is
+        one, or None when the request has to be executed
+        '''
+        if request.method not in ('GET', 'HEAD') or not self.snapshot.ready:
+            return None
+        etag = self.etag(request)
+        if self.notModified(request, etag):
+            return Response('304 Not Modified', self.validatorHeaders(etag), b'')
+        return self.response_cache.get(etag)
+
+    def storeResponse(self, request, response):
+        '''
+        Adds the validators to a freshly computed response and keeps it if it was successful
+        '''
+        if request.method not in ('GET', 'HEAD') or not self.snapshot.ready:
+            return response
+        etag = self.etag(request)
+        response = response._replace(headers=response.headers + self.validatorHeaders(etag))
+        # partial results depend on how fast the query ran, don't serve them again
+        truncated = any(key == TRUNCATED_HEADER for key, value in response.headers)
+        if response.status.startswith('200') and isinstance(response.body, bytes) and not truncated:
+            self.response_cache.put(etag, response)
+        return response
+
+    def cacheStats(self):
+        return {'hits': self.response_cache.hits, 'misses': self.response_cache.misses,
+                'entries': len(self.response_cache.entries), 'bytes': self.response_cache.size}
+
+    def graphTriples(self):
+        return dict(self.snapshot.triples)
+
+    def health(self):
+        status = self.snapshot.status()
+        return self.respond('200 OK' if self.snapshot.ready else '503 Service Unavailable', status)
+
+    def run(self, path, query, cancelled=None):
+        '''
+        Executes one REST URI against the snapshot
+
+        :param cancelled: callable returning True once the client has gone away
+        :return: (http status, result object, budget reason if the result is partial or None)
+        '''
+        restParser = RestParser(output_format=RestParser.OBJECT_FORMAT, verbosity_level=self.verbosity,
+                                limits=self.limits, cancelled=cancelled)
+        command = "{}?{}".format(path, query) if query else path
+        result = restParser.run(self.snapshot.files, command)
+        if isinstance(result, dict) and result.get('error') == 'No match for supplied URI':
+            return '404 Not Found', result, None
+        if isinstance(result, dict) and result.get('budget') in BUDGET_STATUS:
+            return BUDGET_STATUS[result['budget']], result, None
+        return '200 OK', result, restParser.truncated
+
+    def handle(self, request):
+        if request.path.rstrip('/') == '/batch':
+            return self.batch(request)
+        if NDJSON in request.headers.get('accept', ''):
+            return self.streamResponse(request)
+        truncated = None
+        try:
+            status, result, truncated = self.run(request.path, request.query, request.cancelled)
+        except Exception as e:
+            status, result = '500 Internal Server Error', {'error': str(e)}
+        headers = [(TRUNCATED_HEADER, truncated)] if truncated else None
+        table_format = self.tableFormat(request)
+        if table_format is not None and status == '200 OK' and not (isinstance(result, dict) and 'error' in result):
+            return self.respondTable(result, *table_format, headers=headers)
+        return self.respond(status, result, headers=headers, pretty=self.isPretty(request))
+
+    def isPretty(self, request):
+        '''
+        ?pretty (or pretty=1/true) asks for indented JSON, responses are compact otherwise
+        '''
+        value = parse.parse_qs(request.query, keep_blank_values=True).get('pretty', [None])[0]
+        return value is not None and value.lower() not in ('0', 'false', 'no')
+
+    def tableFormat(self, request):
+        '''
+        The (media type, writer) of a columnar format named in the Accept header, or None for JSON
+        '''
+        accept = request.headers.get('accept', '')
+        for mimetype, writer in TABLE_MIMETYPES:
+            if mimetype in accept:
+                return mimetype, writer
+        return None
+
+    def respondTable(self, result, mimetype, writer, headers=None):
+        try:
+            body = writer(rest_tables.resultToDataFrame(result))
+        except rest_tables.TableFormatError as e:
+            return self.respond('406 Not Acceptable', {'error': str(e)})
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+            mimetype += '; charset=utf-8'
+        return Response('200 OK', [('Content-Type', mimetype), ('Content-Length', str(len(body))),
+                                   ('Access-Control-Allow-Origin', '*')] + (headers or []), body)
+
+    def batch(self, request):
+        '''
+        POST /batch with a JSON list of REST URIs (or {"uris": [...]}) runs all of them against the
+        snapshot in one go and returns a list of {"uri", "status", "result"}
+        '''
+        if request.method != 'POST':
+            return self.respond('405 Method Not Allowed', {'error': 'POST a JSON list of URIs to /batch'}, headers=[('Allow', 'POST')])
+        try:
+            uris = rest_json.loads(request.body or b'null')
+        except (ValueError, UnicodeDecodeError):
+            uris = None
+        if isinstance(uris, dict):
+            uris = uris.get('uris')
+        if not isinstance(uris, list) or not all(isinstance(u, str) for u in uris):
+            return self.respond('400 Bad Request', {'error': 'The request body must be a JSON list of URIs'})
+        if len(uris) > self.max_batch:
+            return self.respond('413 Payload Too Large', {'error': 'At most {} URIs per batch'.format(self.max_batch)})
+
+        restParser = RestParser(output_format=RestParser.OBJECT_FORMAT, verbosity_level=self.verbosity,
+                                limits=self.limits, cancelled=request.cancelled)
+        try:
+            return self.respond('200 OK', restParser.runBatch(self.snapshot.files, uris), pretty=self.isPretty(request))
+        except Exception as e:
+            return self.respond('500 Internal Server Error', {'error': str(e)})
+
+    def streamResponse(self, request):
+        '''
+        Newline delimited JSON, one record per line, written as the records are produced.  The body is
+        a generator so the response has no Content-Length and is never cached.
+        '''
+        restParser = RestParser(output_format=RestParser.OBJECT_FORMAT, verbosity_level=self.verbosity,
+                                limits=self.limits, cancelled=request.cancelled)
+        command = "{}?{}".format(request.path, request.query) if request.query else request.path
+
+        def lines():
+            try:
+                for record in restParser.stream(self.snapshot.files, command):
+                    yield rest_json.dumps(record) + b'\n'
+            except Exception as e:
+                # the status line is long gone, report the failure as the last record
+                yield rest_json.dumps({'error': str(e)}) + b'\n'
+
+        return Response('200 OK', [('Content-Type', NDJSON), ('Access-Control-Allow-Origin', '*')], lines())
+
+class QuietRequestHandler(WSGIRequestHandler):
+    verbosity = 0
+
+    def log_message(self, format, *args):
+        if self.verbosity > 0:
+            super().log_message(format, *args)
+
+    def get_environ(self):
+        # lets a running query notice that the client disconnected
+        environ = super().get_environ()
+        environ[CONNECTION_KEY] = self.connection
+        return environ
+
+
+def serve(nidm_files, host='0.0.0.0', port=5000, workers=1, verbosity=0, cache_size=256, limits=None):
+    '''
+    Binds the port, loads the snapshot (answering /health with 503 meanwhile) and then serves
+    requests from `workers` forked processes sharing the listening socket.  Dead workers are replaced
+    until the server receives SIGTERM or SIGINT.  A query stops when it exceeds the limits (see
+    RestParser) or its client disconnects, which frees the worker for the next request.
+    '''
+    snapshot = Snapshot(nidm_files)
+    app = RestApplication(snapshot, verbosity, cache_size, limits=limits)
+    QuietRequestHandler.verbosity = verbosity
+    server = make_server(host, port, app, handler_class=QuietRequestHandler)
+
+    loading = threading.Thread(target=server.serve_forever, daemon=True)
+    loading.start()
+    try:
+        snapshot.load()
+    finally:
+        server.shutdown()
+        loading.join()
+    print("Loaded {} files ({} triples) in {:.1f}s, serving on http://{}:{}/ with {} worker(s)".format(
+        len(snapshot.files), sum(snapshot.triples.values()), snapshot.load_seconds, host, port, workers))
+
+    # keep the garbage collector from touching (and so copying) the snapshot's pages in the workers
+    gc.freeze()
+
+    if workers <= 1 or not hasattr(os, 'fork'):
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    # each worker keeps its own metrics, /metrics adds up what they wrote to the spool directory
+    app.metrics.spool_dir = tempfile.mkdtemp(prefix='pynidm_metrics_')
+    try:
+        runWorkers(server, workers, app)
+    finally:
+        shutil.rmtree(app.metrics.spool_dir, ignore_errors=True)
+
+
+def runWorkers(server, workers, app):
+    children = set([])
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            app.metrics.reset()
+            app.metrics.save(app, force=True)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for i in range(workers):
+        spawn()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print("Worker {} exited with status {}, starting a replacement".format(pid, status))
+            spawn()
+
+    server.server_close()
+
+
+# the application used by the process pool workers of the asyncio server.  It is set before the
+# pool forks so the workers inherit the loaded snapshot.
+_worker_app = None
+
+# one flag per request slot of the asyncio server, set when the request's client is gone
+_cancel_flags = None
+
+
+def _initWorker(nidm_files, verbosity, limits, cancel_flags, spool_dir=None):
+    global _worker_app, _cancel_flags
+    # Ctrl-C goes to the whole process group, let the server shut the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _cancel_flags = cancel_flags
+    if _worker_app is None:
+        # no fork on this platform, the worker has to load its own copy
+        _worker_app = RestApplication(Snapshot(nidm_files).load(), verbosity, limits=limits)
+    # the requests are counted by the server, the worker reports its query caches and memory
+    _worker_app.metrics = ServerMetrics(spool_dir)
+    _worker_app.metrics.save(force=True)
+
+
+def _handleInWorker(request, slot=None):
+    if slot is not None:
+        request = request._replace(cancelled=lambda: _cancel_flags[slot] != 0)
+    response = _worker_app.handle(request)
+    if not isinstance(response.body, bytes):
+        # generators can't cross the process boundary, send the streamed body back whole
+        response = response._replace(body=b''.join(response.body))
+    _worker_app.metrics.save()
+    return response
+
+
+class AsyncRestServer:
+    '''
+    asyncio HTTP server that accepts requests concurrently and sends the CPU bound query work to a
+    bounded process pool.  Cheap routes (see RestApplication.CHEAP_ROUTES) are answered directly
+    on the event loop so they never queue behind heavy requests.  Requests that take longer than
+    `timeout` seconds get a 504 and new heavy requests are refused with a 503 while `max_queue`
+    are already waiting for or running in the pool.  When a request times out or its client
+    disconnects the query in the pool is cancelled (see QueryBudget) so the worker becomes free.
+    '''
+
+    def __init__(self, app, workers=2, timeout=60, max_queue=32):
+        self.app = app
+        self.workers = workers
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.pending = 0
+        self.pool = None
+        # bumped every time the pool is replaced, so a broken pool is only rebuilt once
+        self.generation = 0
+        self.cancel_flags = None
+        self.free_slots = list(range(max_queue))
+
+    def makePool(self):
+        global _worker_app
+        _worker_app = self.app
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        # shared with the workers, which poll the flag of the request they are running
+        self.cancel_flags = context.RawArray('b', self.max_queue)
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_initWorker,
+                                   initargs=(self.app.snapshot.files, self.app.verbosity, self.app.limits, self.cancel_flags,
+                                             self.app.metrics.spool_dir))
+        # start the workers now, while the snapshot is freshly loaded and nothing else is running
+        for f in [pool.submit(os.getpid) for i in range(self.workers)]:
+            f.result()
+        return pool
+
+    def rebuildPool(self, generation):
+        '''
+        Replaces a broken pool, unless another request already replaced the pool it was using
+        '''
+        if generation != self.generation:
+            return
+        old, self.pool = self.pool, self.makePool()
+        self.generation += 1
+        old.shutdown(wait=False)
+
+    async def respondTo(self, request, disconnected=None):
+        token = self.app.metrics.started(request.path)
+        response = None
+        try:
+            response = await self.execute(request, disconnected)
+        finally:
+            response = self.app.metrics.finishedWith(token, response, self.app)
+        return response
+
+    async def execute(self, request, disconnected=None):
+        '''
+        :param disconnected: optional future that completes when the client closes the connection
+        '''
+        if self.app.isCheap(request) or not self.app.snapshot.ready:
+            return self.app.route(request)
+
+        # conditional requests and repeats are answered here, the cache lives in this process
+        response = self.app.cachedResponse(request)
+        if response is not None:
+            return response
+
+        if self.pending >= self.max_queue:
+            return self.app.respond('503 Service Unavailable', {'error': 'Server busy, try again later'},
+                                    headers=[('Retry-After', '1')])
+
+        loop = asyncio.get_running_loop()
+        generation = self.generation
+        slot = self.free_slots.pop()
+        future = None
+        try:
+            self.cancel_flags[slot] = 0
+            future = self.pool.submit(_handleInWorker, request, slot)
+        except BrokenProcessPool:
+            self.rebuildPool(generation)
+            return self.app.respond('500 Internal Server Error', {'error': 'Worker process died'})
+        finally:
+            if future is None:
+                self.free_slots.append(slot)
+        self.pending += 1
+        # count the work as pending until the pool has really finished it, even if we time out first
+        future.add_done_callback(lambda f: self.finishedFromPool(loop, slot))
+        result = asyncio.wrap_future(future)
+        waiting = [result] if disconnected is None else [result, disconnected]
+        done, _ = await asyncio.wait(waiting, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+        if result in done:
+            try:
+                return self.app.storeResponse(request, result.result())
+            except BrokenProcessPool:
+                self.rebuildPool(generation)
+                return self.app.respond('500 Internal Server Error', {'error': 'Worker process died'})
+
+        # nobody will read the result, stop the query so the worker can take the next request
+        self.cancel_flags[slot] = 1
+        if len(done) == 0:
+            return self.app.respond('504 Gateway Timeout',
+                                    {'error': 'Request took longer than {} seconds'.format(self.timeout)})
+        return self.app.respond(BUDGET_STATUS['cancelled'], {'error': 'Client closed the connection'})
+
+    def finished(self, slot=None):
+        self.pending -= 1
+        if slot is not None:
+            self.free_slots.append(slot)
+
+    def finishedFromPool(self, loop, slot=None):
+        # runs on the pool's management thread
+        try:
+            loop.call_soon_threadsafe(self.finished, slot)
+        except RuntimeError:
+            # the loop is already closed, we are shutting down
+            pass
+
+    async def readRequest(self, reader):
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        body = b''
+        if int(headers.get('content-length', 0)) > 0:
+            body = await reader.readexactly(int(headers['content-length']))
+        path, _, query = target.partition('?')
+        return Request(method, parse.unquote(path) or '/', query, headers, body)
+
+    async def writeResponse(self, writer, response):
+        head = ["HTTP/1.1 {}".format(response.status)]
+        head.extend(["{}: {}".format(key, value) for key, value in response.headers])
+        head.append("Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1'))
+        if isinstance(response.body, bytes):
+            writer.write(response.body)
+        else:
+            for chunk in response.body:
+                writer.write(chunk)
+                await writer.drain()
+        await writer.drain()
+
+    async def clientClosed(self, reader):
+        '''
+        Completes once the client has closed the connection, anything it sends after the request is ignored
+        '''
+        try:
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+
+    async def handleConnection(self, reader, writer):
+        closed = None
+        response = None
+        try:
+            request = await self.readRequest(reader)
+            closed = asyncio.ensure_future(self.clientClosed(reader))
+            response = await self.respondTo(request, closed)
+            if not closed.done():
+                await self.writeResponse(writer, response)
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            if closed is not None:
+                closed.cancel()
+            if response is not None and hasattr(response.body, 'close'):
+                response.body.close()
+            writer.close()
+
+    async def run(self, host, port):
+        server = await asyncio.start_server(self.handleConnection, host, port)
+
+        # load in a thread so /health can answer 503 in the meantime
+        loader = threading.Thread(target=self.app.snapshot.load, daemon=True)
+        loader.start()
+        while loader.is_alive():
+            await asyncio.sleep(0.1)
+        if not self.app.snapshot.ready:
+            server.close()
+            raise RuntimeError("Unable to load NIDM files: {}".format(self.app.snapshot.error))
+
+        gc.freeze()
+        # the pool workers spool their metrics, /metrics adds them to the server's own
+        self.app.metrics.spool_dir = tempfile.mkdtemp(prefix='pynidm_metrics_')
+        self.pool = self.makePool()
+        snapshot = self.app.snapshot
+        print("Loaded {} files ({} triples) in {:.1f}s, serving on http://{}:{}/ with a pool of {} worker(s)".format(
+            len(snapshot.files), sum(snapshot.triples.values()), snapshot.load_seconds, host, port, self.workers))
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, server.close)
+            except NotImplementedError:
+                pass
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if sys.version_info >= (3, 9):
+                self.pool.shutdown(wait=False, cancel_futures=True)
+            else:
+                self.pool.shutdown(wait=False)
+            shutil.rmtree(self.app.metrics.spool_dir, ignore_errors=True)
+
+
+def serveAsync(nidm_files, host='0.0.0.0', port=5000, workers=2, verbosity=0, timeout=60, max_queue=32, cache_size=256,
+               limits=None):
+    '''
+    Serves the REST API with AsyncRestServer, queries stop by themselves after timeout seconds
+    '''
+    limits = dict(limits or {})
+    if limits.get('timeout') is None:
+        limits['timeout'] = timeout
+    app = RestApplication(Snapshot(nidm_files), verbosity, cache_size, limits=limits)
+    asyncio.run(AsyncRestServer(app, workers, timeout, max_queue).run(host, port))
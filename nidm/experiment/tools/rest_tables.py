@@ -0,0 +1,146 @@
+'''
+Columnar output for RestParser results: CSV, Arrow IPC stream and Parquet.
+
+REST results are turned into a pandas DataFrame whose columns are typed with ValueColumn (int64,
+float64 or categorical) so numbers arrive as numbers.  Field values keep the long format of the JSON
+result, one row per value, so repeated visits or fields sharing a label are all kept.  Arrow and
+Parquet need the optional pyarrow package.
+'''
+import io
+
+import pandas as pd
+
+from nidm.experiment.ValueColumn import ValueColumn, outputValue, toNumber
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CSV_MIMETYPE = 'text/csv'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+PARQUET_MIMETYPE = 'application/vnd.apache.parquet'
+
+
+class TableFormatError(Exception):
+    pass
+
+
+def typedDataFrame(df):
+    '''
+    Re-types every object or string column of a DataFrame with ValueColumn
+    '''
+    result = pd.DataFrame(index=range(len(df)))
+    for column in df.columns:
+        if pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column]):
+            result[column] = ValueColumn(df[column].tolist()).toPandas()
+        else:
+            result[column] = df[column].reset_index(drop=True)
+    return result
+
+
+def isValueType(x):
+    return hasattr(x, '_fields') and 'dataElement' in x._fields and 'value' in x._fields
+
+
+def fieldValuesDataFrame(field_values):
+    '''
+    One row per value: subject, data element, label, the value as written in the file, its unit and
+    numeric_value (float64, NaN where the value isn't a number)
+    '''
+    df = typedDataFrame(pd.DataFrame({'subject': [vt.subject for vt in field_values],
+                                      'dataElement': [vt.dataElement for vt in field_values],
+                                      'label': [vt.label for vt in field_values],
+                                      'unit': [vt.hasUnit for vt in field_values]}))
+    # the value column keeps the lexical form ("007", "3.50"), the same as the JSON and CSV output
+    df.insert(3, 'value', [None if vt.value is None else outputValue(vt.value) for vt in field_values])
+    numbers = [toNumber(vt.value) for vt in field_values]
+    df['numeric_value'] = pd.Series([float('nan') if n is None else n for n in numbers], dtype='float64')
+    return df
+
+
+def derivativesDataFrame(derivatives):
+    '''
+    One row per measurement of each stat collection
+    '''
+    records = []
+    for key, collection in derivatives.items():
+        for uri, measure in collection['values'].items():
+            records.append({'derivative': key, 'measurement': uri, 'label': measure['label'],
+                            'value': measure['value'], 'units': measure['units'], 'datumType': measure['datumType']})
+    return pd.DataFrame(records, columns=['derivative', 'measurement', 'label', 'value', 'units', 'datumType'])
+
+
+def resultToDataFrame(result):
+    '''
+    Converts a RestParser object format result to a typed DataFrame
+
+    :param result: list of ValueType, list of scalars, dict of lists, dict of stat collections or a flat dict
+    :return: pandas DataFrame
+    '''
+    if isinstance(result, dict) and isinstance(result.get('field_values'), list):
+        result = result['field_values']
+    if isinstance(result, pd.DataFrame):
+        df = result
+    elif isinstance(result, list) and len(result) > 0 and all(isValueType(x) for x in result):
+        return fieldValuesDataFrame(result)
+    elif isinstance(result, (list, tuple, set)):
+        if any(isinstance(x, (dict, list)) for x in result):
+            df = pd.DataFrame(list(result))
+        else:
+            df = pd.DataFrame({'value': [str(x) for x in result]})
+    elif isinstance(result, dict) and len(result) > 0 and all(isinstance(v, dict) and 'values' in v for v in result.values()):
+        df = derivativesDataFrame(result)
+    elif isinstance(result, dict) and all(isinstance(v, list) for v in result.values()) \
+            and len(set(len(v) for v in result.values())) <= 1:
+        df = pd.DataFrame(result)
+    elif isinstance(result, dict) and not any(isinstance(v, (dict, list, set)) for v in result.values()):
+        df = pd.DataFrame([result])
+    else:
+        raise TableFormatError("This result can't be represented as a table, use JSON instead")
+    return typedDataFrame(df)
+
+
+def dataFrameToCSV(df):
+    return df.to_csv(index=False)
+
+
+def dataFrameToArrow(df):
+    '''
+    :return: bytes in the Arrow IPC streaming format
+    '''
+    requirePyarrow('Arrow')
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def dataFrameToParquet(df):
+    '''
+    :return: bytes of a Parquet file
+    '''
+    requirePyarrow('Parquet')
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(pyarrow.Table.from_pandas(df, preserve_index=False), buffer)
+    return buffer.getvalue()
+
+
+def requirePyarrow(name):
+    if pyarrow is None:
+        raise TableFormatError("{} output needs the pyarrow package (pip install pyarrow)".format(name))
+
+
+def writerForFile(output_file):
+    '''
+    The columnar writer matching an output file extension (.parquet, .arrow or .arrows), None otherwise
+    '''
+    extension = output_file.lower().rsplit('.', 1)[-1] if output_file else ''
+    if extension == 'parquet':
+        return dataFrameToParquet
+    if extension in ('arrow', 'arrows'):
+        return dataFrameToArrow
+    return None
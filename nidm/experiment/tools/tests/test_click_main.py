@@ -0,0 +1,54 @@
+import os
+import sys
+import subprocess
+
+from click.testing import CliRunner
+
+from nidm.experiment.tools.click_main import cli
+
+# modules only some of the commands need, none of them may be imported to start pynidm
+HEAVY_MODULES = ['pandas', 'numpy', 'bids', 'datalad', 'graphviz', 'pydot', 'pyld', 'rapidfuzz', 'github', 'networkx',
+                 'nidm.experiment.Query', 'nidm.experiment.tools.rest', 'nidm.experiment.tools.nidm_query']
+
+# cumulative import time of click_main in microseconds, it was ~2s when every command was imported
+# up front and is ~0.3s with the lazy commands, the budget leaves room for slow machines
+STARTUP_BUDGET = 1500000
+
+
+def importTimes(code):
+    '''
+    Runs the code with python -X importtime and returns {module: cumulative microseconds}
+    '''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_us, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_help_lists_commands_without_importing_them():
+    res = CliRunner().invoke(cli, ['--help'])
+    assert res.exit_code == 0
+    for command in ['concat', 'convert', 'merge', 'query', 'search', 'serve', 'visualize']:
+        assert command in res.output
+
+    res = CliRunner().invoke(cli, ['query', '--help'])
+    assert res.exit_code == 0
+    assert '--nidm_file_list' in res.output
+
+
+def test_startup_import_time():
+    times = importTimes("from nidm.experiment.tools.click_main import cli; cli.main(['--help'], standalone_mode=False)")
+    assert [m for m in HEAVY_MODULES if m in times] == []
+    assert times['nidm.experiment.tools.click_main'] < STARTUP_BUDGET
+
+    # a command only imports what it needs (modules loaded with importlib aren't listed themselves)
+    times = importTimes("from nidm.experiment.tools.click_main import cli; cli.main(['query', '--help'], standalone_mode=False)")
+    assert 'nidm.experiment.tools.rest' in times
+    assert [m for m in ['bids', 'datalad', 'graphviz', 'pydot', 'pyld', 'github'] if m in times] == []
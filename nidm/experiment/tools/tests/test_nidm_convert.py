@@ -0,0 +1,73 @@
+import gzip
+
+from click.testing import CliRunner
+from rdflib import Graph, Dataset
+from rdflib.compare import isomorphic
+
+from nidm.experiment.tools.nidm_convert import convert
+
+TURTLE = '''
+@prefix prov: <http://www.w3.org/ns/prov#> .
+@prefix ex: <http://example.org/> .
+
+ex:{name} a prov:Agent ;
+    ex:age 50 ;
+    ex:entity [ ex:label "blank node" ] .
+'''
+
+
+def writeFiles(tmp_path):
+    files = []
+    for name in ["a", "b", "c"]:
+        file = tmp_path / (name + ".ttl")
+        file.write_text(TURTLE.format(name=name))
+        files.append(str(file))
+    return files
+
+
+def test_convert_streamed_and_gzip(tmp_path):
+    files = writeFiles(tmp_path)
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+
+    res = CliRunner().invoke(convert, ["-nl", ",".join(files), "-t", "nt", "-out", str(outdir), "--gzip", "--jobs", "2"])
+    assert res.exit_code == 0, res.output
+    for file in files:
+        name = file.split("/")[-1].replace(".ttl", ".nt.gz")
+        with gzip.open(str(outdir / name), "rt") as f:
+            assert isomorphic(Graph().parse(data=f.read(), format="nt"), Graph().parse(file))
+
+    res = CliRunner().invoke(convert, ["-nl", files[0], "-t", "nquads", "-out", str(outdir)])
+    assert res.exit_code == 0, res.output
+    result = Dataset()
+    result.parse(str(outdir / "a.nq"), format="nquads")
+    assert [len(g) for g in result.graphs() if len(g) > 0] == [4]
+
+
+def test_convert_fast(tmp_path):
+    files = writeFiles(tmp_path)
+    for type, extension, rdf_format in [("jsonld", ".json", "json-ld"), ("turtle", ".ttl", "turtle")]:
+        outdir = tmp_path / type
+        outdir.mkdir()
+        res = CliRunner().invoke(convert, ["-nl", files[1], "-t", type, "-out", str(outdir), "--fast"])
+        assert res.exit_code == 0, res.output
+        assert isomorphic(Graph().parse(str(outdir / ("b" + extension)), format=rdf_format), Graph().parse(files[1]))
+
+
+def test_convert_to_own_format(tmp_path):
+    files = writeFiles(tmp_path)
+    expected = Graph().parse(files[0])
+
+    # the output replaces the input once it is written
+    res = CliRunner().invoke(convert, ["-nl", files[0], "-t", "turtle", "--fast"])
+    assert res.exit_code == 0, res.output
+    assert isomorphic(Graph().parse(files[0]), expected)
+    assert sorted(f.name for f in tmp_path.iterdir()) == ["a.ttl", "b.ttl", "c.ttl"]
+
+    res = CliRunner().invoke(convert, ["-nl", files[0], "-t", "nt", "-out", str(tmp_path)])
+    assert res.exit_code == 0, res.output
+    nt_file = str(tmp_path / "a.nt")
+    res = CliRunner().invoke(convert, ["-nl", nt_file, "-t", "nt"])
+    assert res.exit_code != 0
+    assert "would be overwritten" in res.output
+    assert isomorphic(Graph().parse(nt_file), expected)
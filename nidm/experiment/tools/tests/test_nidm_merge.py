@@ -0,0 +1,90 @@
+from click.testing import CliRunner
+from rdflib import Graph, URIRef, Literal
+
+from nidm.core import Constants
+from nidm.experiment.tools.nidm_merge import merge
+
+SUBJECTS = '''
+@prefix ndar: <https://ndar.nih.gov/api/datadictionary/v2/dataelement/> .
+@prefix prov: <http://www.w3.org/ns/prov#> .
+@prefix niiri: <http://iri.nidash.org/> .
+@prefix ex: <http://example.org/> .
+
+{agents}
+'''
+
+
+def writeSubjects(file, agents):
+    turtle = "\n".join('niiri:{0} a prov:Agent ; ndar:src_subject_id "{1}" .\n'
+                       'ex:{0}_act prov:wasAssociatedWith niiri:{0} .'.format(uuid, subject_id)
+                       for uuid, subject_id in agents)
+    file.write_text(SUBJECTS.format(agents=turtle))
+    return str(file)
+
+
+def test_merge_by_subject_id(tmp_path):
+    files = [writeSubjects(tmp_path / "a.ttl", [("a1", "sub-0050"), ("a2", "51")]),
+             writeSubjects(tmp_path / "b.ttl", [("b1", "50"), ("b2", "52")]),
+             # 52 isn't in the first file but still merges with the second
+             writeSubjects(tmp_path / "c.ttl", [("c1", "0052"), ("c2", "51")])]
+
+    for name in ["merged.ttl", "merged.nt"]:
+        out = str(tmp_path / name)
+        res = CliRunner().invoke(merge, ["-nl", ",".join(files), "-s", "-o", out])
+        assert res.exit_code == 0, res.output
+
+        graph = Graph().parse(out)
+        agents = dict((str(s).split('/')[-1], str(o))
+                      for s, o in graph.subject_objects(Constants.NDAR['src_subject_id']))
+        assert sorted(agents) == ["a1", "a2", "b2"]
+        # the associations now point at the merged agents
+        associated = graph.value(URIRef("http://example.org/c2_act"), Constants.PROV['wasAssociatedWith'])
+        assert associated == URIRef("http://iri.nidash.org/a2")
+        assert set(graph.objects(URIRef("http://iri.nidash.org/b2"), Constants.NDAR['src_subject_id'])) == \
+            set([Literal("52"), Literal("0052")])
+
+    # without -s the files are only combined
+    out = str(tmp_path / "all.ttl")
+    assert CliRunner().invoke(merge, ["-nl", ",".join(files), "-o", out]).exit_code == 0
+    assert len(set(Graph().parse(out).subjects(Constants.NDAR['src_subject_id']))) == 6
+
+
+PROJECT_SUBJECTS = '''
+@prefix ndar: <https://ndar.nih.gov/api/datadictionary/v2/dataelement/> .
+@prefix prov: <http://www.w3.org/ns/prov#> .
+@prefix nidm: <http://purl.org/nidash/nidm#> .
+@prefix dct: <http://purl.org/dc/terms/> .
+@prefix niiri: <http://iri.nidash.org/> .
+
+niiri:p1 a nidm:Project .
+niiri:p2 a nidm:Project .
+niiri:s1 dct:isPartOf niiri:p1 .
+niiri:s2 dct:isPartOf niiri:p2 .
+{agents}
+'''
+
+
+def writeProjectSubjects(file, agents):
+    turtle = "\n".join('niiri:{0} a prov:Agent ; ndar:src_subject_id "{1}" .\n'
+                       'niiri:{0}_act dct:isPartOf niiri:{2} ; prov:qualifiedAssociation [ prov:agent niiri:{0} ] .'
+                       .format(uuid, subject_id, session) for uuid, subject_id, session in agents)
+    file.write_text(PROJECT_SUBJECTS.format(agents=turtle))
+    return str(file)
+
+
+def test_merge_keeps_projects_apart(tmp_path):
+    # both projects have a subject 1, "007" and "7" are two subjects of the same file
+    files = [writeProjectSubjects(tmp_path / "a.ttl", [("a1", "1", "s1"), ("a2", "1", "s2"), ("a3", "007", "s1"), ("a4", "7", "s2")]),
+             writeProjectSubjects(tmp_path / "b.ttl", [("b1", "1", "s2"), ("b2", "7", "s1")])]
+
+    out = str(tmp_path / "merged.ttl")
+    res = CliRunner().invoke(merge, ["-nl", ",".join(files), "-s", "-o", out])
+    assert res.exit_code == 0, res.output
+
+    graph = Graph().parse(out)
+    agents = sorted(str(s).split('/')[-1] for s in set(graph.subjects(Constants.NDAR['src_subject_id'])))
+    # b1 is the subject 1 of project 2, b2 matches the project 1 agent with ID 7 ("007")
+    assert agents == ["a1", "a2", "a3", "a4"]
+    assert set(graph.objects(URIRef("http://iri.nidash.org/a2"), Constants.NDAR['src_subject_id'])) == set([Literal("1")])
+    assert URIRef("http://iri.nidash.org/a3") in graph.objects(None, Constants.PROV['agent'])
+    assert len(list(graph.subjects(Constants.PROV['agent'], URIRef("http://iri.nidash.org/a2")))) == 2
@@ -12,3 +12,139 @@ def test_query_failing():
     assert "Missing option" in res.output
 
 # TODO: adding tests that are passing
+
+
+def test_query_daemon(tmp_path, monkeypatch):
+    import io
+    import os
+    import threading
+    from nidm.experiment.tools import query_daemon
+    from nidm.experiment.tools.tests.test_rest import makeTestFile
+
+    # makeTestFile also writes ./agent.ttl
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv(query_daemon.NO_DAEMON_ENV, raising=False)
+    makeTestFile('daemon.ttl', {'PROJECT_UUID': 'daemon_p1', 'PROJECT2_UUID': 'daemon_p2'})
+    socket_path = str(tmp_path / 'query.sock')
+    argv = ['query', '--socket', socket_path, '-nl', 'daemon.ttl', '-u', '/projects']
+
+    # no daemon yet, the query runs locally
+    assert query_daemon.forward(argv) is None
+
+    daemon = query_daemon.QueryDaemon(socket_path)
+    assert os.stat(socket_path).st_mode & 0o777 == 0o600
+    def serve():
+        while not daemon.stopping:
+            daemon.handle_request()
+    thread = threading.Thread(target=serve)
+    thread.start()
+    try:
+        out, err = io.BytesIO(), io.BytesIO()
+        assert query_daemon.forward(argv, out, err) == 0
+        assert 'daemon_p1' in out.getvalue().decode('utf-8')
+
+        # output files are written relative to the client's directory
+        assert query_daemon.forward(argv + ['-o', 'projects.csv'], out, err) == 0
+        assert (tmp_path / 'projects.csv').exists()
+
+        out, err = io.BytesIO(), io.BytesIO()
+        assert query_daemon.forward(['query', '--socket', socket_path, '-nl', 'daemon.ttl'], out, err) == 2
+        assert 'Query Type' in err.getvalue().decode('utf-8')
+    finally:
+        assert query_daemon.stop(socket_path)
+        thread.join()
+        daemon.server_close()
+    assert daemon.served == 3
+    assert not query_daemon.stop(socket_path)
+
+
+def test_query_daemon_socket_checks(tmp_path, monkeypatch):
+    import os
+    from nidm.experiment.tools import query_daemon
+
+    monkeypatch.delenv(query_daemon.NO_DAEMON_ENV, raising=False)
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    os.chmod(str(shared), 0o777)
+    # others could have put a socket there, the daemon won't use it and the client won't trust it
+    with pytest.raises(OSError):
+        query_daemon.QueryDaemon(str(shared / 'query.sock'))
+
+    socket_path = str(tmp_path / 'query.sock')
+    daemon = query_daemon.QueryDaemon(socket_path)
+    try:
+        connection = query_daemon.connect(socket_path)
+        assert connection is not None
+        connection.close()
+        os.chmod(str(tmp_path), 0o755)
+        assert query_daemon.connect(socket_path) is None
+        assert query_daemon.forward(['query', '--socket', socket_path, '-nl', 'a.ttl', '-u', '/projects']) is None
+    finally:
+        os.chmod(str(tmp_path), 0o700)
+        daemon.server_close()
+
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(shared))
+    monkeypatch.delenv(query_daemon.SOCKET_ENV, raising=False)
+    assert query_daemon.privateDirectory(os.path.dirname(query_daemon.defaultSocket()))
+
+
+def test_map_files_keeps_file_order():
+    from ..parallel import mapFiles
+    files = ['{}.ttl'.format(i) for i in range(6)]
+    assert list(mapFiles(len, files, jobs=3)) == [len(f) for f in files]
+    assert list(mapFiles(str.upper, files, jobs=3)) == list(mapFiles(str.upper, files))
+
+    runner = CliRunner()
+    res = runner.invoke(query, ['-nl', 'a.ttl', '-gf', 'age', '--jobs', '0'])
+    assert res.exit_code != 0
+    assert "--jobs" in res.output
+
+
+def test_instrument_catalog(tmp_path, monkeypatch):
+    from nidm.core import Constants
+    from nidm.experiment import Navigate, FileCache
+    from nidm.experiment.tools.rest import RestParser
+    from nidm.experiment.tools.nidm_query import instrumentCatalog
+    from nidm.experiment.tools.tests.test_rest import makeTestFile
+
+    # makeTestFile also writes ./agent.ttl
+    monkeypatch.chdir(tmp_path)
+    makeTestFile('catalog.ttl', {'PROJECT_UUID': 'cat_p1', 'PROJECT2_UUID': 'cat_p2'})
+    rest_parser = RestParser(output_format=RestParser.OBJECT_FORMAT)
+
+    instruments = rest_parser.run(['catalog.ttl'], '/instruments')
+    assert sorted(i['project'] for i in instruments) == ['cat_p1', 'cat_p2']
+    assert all(i['instrument'] == str(Constants.ONLI['assessment-instrument']) and i['count'] == 2 for i in instruments)
+
+    variables = rest_parser.run(['catalog.ttl'], '/instruments/variables?project=cat_p2')
+    assert set(v['project'] for v in variables) == {'cat_p2'}
+    assert [v['count'] for v in variables if v['variable'] == str(Constants.NCICB['Age'])] == [2]
+
+    df = instrumentCatalog(['catalog.ttl'], variables=True)
+    assert list(df.columns) == ['project', 'project_title', 'assessment_type', 'variables', 'count']
+    assert len(df) == len(variables) * 2
+
+    # a second process reads the catalog pickled for this version of the file
+    cached = Navigate.getFileInstrumentCatalog.__wrapped__
+    loaded = cached.loaded
+    FileCache.invalidate('catalog.ttl')
+    assert Navigate.getInstrumentCatalog(('catalog.ttl',)) == Navigate.getInstrumentCatalog(('catalog.ttl',))
+    assert cached.loaded == loaded + 1
+
+
+def test_project_fields_cli_format(tmp_path, monkeypatch):
+    from nidm.experiment.Navigate import makeValueType
+    from nidm.experiment.tools.rest import RestParser
+    from nidm.experiment.tools.tests.test_rest import makeTestFile
+
+    # makeTestFile also writes ./agent.ttl
+    monkeypatch.chdir(tmp_path)
+    makeTestFile('fields.ttl', {'PROJECT_UUID': 'fields_p1', 'PROJECT2_UUID': 'fields_p2'})
+    # the test file has no data elements, so stand in for the field lookup
+    monkeypatch.setattr(RestParser, 'iterFieldValues',
+                        lambda self, project_id: iter([makeValueType(value=9, label='age', subject='s1', hasUnit='years')]))
+
+    # --get_fields and query -u print the field values in the CLI format
+    table = RestParser(output_format=RestParser.CLI_FORMAT).run(['fields.ttl'], '/projects/fields_p1?fields=age')
+    assert table.split('\n')[0].split() == ['subject', 'label', 'value', 'unit']
+    assert table.split('\n')[2].split() == ['s1', 'age', '9', 'years']
@@ -0,0 +1,57 @@
+from click.testing import CliRunner
+from rdflib import Graph, Dataset, BNode
+from rdflib.compare import isomorphic
+
+from nidm.experiment.tools import rdf_stream
+from nidm.experiment.tools.nidm_concat import concat
+
+# both files use the blank node label b0 for different nodes
+FILE_A = '''
+_:b0 <http://example.org/name> "subject a" .
+<http://example.org/a> <http://example.org/agent> _:b0 .
+'''
+
+FILE_B = '''
+@prefix ex: <http://example.org/> .
+ex:b ex:agent [ ex:name "subject b" ] .
+ex:a ex:agent _:b0 .
+_:b0 ex:name "subject a2" .
+'''
+
+
+def writeFiles(tmp_path):
+    a = tmp_path / "a.nt"
+    b = tmp_path / "b.ttl"
+    a.write_text(FILE_A)
+    b.write_text(FILE_B)
+    return [str(a), str(b)]
+
+
+def test_concat_formats(tmp_path):
+    files = writeFiles(tmp_path)
+    expected = Graph()
+    for f in files:
+        expected.parse(f)
+
+    for name in ["all.nt", "all.ttl"]:
+        out = str(tmp_path / name)
+        assert rdf_stream.concatFiles(files, out, batch_size=2) == 6
+        result = Graph().parse(out)
+        assert isomorphic(result, expected)
+        # the blank nodes of the two files stayed apart
+        assert len(set(o for o in result.objects() if isinstance(o, BNode))) == 3
+
+    out = str(tmp_path / "all.nq")
+    rdf_stream.concatFiles(files, out)
+    result = Dataset()
+    result.parse(out, format="nquads")
+    graphs = dict((str(g.identifier), len(g)) for g in result.graphs() if len(g) > 0)
+    assert graphs == {(tmp_path / "a.nt").as_uri(): 2, (tmp_path / "b.ttl").as_uri(): 4}
+
+
+def test_concat_command_streams(tmp_path):
+    files = writeFiles(tmp_path)
+    out = str(tmp_path / "out.ttl")
+    res = CliRunner().invoke(concat, ["-nl", ",".join(files), "-o", out, "--stream"])
+    assert res.exit_code == 0, res.output
+    assert len(Graph().parse(out)) == 6
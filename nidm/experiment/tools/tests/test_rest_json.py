@@ -0,0 +1,41 @@
+import json
+
+import numpy as np
+import pytest
+
+from nidm.experiment.Navigate import makeValueType, ActivityData
+from nidm.experiment.tools import rest_json
+
+
+@pytest.mark.parametrize("encoder", sorted(rest_json.ENCODERS))
+def test_dumps(encoder):
+    rest_json.setEncoder(encoder)
+    try:
+        value_type = makeValueType(value=21, label='age', subject='s1')
+        result = {'field_values': [value_type],
+                  'activity': ActivityData(category='instrument', uuid='u1', data=[value_type]),
+                  'labels': {'b', 'a'},
+                  'count': np.int64(3),
+                  'values': np.array([1.5, 2.5])}
+
+        compact = rest_json.dumps(result)
+        assert isinstance(compact, bytes)
+        assert b'\n' not in compact
+        decoded = json.loads(compact)
+        assert decoded['field_values'][0]['value'] == 21
+        assert decoded['field_values'][0]['label'] == 'age'
+        assert decoded['activity']['data'][0]['subject'] == 's1'
+        assert decoded['labels'] == ['a', 'b']
+        assert decoded['count'] == 3
+        assert decoded['values'] == [1.5, 2.5]
+
+        pretty = rest_json.dumpsText(result, pretty=True)
+        assert '\n  "field_values"' in pretty
+        assert json.loads(pretty) == decoded
+    finally:
+        rest_json.setEncoder()
+
+
+def test_setEncoder():
+    with pytest.raises(ValueError):
+        rest_json.setEncoder('no-such-encoder')
@@ -0,0 +1,408 @@
+import io
+import json
+import asyncio
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from nidm.core import Constants
+from nidm.experiment import Navigate, Query
+from nidm.experiment.Navigate import makeValueType
+
+from nidm.experiment.tools.rest_server import Snapshot, RestApplication, AsyncRestServer, Request, findNIDMFiles
+from nidm.experiment.tools.rest_datasets import Dataset, DatasetsApplication, parseDatasetSpec
+from nidm.experiment.tools.rest_metrics import routeName, datasetName
+from nidm.experiment.tools.rest_tables import resultToDataFrame, dataFrameToArrow, TableFormatError
+from nidm.experiment.tools.tests.test_rest import makeTestFile
+
+
+def call(app, path, query='', headers=None):
+    environ = {}
+    setup_testing_defaults(environ)
+    environ['PATH_INFO'] = path
+    environ['QUERY_STRING'] = query
+    for key, value in (headers or {}).items():
+        environ['HTTP_' + key.upper().replace('-', '_')] = value
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = status
+        response['headers'] = dict(headers)
+
+    body = b''.join(app(environ, start_response))
+    if not body:
+        return response['status'], response['headers']
+    if response['headers']['Content-Type'].startswith('text/plain'):
+        return response['status'], body.decode('utf-8')
+    return response['status'], json.loads(body)
+
+
+def test_rest_application(tmp_path, monkeypatch):
+    # makeTestFile also writes ./agent.ttl
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'serve.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'serve_p1', 'PROJECT2_UUID': 'serve_p2'})
+    assert nidm_file in findNIDMFiles(nidm_dir=str(tmp_path))
+
+    snapshot = Snapshot([nidm_file])
+    app = RestApplication(snapshot)
+
+    status, result = call(app, '/health')
+    assert status.startswith('503')
+    assert result['status'] == 'loading'
+    status, result = call(app, '/projects')
+    assert status.startswith('503')
+
+    snapshot.load()
+    status, result = call(app, '/health')
+    assert status.startswith('200')
+    assert result['triples'] > 0
+
+    status, result = call(app, '/projects')
+    assert status.startswith('200')
+    assert sorted(result) == ['serve_p1', 'serve_p2']
+
+    status, result = call(app, '/no/such/route')
+    assert status.startswith('404')
+
+
+def test_async_rest_server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'serve_async.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'async_p1', 'PROJECT2_UUID': 'async_p2'})
+    app = RestApplication(Snapshot([nidm_file]).load())
+
+    server = AsyncRestServer(app, workers=1, timeout=30, max_queue=1)
+    (tmp_path / 'spool').mkdir()
+    app.metrics.spool_dir = str(tmp_path / 'spool')
+    server.pool = server.makePool()
+    try:
+        response = asyncio.run(server.respondTo(Request('GET', '/projects/async_p1/subjects', '', {}, b'')))
+        assert response.status.startswith('200')
+        assert len(json.loads(response.body)['uuid']) == 3
+        # the pool worker reports its query caches and memory next to the server's
+        text = app.metrics.render(app)
+        assert 'pynidm_workers 2' in text
+        assert 'pynidm_requests_total{route="/projects/{project}/subjects",status="200"} 1' in text
+
+        # a full queue turns heavy requests away but cheap ones are still answered
+        server.pending = 1
+        response = asyncio.run(server.respondTo(Request('GET', '/projects/async_p2/subjects', '', {}, b'')))
+        assert response.status.startswith('503')
+        # ... unless the response is already cached
+        response = asyncio.run(server.respondTo(Request('GET', '/projects/async_p1/subjects', '', {}, b'')))
+        assert response.status.startswith('200')
+        response = asyncio.run(server.respondTo(Request('GET', '/projects', '', {}, b'')))
+        assert response.status.startswith('200')
+    finally:
+        server.pool.shutdown()
+
+
+class BrokenPool:
+    def __init__(self, broken_futures=False):
+        self.broken_futures = broken_futures
+        self.shut_down = False
+
+    def submit(self, *args):
+        if not self.broken_futures:
+            raise BrokenProcessPool('worker died')
+        future = Future()
+        future.set_exception(BrokenProcessPool('worker died'))
+        return future
+
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+
+def test_async_broken_pool(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'serve_broken.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'broken_p1', 'PROJECT2_UUID': 'broken_p2'})
+    app = RestApplication(Snapshot([nidm_file]).load())
+    server = AsyncRestServer(app, workers=1, timeout=30, max_queue=4)
+    server.cancel_flags = [0] * 4
+    pools = []
+
+    def makePool():
+        pools.append(BrokenPool(broken_futures=True))
+        return pools[-1]
+    monkeypatch.setattr(server, 'makePool', makePool)
+
+    async def requests(n):
+        return await asyncio.gather(*[server.respondTo(Request('GET', '/projects/broken_p{}/subjects'.format(i % 2 + 1), 'n={}'.format(i), {}, b''))
+                                      for i in range(n)])
+
+    # submit itself fails on a pool that is already broken, the slot still goes back
+    server.pool = broken = BrokenPool()
+    responses = asyncio.run(requests(1))
+    assert responses[0].status.startswith('500')
+    assert len(pools) == 1 and server.pool is pools[0] and broken.shut_down
+    assert server.pending == 0 and sorted(server.free_slots) == [0, 1, 2, 3]
+
+    # concurrent requests that all see the broken pool only rebuild it once
+    responses = asyncio.run(requests(3))
+    assert all(r.status.startswith('500') for r in responses)
+    assert len(pools) == 2 and pools[0].shut_down and not pools[1].shut_down
+    assert server.pending == 0 and sorted(server.free_slots) == [0, 1, 2, 3]
+
+
+def test_conditional_requests(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'serve_etag.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'etag_p1', 'PROJECT2_UUID': 'etag_p2'})
+    app = RestApplication(Snapshot([nidm_file]).load(), cache_size=2)
+
+    first = app.dispatch(Request('GET', '/projects/etag_p1/subjects', 'a=1&b=2', {}, b''))
+    etag = dict(first.headers)['ETag']
+    assert app.response_cache.misses == 1
+
+    # same URI with the parameters in another order is the same resource
+    second = app.dispatch(Request('GET', '/projects/etag_p1/subjects', 'b=2&a=1', {}, b''))
+    assert dict(second.headers)['ETag'] == etag
+    assert second.body == first.body
+    assert app.response_cache.hits == 1
+
+    status, headers = call(app, '/projects/etag_p1/subjects', 'a=1&b=2', {'If-None-Match': etag})
+    assert status.startswith('304')
+    assert headers['ETag'] == etag
+
+    other = app.dispatch(Request('GET', '/projects/etag_p2/subjects', '', {}, b''))
+    assert dict(other.headers)['ETag'] != etag
+
+    # a different file set changes every ETag
+    changed = str(tmp_path / 'serve_etag2.ttl')
+    makeTestFile(changed, {'PROJECT_UUID': 'etag_p1', 'PROJECT2_UUID': 'etag_p3'})
+    app2 = RestApplication(Snapshot([changed]).load())
+    assert app2.etag(Request('GET', '/projects/etag_p1/subjects', 'a=1&b=2', {}, b'')) != etag
+
+    app.dispatch(Request('GET', '/projects/etag_p1', '', {}, b''))
+    assert len(app.response_cache.entries) == 2
+
+
+def test_paging_and_ndjson(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'serve_page.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'page_p1', 'PROJECT2_UUID': 'page_p2'})
+    app = RestApplication(Snapshot([nidm_file]).load())
+
+    status, everything = call(app, '/projects/page_p1/subjects')
+    assert len(everything['uuid']) == 3
+    status, page = call(app, '/projects/page_p1/subjects', 'limit=1&offset=1')
+    assert page['uuid'] == everything['uuid'][1:2]
+    assert page['subject id'] == everything['subject id'][1:2]
+    status, result = call(app, '/projects/page_p1/subjects', 'limit=-1')
+    assert 'error' in result
+
+    response = app.dispatch(Request('GET', '/projects/page_p1/subjects', 'limit=5', {'accept': 'application/x-ndjson'}, b''))
+    assert dict(response.headers)['Content-Type'] == 'application/x-ndjson'
+    records = [json.loads(line) for line in b''.join(response.body).splitlines()]
+    assert [r['uuid'] for r in records] == everything['uuid']
+
+
+def test_metrics(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'serve_metrics.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'metrics_p1', 'PROJECT2_UUID': 'metrics_p2'})
+    app = RestApplication(Snapshot([nidm_file]).load())
+
+    call(app, '/projects/metrics_p1/subjects')
+    call(app, '/projects/metrics_p2/subjects')
+    call(app, '/projects/metrics_p2/subjects')
+    call(app, '/no/such/route')
+
+    status, text = call(app, '/metrics')
+    assert status.startswith('200')
+    assert 'pynidm_requests_total{route="/projects/{project}/subjects",status="200"} 3' in text
+    assert 'pynidm_requests_total{route="other",status="404"} 1' in text
+    assert routeName('/search') == '/search'
+    assert routeName('/datasets/a/projects') == '/projects' and datasetName('/datasets/a/projects') == 'a'
+    assert routeName('/instruments') == '/instruments'
+    assert routeName('/instruments/variables/') == '/instruments/variables'
+    assert 'pynidm_request_duration_seconds_count{route="/projects/{project}/subjects"} 3' in text
+    assert 'pynidm_response_cache_hit_ratio 0.25' in text
+    assert 'pynidm_graph_triples{{file="{}"}}'.format(nidm_file) in text
+    # the /metrics request itself is in flight
+    assert 'pynidm_requests_in_flight 1' in text
+
+    # a streamed request is timed until its body has been sent
+    response = app.dispatch(Request('GET', '/projects/metrics_p1/subjects', '', {'accept': 'application/x-ndjson'}, b''))
+    assert app.metrics.in_flight == 1
+    assert len(b''.join(response.body).splitlines()) == 3
+    assert app.metrics.in_flight == 0
+    assert app.metrics.routes['/projects/{project}/subjects']['count'] == 4
+
+
+def test_batch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'serve_batch.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'batch_p1', 'PROJECT2_UUID': 'batch_p2'})
+    app = RestApplication(Snapshot([nidm_file]).load(), max_batch=4)
+
+    uris = ['/projects', '/projects/batch_p1/subjects', '/no/such/route', '/projects']
+    response = app.dispatch(Request('POST', '/batch', '', {}, json.dumps(uris).encode('utf-8')))
+    assert response.status.startswith('200')
+    results = json.loads(response.body)
+    assert [r['uri'] for r in results] == uris
+    assert [r['status'] for r in results] == [200, 200, 404, 200]
+    assert sorted(results[0]['result']) == ['batch_p1', 'batch_p2']
+    assert len(results[1]['result']['uuid']) == 3
+
+    assert app.dispatch(Request('GET', '/batch', '', {}, b'')).status.startswith('405')
+    assert app.dispatch(Request('POST', '/batch', '', {}, b'{"not": "a list"}')).status.startswith('400')
+    too_many = json.dumps({'uris': ['/projects'] * 5}).encode('utf-8')
+    assert app.dispatch(Request('POST', '/batch', '', {}, too_many)).status.startswith('413')
+
+
+def test_subject_table(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'serve_subjects.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'subjects_p1', 'PROJECT2_UUID': 'subjects_p2'})
+    app = RestApplication(Snapshot([nidm_file]).load())
+
+    # the table was built when the snapshot loaded and is shared by UUID and URI lookups
+    table = Navigate.getProjectSubjectTable(app.snapshot.files, Constants.NIIRI['subjects_p1'])
+    assert Navigate.getProjectSubjectTable(app.snapshot.files, 'subjects_p1') is table
+    # two subjects share one acquisition, both are listed
+    assert sorted(row.subject_id for row in table) == ['a1_8888', 'a1_9999', 'a2_7777']
+    for row in table:
+        assert len(row.sessions) == 1 and row.acquisitions == 1 and len(row.instruments) == 1 and row.derivatives == ()
+
+    status, result = call(app, '/projects/subjects_p2/subjects')
+    assert status.startswith('200')
+    assert sorted(result['subject id']) == ['a3_6666', 'a4_5555']
+    assert result['sessions'] == [1, 1] and result['acquisitions'] == [1, 1]
+    assert result['instruments'] == [1, 1] and result['derivatives'] == [0, 0]
+
+
+def test_query_budget(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'serve_budget.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'budget_p1', 'PROJECT2_UUID': 'budget_p2'})
+    app = RestApplication(Snapshot([nidm_file]).load(), limits={'max_rows': 2})
+
+    # the server's limit can't be raised by the query
+    status, result = call(app, '/projects/budget_p1/subjects', 'max_rows=5')
+    assert status.startswith('413')
+    assert result['budget'] == 'rows'
+    status, result = call(app, '/projects/budget_p1/subjects', 'max_rows=0')
+    assert 'error' in result
+
+    request = Request('GET', '/projects/budget_p1/subjects', 'partial', {}, b'')
+    response = app.dispatch(request)
+    assert response.status.startswith('200')
+    assert dict(response.headers)['X-PyNIDM-Truncated'] == 'rows'
+    assert len(json.loads(response.body)['uuid']) == 2
+    # partial results are not cached
+    assert app.etag(request) not in app.response_cache.entries
+
+    status, result = call(app, '/projects/budget_p2/subjects')
+    assert status.startswith('200') and len(result['uuid']) == 2
+
+    response = app.dispatch(Request('GET', '/projects/budget_p1/subjects', 'max_rows=1&partial=1',
+                                    {'accept': 'application/x-ndjson'}, b''))
+    records = [json.loads(line) for line in b''.join(response.body).splitlines()]
+    assert len(records) == 2 and records[-1] == {'truncated': 'rows'}
+
+    # a query stops once its client has gone away
+    response = app.dispatch(Request('GET', '/projects/budget_p2/subjects', 'max_subjects=10', {}, b'', lambda: True))
+    assert response.status.startswith('499')
+
+
+def test_table_formats(tmp_path, monkeypatch):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'serve_tables.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'tables_p1', 'PROJECT2_UUID': 'tables_p2'})
+    app = RestApplication(Snapshot([nidm_file]).load())
+
+    def get(path, accept):
+        return app.handle(Request('GET', path, '', {'accept': accept}, b''))
+
+    response = get('/projects/tables_p1/subjects', 'text/csv')
+    assert response.status.startswith('200')
+    assert dict(response.headers)['Content-Type'].startswith('text/csv')
+    assert response.body.decode('utf-8').splitlines()[0] == 'uuid,subject id,sessions,acquisitions,instruments,derivatives'
+
+    response = get('/projects/tables_p1/subjects', 'application/vnd.apache.arrow.stream')
+    table = pyarrow.ipc.open_stream(response.body).read_all()
+    assert table.num_rows == 3 and table.column_names[:2] == ['uuid', 'subject id']
+    assert table.schema.field('acquisitions').type == pyarrow.int64()
+
+    response = get('/projects/tables_p1/subjects', 'application/vnd.apache.parquet')
+    table = pyarrow.parquet.read_table(io.BytesIO(response.body))
+    assert table.num_rows == 3
+
+    # nested results have no table form
+    with pytest.raises(TableFormatError):
+        resultToDataFrame({'subjects': {'uuid': ['a']}, 'title': 'nested'})
+
+    # field values stay one row per value, a second visit of the same field isn't lost
+    values = [makeValueType(label='age', value='21', subject='s1', dataElement='de_age', hasUnit='years'),
+              makeValueType(label='age', value='22', subject='s1', dataElement='de_age', hasUnit='years'),
+              makeValueType(label='age', value='007', subject='s2', dataElement='de_age', hasUnit='years'),
+              makeValueType(label='site', value='CMU', subject='s1', dataElement='de_site')]
+    df = resultToDataFrame({'field_values': values})
+    assert list(df.columns) == ['subject', 'dataElement', 'label', 'value', 'unit', 'numeric_value']
+    assert len(df) == 4
+    assert list(df['value']) == ['21', '22', '007', 'CMU']
+    assert str(df['subject'].dtype) == 'category'
+    assert str(df['numeric_value'].dtype) == 'float64'
+    table = pyarrow.ipc.open_stream(dataFrameToArrow(df)).read_all()
+    assert table.column('value').to_pylist() == ['21', '22', '007', 'CMU']
+    assert table.column('numeric_value').to_pylist()[:3] == [21.0, 22.0, 7.0]
+
+
+def test_datasets(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ('one', 'two'):
+        (tmp_path / name).mkdir()
+        makeTestFile(str(tmp_path / name / 'data.ttl'), {'PROJECT_UUID': name + '_p1', 'PROJECT2_UUID': name + '_p2'})
+
+    specs = [parseDatasetSpec('{}={}'.format(name, tmp_path / name)) for name in ('one', 'two')]
+    assert specs[0] == ('one', [str(tmp_path / 'one' / 'data.ttl')])
+    # a budget of one byte only ever leaves the dataset in use loaded
+    app = DatasetsApplication([Dataset(name, files) for name, files in specs], memory_budget=1)
+
+    status, result = call(app, '/datasets')
+    assert status.startswith('200')
+    assert [result[name]['status'] for name in ('one', 'two')] == ['loading', 'loading']
+
+    status, result = call(app, '/datasets/one/projects')
+    assert status.startswith('200')
+    assert sorted(result) == ['one_p1', 'one_p2']
+
+    status, result = call(app, '/datasets/two/projects')
+    assert sorted(result) == ['two_p1', 'two_p2']
+    assert app.datasets['two'].snapshot.ready
+    assert not app.datasets['one'].snapshot.ready
+    assert app.datasets['one'].unloads == 1
+    # a loaded dataset's graphs are pinned, an unloaded one's are gone
+    pinned = [entry[2] for entry in Query.OpenGraph.__wrapped__.pinned.values()]
+    assert specs[1][1][0] in pinned and specs[0][1][0] not in pinned
+
+    # unloaded datasets come back on their next request
+    status, result = call(app, '/datasets/one/projects/one_p1/subjects')
+    assert status.startswith('200')
+    assert len(result['uuid']) > 0
+
+    status, result = call(app, '/datasets/three/projects')
+    assert status.startswith('404')
+    status, result = call(app, '/projects')
+    assert status.startswith('404')
+
+    status, result = call(app, '/metrics')
+    assert 'pynidm_requests_total{route="/projects",dataset="two",status="200"} 1' in result
+    assert 'pynidm_request_duration_seconds_count{route="/projects/{project}/subjects",dataset="one"} 1' in result
+    assert 'pynidm_requests_total{route="/datasets",status="200"} 1' in result
+    assert 'pynidm_dataset_loaded{dataset="one"} 1' in result
+    assert 'pynidm_dataset_unloads_total{dataset="two"} 1' in result
+
+    # a dataset bigger than its own budget is refused
+    app = DatasetsApplication([Dataset('tiny', specs[0][1], memory_budget=1)])
+    status, result = call(app, '/datasets/tiny/projects')
+    assert status.startswith('507')
@@ -122,3 +122,19 @@ def test_getTailOfURI():
     assert restParser.getTailOfURI('http://purl.org/nidash/fsl#fsl_000020') == 'fsl_000020'
     assert restParser.getTailOfURI('https://surfer.nmr.mgh.harvard.edu/fs_00005') == 'fs_00005'
 
+
+
+def test_project_statistics_group_by(tmp_path, monkeypatch):
+    from nidm.experiment.tools.tests.test_rest import makeTestFile
+
+    # makeTestFile also writes ./agent.ttl
+    monkeypatch.chdir(tmp_path)
+    nidm_file = str(tmp_path / 'group_by.ttl')
+    makeTestFile(nidm_file, {'PROJECT_UUID': 'group_by_p1', 'PROJECT2_UUID': 'group_by_p2'})
+
+    stats = restParser.run([nidm_file], "/statistics/projects/group_by_p1?fields=instruments.Age,instruments.handedness&group_by=instruments.Diagnosis")
+    assert [g['group']['Diagnosis'] for g in stats['Age']] == ['Anxiety', 'ADHD']
+    assert stats['Age'][0]['max'] == 9
+    assert stats['Age'][1]['count'] == 2
+    assert 'p95' in stats['Age'][1]['percentiles']
+    assert stats['handedness'][1]['categories'] == {'L': 2}
@@ -24,6 +24,7 @@ CLASSIFIERS = ["Development Status :: 3 - Alpha",
                "Operating System :: MacOS :: MacOS X",
                "Operating System :: POSIX :: Linux",
                "Programming Language :: Python :: 3",
+               "Programming Language :: Python :: 3 :: Only",
                "Topic :: Scientific/Engineering"]
 
 # Description should be a one-liner:
@@ -51,6 +52,7 @@ DOWNLOAD_URL = ""
 LICENSE = "Apache License 2.0"
 AUTHOR = "INCF-NIDASH developers"
 AUTHOR_EMAIL = "incf-nidash-nidm@googlegroups.com"
+PYTHON_REQUIRES = ">=3.7"
 MAJOR = _version_major
 MINOR = _version_minor
 MICRO = _version_micro
@@ -3,7 +3,7 @@ from flask_restful import Resource, Api
 import glob
 from nidm.experiment.tools.rest import RestParser
 from flask_cors import CORS
-import simplejson
+from nidm.experiment.tools import rest_json
 
 def getTTLFiles():
     files = []
@@ -24,7 +24,7 @@ class NIDMRest(Resource):
             return ({'error' : 'No NIDM files found. You may need to add NIDM ttl files to ~/PyNIDM/ttl'})
         restParser = RestParser(output_format=RestParser.OBJECT_FORMAT, verbosity_level=5)
 
-        json_str = simplejson.dumps(restParser.run(files, "{}?{}".format(all, query)), indent=2)
+        json_str = rest_json.dumps(restParser.run(files, "{}?{}".format(all, query)), pretty='pretty' in request.args)
         response = app.response_class(response=json_str, status=200, mimetype='application/json')
 
         return response
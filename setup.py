@@ -22,10 +22,11 @@ opts = dict(name=NAME,
             packages=PACKAGES,
             scripts=SCRIPTS,
             install_requires=INSTALL_REQUIRES,
+            python_requires=PYTHON_REQUIRES,
             #requires=INSTALL_REQUIRES,
             entry_points='''
                [console_scripts]
-               pynidm=nidm.experiment.tools.click_main:cli
+               pynidm=nidm.experiment.tools.click_base:main
             '''
 )
 